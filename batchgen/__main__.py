@@ -11,6 +11,14 @@ import sys
 
 from batchgen import batch_from_files
 from batchgen import __version__
+from batchgen.history import harvest_joblogs
+from batchgen.status import print_status, print_failed
+from batchgen.logs import print_task_output
+from batchgen.stream import stream_batches
+from batchgen.multi import batch_from_job_list
+from batchgen.report import print_report
+from batchgen.submit import drip_feed
+from batchgen.fetch import fetch_results
 
 
 def parse_arguments(args):
@@ -80,9 +88,326 @@ def parse_arguments(args):
     return vars(args)
 
 
+def parse_harvest_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen harvest",
+        description="Load joblogs of finished runs into the runtime history.",
+    )
+
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help="Joblog files or batch directories.",
+    )
+
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        dest="db_file",
+        help="History database (default: ~/.batchgen/history.sqlite).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_status_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen status",
+        description="Show the progress of a (running) job.",
+    )
+
+    parser.add_argument(
+        "batch_dir",
+        type=str,
+        help="Batch directory of the job (e.g. batch.slurm_lisa/my_job).",
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_const",
+        const=False,
+        default=True,
+        help="Read all progress records again instead of only new ones.",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_logs_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen logs",
+        description="Show the output of a single task (log_mode = indexed).",
+    )
+
+    parser.add_argument(
+        "batch_dir",
+        type=str,
+        help="Batch directory of the job (e.g. batch.slurm_lisa/my_job).",
+    )
+
+    parser.add_argument(
+        "task_id",
+        type=str,
+        help="Task identifier BATCH_ID.SEQ (e.g. 3.17).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_failed_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen failed",
+        description="List the commands of the tasks that failed after all "
+                    "retries (retry_max option).",
+    )
+
+    parser.add_argument(
+        "batch_dir",
+        type=str,
+        help="Batch directory of the job (e.g. batch.slurm_lisa/my_job).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_append_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen append",
+        description="Continuously add batches with new commands to a job. "
+                    "Commands are read from stdin, unless a file or socket "
+                    "is given.",
+    )
+
+    parser.add_argument(
+        "config_file",
+        type=str,
+        help="Configuration file (e.g. slurm_lisa.ini).",
+    )
+
+    parser.add_argument(
+        "--follow",
+        type=str,
+        default=None,
+        dest="input_file",
+        help="Read the lines that are appended to this file.",
+    )
+
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        dest="socket_file",
+        help="Listen on this unix socket for commands.",
+    )
+
+    parser.add_argument(
+        "-w", "--window",
+        type=float,
+        default=60,
+        help="Maximum waiting time [s] of a command before it is written "
+             "in a batch (default: 60).",
+    )
+
+    parser.add_argument(
+        "-n", "--fill-size",
+        type=int,
+        default=None,
+        dest="fill_size",
+        help="Number of commands per batch (default: num_tasks_per_node).",
+    )
+
+    parser.add_argument(
+        "--submit",
+        dest="submit",
+        action="store_true",
+        default=False,
+        help="Submit every new batch.",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_multi_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen multi",
+        description="Create the batch files of all jobs in a job list, "
+                    "and one script to submit them.",
+    )
+
+    parser.add_argument(
+        "job_list_file",
+        type=str,
+        help="Job list: INI file with a section per job, with its "
+             "command_file, config_file and optionally pre_post_file "
+             "(or pre_com_file/post_com_file).",
+    )
+
+    parser.add_argument(
+        "-f", "--force-overwrite",
+        dest="force_clear",
+        action="store_true",
+        default=False,
+        help="If batch directories exist, clear contents.",
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=None,
+        dest="num_workers",
+        help="Number of jobs generated at the same time (default: up to "
+             "8).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_report_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen report",
+        description="Report the efficiency of a run, from the accounting "
+                    "data (sacct) and the joblogs.",
+    )
+
+    parser.add_argument(
+        "batch_dir",
+        type=str,
+        help="Batch directory of the job (e.g. batch.slurm_lisa/my_job).",
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=str,
+        default=None,
+        dest="job_ids",
+        help="Comma separated job ids (default: the jobs with the job name "
+             "that were submitted after the batches were generated).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_submit_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen submit",
+        description="Submit the batches of a job within the queue limits "
+                    "of the site, as job arrays where possible.",
+    )
+
+    parser.add_argument(
+        "batch_dir",
+        type=str,
+        help="Batch directory of the job (e.g. batch.slurm_lisa/my_job).",
+    )
+
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=None,
+        dest="max_jobs",
+        help="Maximum number of queued jobs (default: max_submit_jobs, or "
+             "MaxSubmitJobs of the site).",
+    )
+
+    parser.add_argument(
+        "--max-array-size",
+        type=int,
+        default=None,
+        dest="max_array_size",
+        help="Maximum size of a job array (default: max_array_size, or "
+             "MaxArraySize of the site).",
+    )
+
+    parser.add_argument(
+        "-i", "--interval",
+        type=float,
+        default=60,
+        help="Time [s] between checks of the queue (default: 60).",
+    )
+
+    parser.add_argument(
+        "--once",
+        dest="once",
+        action="store_true",
+        default=False,
+        help="Only submit what fits now (e.g. from cron).",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+def parse_fetch_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="batchgen fetch",
+        description="Fetch the new and changed results of a remote job.",
+    )
+
+    parser.add_argument(
+        "config_file",
+        type=str,
+        help="Configuration file of the job (with [CONNECTION] or [TARGET] "
+             "sections).",
+    )
+
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="*",
+        help="Remote files/directories, relative to remote_dir (default: "
+             "output_dir and the batch directory of the job).",
+    )
+
+    parser.add_argument(
+        "-d", "--dest",
+        type=str,
+        default=".",
+        dest="dest_dir",
+        help="Local directory to fetch to (default: current directory).",
+    )
+
+    parser.add_argument(
+        "-i", "--interval",
+        type=float,
+        default=None,
+        help="Fetch again every INTERVAL seconds, until interrupted.",
+    )
+
+    args = parser.parse_args(args)
+    return vars(args)
+
+
+# Sub-commands: name -> (argument parser, function to execute).
+SUB_COMMANDS = {
+    "harvest": (parse_harvest_arguments, harvest_joblogs),
+    "status": (parse_status_arguments, print_status),
+    "logs": (parse_logs_arguments, print_task_output),
+    "failed": (parse_failed_arguments, print_failed),
+    "append": (parse_append_arguments, stream_batches),
+    "multi": (parse_multi_arguments, batch_from_job_list),
+    "report": (parse_report_arguments, print_report),
+    "submit": (parse_submit_arguments, drip_feed),
+    "fetch": (parse_fetch_arguments, fetch_results),
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUB_COMMANDS:
+        parse_sub_arguments, sub_command = SUB_COMMANDS[sys.argv[1]]
+        args = parse_sub_arguments(sys.argv[2:])
+        sys.exit(sub_command(**args))
     args = parse_arguments(sys.argv[1:])
-    batch_from_files(**args)
+    sys.exit(batch_from_files(**args))
 
 
 # If used from the command line.
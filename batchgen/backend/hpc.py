@@ -5,10 +5,25 @@ Base class for HPC backends.
 """
 
 import os
+import sys
 import errno
+import ctypes
+import time
+import fcntl
+import shlex
+import threading
+import uuid
 from string import Template
 
-from batchgen.util import _split_commands
+from batchgen.util import _split_commands, _chunk_commands, _chunk_size,\
+    _is_true, memory_to_kb, write_manifest, MANIFEST_FILE,\
+    _remove_duplicates, _common_prefix, read_manifest, time_to_seconds,\
+    seconds_to_time
+from batchgen.history import command_signature
+from batchgen.memo import memoizes, write_memo_table, MEMO_FILE
+from batchgen.backend.wrapper import uses_task_wrapper, task_wrapper_string,\
+    wrapper_command, indexed_logs, WRAPPER_FILE, PROGRESS_DIR, LOG_DIR,\
+    PREFIX_FUNCTION, speculates, speculate_string, SPECULATE_FILE
 
 
 def double_substitute(template, param):
@@ -63,12 +78,19 @@ def make_check_clean_directory(output_dir, force_clear=False):
 
         for cur_file in os.listdir(output_dir):
             file_path = os.path.join(output_dir, cur_file)
+            if os.path.isdir(file_path) and cur_file.startswith("shard_"):
+                # Sharded layout: clean the shard and remove it.
+                if not make_check_clean_directory(file_path, force_clear):
+                    return False
+                os.rmdir(file_path)
+                continue
             if not os.path.isfile(file_path):
                 print("Error: directory {dir} contains sub-directories.\n"
                       "Remove by hand to continue.\n"
                       .format(dir=output_dir))
                 return False
-            elif os.path.splitext(file_path)[1] != ".sh":
+            elif (os.path.splitext(file_path)[1] != ".sh" and
+                  cur_file != MANIFEST_FILE):
                 print("Error: non shell script {file} detected in {dir}\n"
                       "Remove by hand to continue\n"
                       .format(file=cur_file, dir=output_dir))
@@ -78,14 +100,218 @@ def make_check_clean_directory(output_dir, force_clear=False):
     return True
 
 
+def lock_batch_directory(batch_dir):
+    """ Prevent other batchgen processes from generating the same job.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory to lock.
+
+    Returns
+    -------
+    file:
+        Open lock file (close to release the lock), None if the directory
+        is locked by another process.
+    """
+    parent_dir, name = os.path.split(os.path.abspath(batch_dir))
+    if not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+    lock_file = open(os.path.join(parent_dir, "." + name + ".lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_file.close()
+        print("Error: another batchgen process is generating {dir}.".format(
+            dir=batch_dir))
+        return None
+    return lock_file
+
+
+def _not_generated(batch_dir):
+    """ Files in a batch directory that were not generated by batchgen
+        (e.g. output, joblogs and progress logs of a run).
+    """
+    found = []
+    for root, _, files in os.walk(batch_dir):
+        for file_name in files:
+            if (os.path.splitext(file_name)[1] != ".sh" and
+                    file_name not in (MANIFEST_FILE, MEMO_FILE)):
+                found.append(os.path.relpath(os.path.join(root, file_name),
+                                             batch_dir))
+    return sorted(found)
+
+
+def check_batch_directory(batch_dir, force_clear=False):
+    """ Check whether batches can be generated in a directory.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory to check.
+    force_clear: bool
+        Allow replacing previously generated batches.
+
+    Returns
+    -------
+    bool:
+        True if the directory is empty/non-existent, or only contains
+        files generated by batchgen that may be replaced.
+    """
+    if not os.path.isdir(batch_dir) or not os.listdir(batch_dir):
+        return True
+    contents = os.listdir(batch_dir)
+    if not force_clear:
+        print("Error: directory {dir} is not empty.\n"
+              "Change the name of the job, or...\n"
+              "Use -f/--force-overwrite to ignore "
+              "previous batch files.\nContents:\n"
+              .format(dir=batch_dir))
+        print(contents)
+        return False
+
+    # Only replace files generated by batchgen, not the results of a run.
+    not_generated = _not_generated(batch_dir)
+    if not_generated:
+        print("Error: {file} in {dir} was not generated by batchgen "
+              "({n} file(s) in total).\n"
+              "Remove by hand to continue\n"
+              .format(file=not_generated[0], dir=batch_dir,
+                      n=len(not_generated)))
+        return False
+    return True
+
+
+def make_stage_directory(batch_dir):
+    """ Create an empty sibling directory to generate the batches in. """
+    parent_dir, name = os.path.split(os.path.abspath(batch_dir))
+    stage_dir = os.path.join(parent_dir, ".{name}.stage-{pid}".format(
+        name=name, pid=os.getpid()))
+    if os.path.exists(stage_dir):
+        remove_tree(stage_dir)
+    os.makedirs(stage_dir)
+    return stage_dir
+
+
+def remove_tree(path, num_threads=8):
+    """ Remove a directory tree, unlinking the files in parallel.
+
+    Arguments
+    ---------
+    path: str
+        Directory to remove.
+    num_threads: int
+        Number of threads that unlink files.
+    """
+    files = []
+    dirs = []
+    todo = [path]
+    while todo:
+        cur_dir = todo.pop()
+        dirs.append(cur_dir)
+        for entry in os.scandir(cur_dir):
+            if entry.is_dir(follow_symlinks=False):
+                todo.append(entry.path)
+            else:
+                files.append(entry.path)
+
+    def _unlink(cur_files):
+        for file_name in cur_files:
+            os.unlink(file_name)
+
+    # Plain threads: a thread pool refuses new work once the interpreter
+    # is shutting down, which the background removal may outlive.
+    threads = [threading.Thread(target=_unlink,
+                                args=(files[i::num_threads],))
+               for i in range(max(1, min(num_threads, len(files))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for cur_dir in reversed(dirs):
+        os.rmdir(cur_dir)
+
+
+def _exchange(path_a, path_b):
+    """ Atomically exchange two paths with renameat2(RENAME_EXCHANGE).
+
+    Returns
+    -------
+    bool:
+        Whether the paths were exchanged: False if the system (not Linux,
+        glibc before 2.28, or a file system without support) can't.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except AttributeError:
+        return False
+    at_fdcwd, rename_exchange = -100, 2
+    if renameat2(at_fdcwd, os.fsencode(path_a), at_fdcwd,
+                 os.fsencode(path_b), rename_exchange) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err), path_a, None, path_b)
+
+
+def swap_directory(stage_dir, batch_dir):
+    """ Replace a batch directory with a staged one.
+
+    On Linux the two directories are exchanged atomically, so the batch
+    directory always exists and is either old or new. Elsewhere the old
+    directory is first renamed out of the way, which leaves a short window
+    in which the batch directory doesn't exist. The old directory is
+    removed in a background thread.
+
+    Arguments
+    ---------
+    stage_dir: str
+        Directory with the new batches.
+    batch_dir: str
+        Directory to replace.
+
+    Returns
+    -------
+    threading.Thread:
+        Thread that removes the old directory (None if there was none).
+    """
+    if not os.path.exists(batch_dir):
+        os.rename(stage_dir, batch_dir)
+        return None
+    old_dir = stage_dir.replace(".stage-", ".old-") + "-" + \
+        uuid.uuid4().hex[:8]
+    if _exchange(stage_dir, batch_dir):
+        os.rename(stage_dir, old_dir)
+    else:
+        os.rename(batch_dir, old_dir)
+        os.rename(stage_dir, batch_dir)
+    thread = threading.Thread(target=remove_tree, args=(old_dir,))
+    thread.start()
+    return thread
+
+
+def _max_memory(task_mem):
+    """ Maximum of the known memory estimates (None if all unknown). """
+    task_mem = [memory for memory in task_mem if memory is not None]
+    return max(task_mem) if task_mem else None
+
+
 class HPC(object):
     """ Abstract base class for manipulating HPC backends. """
 
+    # Whether new batches can be added to existing ones (see append).
+    _appendable = False
+
     def __init__(self):
         self._params = None
         self._batch_template = None
+        self._stage_dir = None
 
-    def write_batch(self, script_lines, param, batch_dir, force_clear=False):
+    def write_batch(self, script_lines, param, batch_dir, force_clear=False,
+                    write_dir=None, print_exec=True, append=False):
         """ Function to create submitable batch scripts.
 
         Arguments
@@ -96,18 +322,296 @@ class HPC(object):
             Dictionary with the parameters for the batch scripts.
         output_dir: str
             Directory for batch files.
+        write_dir: str
+            Directory where the batch files are written, if they are used
+            from another location (batch_dir), e.g. on a remote server.
+        print_exec: bool
+            Print the parameters and how to submit the batch.
+        append: bool
+            Add new batches to the existing ones, instead of replacing them.
+
+        Returns
+        -------
+        str:
+            Command to submit the (new) batches, None if nothing was written
+            (or run, for the local backend).
         """
+        if write_dir is None:
+            write_dir = batch_dir
 
-        if not make_check_clean_directory(batch_dir, force_clear):
-            return
+        lock = lock_batch_directory(write_dir)
+        if lock is None:
+            return None
+        try:
+            if append:
+                my_exec = self._append_batch(script_lines, param, batch_dir,
+                                             write_dir)
+                if my_exec is None:
+                    return None
+            else:
+                if not check_batch_directory(write_dir, force_clear):
+                    return None
+                my_exec = self._stage_batch(script_lines, param, batch_dir,
+                                            write_dir)
+        finally:
+            lock.close()
+        if print_exec and my_exec is not None:
+            self._print_execution(my_exec)
+        return my_exec
 
-        self._batch_template = self._create_batch_template()
+    def _generate(self, script_lines, param, batch_dir):
+        """ Parse the parameters and write all files of the batch. """
+        if self._batch_template is None:
+            self._batch_template = self._create_batch_template()
         param["script_lines"] = _split_commands(script_lines)
         param["batch_dir"] = batch_dir
         self._params = self._parse_params(param)
+        if "shard_size" in param.get("previous_manifest", {}):
+            # Appended batches use the layout of the existing ones.
+            self._params["shard_size"] = \
+                param["previous_manifest"]["shard_size"]
+        self._write_task_wrapper()
+        return self._write_batch_files()
+
+    def _stage_batch(self, script_lines, param, batch_dir, write_dir):
+        """ Generate the batches in a staging directory, which then
+            replaces the batch directory.
+        """
+        self._stage_dir = make_stage_directory(write_dir)
+        try:
+            my_exec = self._generate(script_lines, param, batch_dir)
+            write_manifest(self._stage_dir, self._manifest())
+        except BaseException:
+            remove_tree(self._stage_dir)
+            raise
+        swap_directory(self._stage_dir, write_dir)
+        return my_exec
+
+    def _append_batch(self, script_lines, param, batch_dir, write_dir):
+        """ Write new batches next to the existing ones, continuing their
+            numbering, and update the manifest.
+        """
+        previous = read_manifest(write_dir)
+        if not self._appendable:
+            print("Error: backend {backend} can't append batches.".format(
+                backend=param["backend"]))
+            return None
+        if previous is None or previous["backend"] != param["backend"]:
+            print("Error: no batches of backend {backend} to append to in "
+                  "{dir}.".format(backend=param["backend"], dir=write_dir))
+            return None
+        param["previous_manifest"] = previous
+        param["first_batch"] = previous["num_batches"]
+        # Files are written in place.
+        self._stage_dir = write_dir
+        my_exec = self._generate(script_lines, param, batch_dir)
+        manifest = self._manifest()
+        for key in ["num_tasks", "num_commands", "num_batches"]:
+            manifest[key] += previous[key]
+        if manifest["max_bill_time"] and previous.get("max_bill_time"):
+            manifest["max_bill_time"] = seconds_to_time(
+                time_to_seconds(manifest["max_bill_time"]) +
+                time_to_seconds(previous["max_bill_time"]))
+        manifest["created"] = previous["created"]
+        manifest["updated"] = time.time()
+        write_manifest(write_dir, manifest)
+        return my_exec
+
+    def _out(self, path):
+        """ Location where a file for the batch directory is written.
+
+        Arguments
+        ---------
+        path: str
+            Final location of the file (in the batch directory).
+
+        Returns
+        -------
+        str:
+            Location in the staging directory.
+        """
+        rel_path = os.path.relpath(path, self._params["batch_dir"])
+        return os.path.normpath(os.path.join(self._stage_dir, rel_path))
+
+    def _estimate_memory(self, param):
+        """ Estimate the peak memory of every command, from the history
+            (see history option) or mem_per_task. Sets task_mem [kB] with
+            None for unknown. With mem_sort, commands are ordered by memory
+            so that small tasks are packed together.
+
+        Arguments
+        ---------
+        param: dict
+            Dictionary of parameters.
+        """
+        default_mem = param.get("mem_per_task", None)
+        if default_mem is not None:
+            default_mem = memory_to_kb(default_mem)
+        estimates = param.get("history_estimates", {})
+        task_mem = []
+        for command in param["script_lines"]:
+            memory = estimates.get(command_signature(command), (0, None))[1]
+            task_mem.append(default_mem if memory is None else memory)
+
+        if _is_true(param.get("mem_sort", False)) and None not in task_mem:
+            order = sorted(range(len(task_mem)), key=lambda i: task_mem[i])
+            param["script_lines"] = [param["script_lines"][i] for i in order]
+            task_mem = [task_mem[i] for i in order]
+        param["task_mem"] = task_mem
 
-        my_exec = self._write_batch_files()
-        self._print_execution(my_exec)
+    def _compact_script_lines(self, param):
+        """ Remove duplicate commands and factor out their common prefix
+            (see compact option). The prefix is defined once per batch as a
+            shell function (parallel_prelude), every command calls it with
+            the rest of its arguments.
+
+        Arguments
+        ---------
+        param: dict
+            Dictionary of parameters, script_lines (and task_mem) are
+            replaced.
+        """
+        param["parallel_prelude"] = ""
+        param["compact_prefix"] = ""
+        if not _is_true(param.get("compact", False)):
+            return
+        script_lines = param["script_lines"]
+        keep = _remove_duplicates(script_lines)
+        num_duplicates = len(script_lines) - len(keep)
+        script_lines = [script_lines[i].strip() for i in keep]
+        if "task_mem" in param:
+            param["task_mem"] = [param["task_mem"][i] for i in keep]
+
+        prefix = _common_prefix(script_lines)
+        if prefix:
+            script_lines = [PREFIX_FUNCTION + " " + line[len(prefix):].strip()
+                            for line in script_lines]
+            param["parallel_prelude"] = """\
+{function}() {{ {prefix} "$@"; }}
+export -f {function}
+export _BG_PREFIX={quoted_prefix}
+""".format(function=PREFIX_FUNCTION, prefix=prefix,
+                quoted_prefix=shlex.quote(prefix))
+            param["compact_prefix"] = prefix
+        param["script_lines"] = script_lines
+        print("Compaction: removed {n} duplicate command(s), common prefix: "
+              "{prefix}".format(n=num_duplicates,
+                                prefix=prefix if prefix else "none"))
+
+    def _chunk_script_lines(self, param, dollar="$"):
+        """ Group tiny commands into compound tasks (see chunk_size option).
+
+        Arguments
+        ---------
+        param: dict
+            Dictionary of parameters, script_lines (and task_mem) are
+            replaced.
+        dollar: str
+            How dollar signs should be written in the commands.
+        """
+        param["num_commands"] = len(param["script_lines"])
+        param["chunk_size"] = _chunk_size(param)
+        param["script_lines"] = _chunk_commands(param["script_lines"],
+                                                param["chunk_size"], dollar)
+        task_mem = param.get("task_mem", [])
+        chunk_size = param["chunk_size"]
+        param["task_mem"] = [_max_memory(task_mem[i:i+chunk_size])
+                             for i in range(0, len(task_mem), chunk_size)]
+
+    def _core_concurrency(self, param, num_cores, num_simul):
+        """ Number of simultaneous tasks, if each task uses cores_per_task
+            cores.
+        """
+        cores_per_task = int(param.get("cores_per_task", 1))
+        return max(1, min(num_simul, num_cores // cores_per_task))
+
+    def _memory_concurrency(self, task_mem, num_simul, mem_per_node=None):
+        """ Number of simultaneous tasks that fit in memory, and the
+            options for GNU Parallel to only start tasks with enough free
+            memory.
+
+        Arguments
+        ---------
+        task_mem: list
+            Estimated memory [kB] of the tasks (in one batch).
+        num_simul: int
+            Maximum number of simultaneous tasks (cores).
+        mem_per_node: str
+            Memory available on the node (e.g. 64G), None if unknown.
+
+        Returns
+        -------
+        int:
+            Number of simultaneous tasks.
+        list:
+            Options for GNU Parallel.
+        """
+        max_mem = _max_memory(task_mem)
+        if max_mem is None:
+            return num_simul, []
+        if mem_per_node is not None:
+            num_fit = memory_to_kb(mem_per_node) // max(max_mem, 1)
+            num_simul = max(1, min(num_simul, num_fit))
+        return num_simul, ["--memfree {mem}K".format(mem=max_mem)]
+
+    def _write_task_wrapper(self):
+        """ Write the task wrapper if needed, and set the arguments
+            for GNU Parallel (parallel_args).
+        """
+        par = self._params
+        parallel_args = list(par.get("parallel_opts", []))
+        if uses_task_wrapper(par):
+            wrapper_file = self._out(os.path.join(par["batch_dir"],
+                                                  WRAPPER_FILE))
+            # Replace the file, running tasks may still be reading it.
+            with open(wrapper_file + ".tmp", "w") as f:
+                f.write(task_wrapper_string(par))
+            os.chmod(wrapper_file + ".tmp", 0o755)
+            os.rename(wrapper_file + ".tmp", wrapper_file)
+            parallel_args.append(wrapper_command(par))
+        if memoizes(par):
+            write_memo_table(self._out(os.path.join(par["batch_dir"],
+                                                    MEMO_FILE)),
+                             par["memo_table"])
+        if speculates(par):
+            speculate_file = self._out(os.path.join(par["batch_dir"],
+                                                    SPECULATE_FILE))
+            with open(speculate_file, "w") as f:
+                f.write(speculate_string(par))
+            os.chmod(speculate_file, 0o755)
+        log_dirs = []
+        if _is_true(par.get("progress", False)):
+            log_dirs.append(PROGRESS_DIR)
+        if indexed_logs(par):
+            log_dirs.append(LOG_DIR)
+        for log_dir in log_dirs:
+            log_dir = self._out(os.path.join(par["batch_dir"], log_dir))
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+        par["parallel_args"] = " ".join(parallel_args)
+
+    def _manifest(self):
+        """ Information on the generated batches, for other batchgen
+            commands (e.g. status).
+        """
+        par = self._params
+        manifest = {
+            "job_name": par["job_name"],
+            "backend": par["backend"],
+            "num_tasks": len(par["script_lines"]),
+            "num_commands": par["num_commands"],
+            "num_batches": par.get("num_batches", 1),
+            "clock_wall_time": par["clock_wall_time"],
+            "shard_size": par.get("shard_size", None),
+            "num_cores": par.get("max_num_cores", par.get("num_cores")),
+            "num_cores_simul": par.get("num_cores_simul", None),
+            "max_bill_time": par.get("max_bill_time", None),
+            # Queue limits of the site, for batchgen submit.
+            "max_submit_jobs": par.get("max_submit_jobs", None),
+            "max_array_size": par.get("max_array_size", None),
+            "created": time.time(),
+        }
+        return manifest
 
     def _create_batch_template(self):
         """ Function to generate a batch template.
@@ -0,0 +1,262 @@
+"""
+Local backend: the commands are run directly by batchgen (no batch script
+or GNU Parallel), with a bounded number of asyncio subprocesses.
+
+@author: Raoul Schram
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import subprocess
+
+from collections import namedtuple
+from string import Template
+from multiprocessing import cpu_count
+
+from batchgen.backend.hpc import HPC, double_substitute
+from batchgen.backend.parallel import _total_memory
+from batchgen.history import apply_history
+from batchgen.memo import apply_memo, memoizes, strip_markers,\
+    store_outputs
+from batchgen.util import _is_true
+
+
+TaskResult = namedtuple("TaskResult", ["seq", "start", "runtime",
+                                       "exit_code", "timed_out", "command"])
+
+
+class _PrePostShell(object):
+    """ Shell that runs the pre-commands, waits until the tasks are done,
+        and then runs the post-commands, as the batch script would do.
+        Tasks get the environment and working directory after the
+        pre-commands. If the pre-commands exit the shell (e.g. on an
+        error), exit_code is set and no tasks should be run.
+    """
+    def __init__(self, pre_com_string, env=None, cwd=None):
+        read_fd, write_fd = os.pipe()
+        self._shell = subprocess.Popen(["bash"], stdin=subprocess.PIPE,
+                                       env=env, cwd=cwd,
+                                       pass_fds=(write_fd,))
+        os.close(write_fd)
+        self._shell.stdin.write("""\
+{pre}
+printf "%s\\0" "$PWD" >&{fd}
+env -0 >&{fd}
+exec {fd}>&-
+read -r _bg_continue
+""".format(pre=pre_com_string, fd=write_fd).encode("utf-8"))
+        self._shell.stdin.flush()
+        with os.fdopen(read_fd, "rb") as f:
+            state = f.read().decode("utf-8").split("\0")
+        self.exit_code = None
+        if len(state) < 2:
+            # The pre-commands exited the shell, as in a batch script.
+            self.exit_code = self.finish("")
+            state = [None, ""]
+        self.cwd = state[0]
+        self.env = dict(entry.split("=", 1) for entry in state[1:-1]
+                        if "=" in entry)
+
+    def finish(self, post_com_string):
+        """ Run the post-commands, returns the exit code of the shell. """
+        if self._shell.poll() is None:
+            try:
+                self._shell.stdin.write(("\n" + post_com_string + "\n")
+                                        .encode("utf-8"))
+                self._shell.stdin.close()
+            except BrokenPipeError:
+                # The shell exited in the meantime.
+                pass
+        return self._shell.wait()
+
+
+async def _run_task(seq, command, env, cwd, timeout):
+    start = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        "bash", "-c", command, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, env=env, cwd=cwd, start_new_session=True)
+    timed_out = False
+    try:
+        output = (await asyncio.wait_for(proc.communicate(), timeout))[0]
+    except asyncio.TimeoutError:
+        os.killpg(proc.pid, signal.SIGKILL)
+        await proc.wait()
+        output = b""
+        timed_out = True
+    # Output of a task is printed in one piece, when it's done.
+    sys.stdout.flush()
+    getattr(sys.stdout, "buffer", sys.stdout).write(output)
+    sys.stdout.flush()
+    return TaskResult(seq, start, time.time()-start, proc.returncode,
+                      timed_out, command)
+
+
+async def _run_all(commands, num_workers, timeout, env, cwd, on_done):
+    semaphore = asyncio.Semaphore(num_workers)
+    results = []
+    running = set()
+
+    def _done(future):
+        semaphore.release()
+        running.discard(future)
+        results.append(future.result())
+        if on_done is not None:
+            on_done(future.result())
+
+    # Commands are taken from the iterator only when a worker is free.
+    for seq, command in enumerate(commands, start=1):
+        await semaphore.acquire()
+        task = asyncio.ensure_future(_run_task(seq, command, env, cwd,
+                                               timeout))
+        running.add(task)
+        task.add_done_callback(_done)
+    while running:
+        await asyncio.wait(list(running))
+    return sorted(results)
+
+
+def run_commands(commands, num_workers=None, timeout=None, env=None,
+                 cwd=None, on_done=None):
+    """ Run shell commands, with a bounded number at the same time.
+
+    Arguments
+    ---------
+    commands: iterable
+        Commands (str), can be a generator.
+    num_workers: int
+        Maximum number of commands running at the same time (default: the
+        number of cores).
+    timeout: float
+        Maximum run time [s] of a command, None for no limit.
+    env: dict
+        Environment of the commands.
+    cwd: str
+        Working directory of the commands.
+    on_done: function
+        Called with the TaskResult of every command when it is done.
+
+    Returns
+    -------
+    list:
+        TaskResult (seq, start, runtime, exit_code, timed_out, command) for
+        every command, in the order of the commands.
+    """
+    if num_workers is None:
+        num_workers = cpu_count()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run_all(
+            commands, num_workers, timeout, env, cwd, on_done))
+    finally:
+        loop.close()
+
+
+class Local(HPC):
+    """ Derived class from HPC. See hpc.py for method descriptions """
+
+    def _create_batch_template(self):
+        # Only for the substitution of the pre/post-commands.
+        t = Template("""\
+${pre_com_string}
+""")
+        return t
+
+    def _parse_params(self, param):
+        if "num_cores" not in param:
+            param["num_cores"] = cpu_count()
+        apply_memo(param)
+        apply_history(param)
+        self._estimate_memory(param)
+        self._compact_script_lines(param)
+        self._chunk_script_lines(param)
+        param["num_jobs"] = len(param["script_lines"])
+
+        num_cores = int(param["num_cores"])
+        num_simul = self._core_concurrency(param, num_cores, num_cores)
+        mem_per_node = param.get("mem_per_node", _total_memory())
+        param["num_workers"] = self._memory_concurrency(
+            param["task_mem"], num_simul, mem_per_node)[0]
+        if "task_timeout" in param:
+            param["task_timeout"] = float(param["task_timeout"])
+        else:
+            param["task_timeout"] = None
+        return param
+
+    def _write_task_wrapper(self):
+        # Bookkeeping is done by the backend itself.
+        self._params["parallel_args"] = ""
+
+    def _write_batch_files(self):
+        par = self._params
+        pre_com_string = double_substitute(
+            Template(par["parallel_prelude"] + par["pre_com_string"]), par)
+        post_com_string = double_substitute(
+            Template(par["post_com_string"]), par)
+        # Outputs of memoized commands are stored here (no task wrapper).
+        commands = (strip_markers(double_substitute(Template(line), par))[0]
+                    for line in par["script_lines"])
+
+        joblog = None
+        if _is_true(par.get("joblog", False)):
+            joblog = open(self._out(os.path.join(
+                par["batch_dir"], par["job_name"] + "_0.joblog")), "w")
+
+        def on_done(result):
+            if result.exit_code == 0 and memoizes(par):
+                line = par["script_lines"][result.seq-1]
+                for key in strip_markers(line)[1]:
+                    store_outputs(par["memo_dir"], key,
+                                  par["memo_table"][key])
+            if joblog is None:
+                return
+            joblog.write("{seq}\t{start}\t{runtime:.3f}\t{rc}\t-\t{cmd}\n"
+                         .format(seq=result.seq, start=int(result.start),
+                                 runtime=result.runtime, rc=result.exit_code,
+                                 cmd=result.command))
+            joblog.flush()
+
+        start = time.time()
+        shell = _PrePostShell(pre_com_string)
+        if shell.exit_code is not None:
+            if joblog is not None:
+                joblog.close()
+            print("Error: the pre-commands exited (exit code {rc}), no "
+                  "commands were run.".format(rc=shell.exit_code))
+            return None
+        try:
+            results = run_commands(commands, par["num_workers"],
+                                   par["task_timeout"], shell.env, shell.cwd,
+                                   on_done)
+        finally:
+            shell.finish(post_com_string)
+            if joblog is not None:
+                joblog.close()
+        elapsed = max(time.time() - start, 1e-6)
+
+        par["num_failed"] = sum(1 for result in results
+                                if result.exit_code != 0)
+        par["num_timed_out"] = sum(1 for result in results
+                                   if result.timed_out)
+        par["elapsed"] = "{t:.1f} s".format(t=elapsed)
+        par["throughput"] = "{r:.2f} tasks/s".format(r=len(results)/elapsed)
+        return ""
+
+    def _print_execution(self, exec_script):
+        par = self._params
+        print_template = """\
+******************************************************
+**                    Local run                     **
+******************************************************
+** Job name        : {job_name: <31}**
+** Number of jobs  : {num_jobs: <31}**
+** Workers         : {num_workers: <31}**
+** Failed          : {num_failed: <31}**
+** Timed out       : {num_timed_out: <31}**
+** Elapsed         : {elapsed: <31}**
+** Throughput      : {throughput: <31}**
+******************************************************
+        """.format(**par)
+        print(print_template)
@@ -9,6 +9,18 @@ from string import Template
 from multiprocessing import cpu_count
 
 from batchgen.backend.hpc import HPC, double_substitute
+from batchgen.history import apply_history
+from batchgen.memo import apply_memo
+from batchgen.backend.wrapper import speculates, speculate_command
+
+
+def _total_memory():
+    """ Total memory of this machine (e.g. 16384K), None if unknown. """
+    try:
+        mem_bytes = os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+    return str(mem_bytes // 1024) + "K"
 
 
 class Parallel(HPC):
@@ -18,7 +30,7 @@ class Parallel(HPC):
 #!/bin/bash
 
 ${pre_com_string}
-parallel ${num_cores_w_arg}< ${command_file}
+${parallel_prelude}parallel ${num_cores_w_arg}${parallel_args_w_arg}< ${command_file}
 ${post_com_string}
 """)
         return t
@@ -39,26 +51,48 @@ ${post_com_string}
 
         param["command_file"] = command_file
         param["batch_file"] = batch_file
+        apply_memo(param)
+        apply_history(param)
+        self._estimate_memory(param)
+        self._compact_script_lines(param)
+        self._chunk_script_lines(param)
         param["num_jobs"] = len(param["script_lines"])
 
+        # Limit the number of simultaneous jobs by cores and memory.
+        num_cores = int(param["num_cores"])
+        num_simul = self._core_concurrency(param, num_cores, num_cores)
+        mem_per_node = param.get("mem_per_node", _total_memory())
+        num_simul, mem_opts = self._memory_concurrency(
+            param["task_mem"], num_simul, mem_per_node)
+        if mem_opts or num_simul != num_cores:
+            param["num_cores_w_arg"] = "-j " + str(num_simul) + " "
+        param["parallel_opts"] = mem_opts
+        if speculates(param):
+            param["parallel_prelude"] += speculate_command(
+                param, param["batch_id"], param["num_jobs"], num_simul)
+
         return param
 
     def _write_batch_files(self):
         par = self._params
+        if par["parallel_args"]:
+            par["parallel_args_w_arg"] = par["parallel_args"] + " "
+        else:
+            par["parallel_args_w_arg"] = ""
         batch_str = double_substitute(self._batch_template, par)
         script_lines = Template("\n".join(par["script_lines"]))
         script_lines = double_substitute(script_lines, par)
         batch_file = par["batch_file"]
         # Write all the commands executed in parallel.
-        with open(par["command_file"], "w") as f:
+        with open(self._out(par["command_file"]), "w") as f:
             f.write(script_lines)
 
         # Write batch script (inc. pre/post commands that are not in parallel).
-        with open(batch_file, "w") as f:
+        with open(self._out(batch_file), "w") as f:
             f.write(batch_str)
 
         # Make the batch script executable.
-        os.chmod(batch_file, 0o755)
+        os.chmod(self._out(batch_file), 0o755)
 
         # Bash command to submit the scripts.
         return batch_file
@@ -5,13 +5,21 @@ SLURM on Lisa (SURFSara) backend for running batch style scripts.
 """
 
 import os
+import shlex
 from string import Template
 
 from batchgen.backend.hpc import HPC, double_substitute
-from batchgen.util import mult_time
+from batchgen.util import mult_time, shard_size, batch_file_path, _is_true,\
+    time_to_seconds, seconds_to_time, memory_to_kb
+from batchgen.history import apply_history, history_shape
+from batchgen.memo import apply_memo
+from batchgen.backfill import backfill_shape, regular_layout
+from batchgen.backend.wrapper import indexed_logs, _cpu_bind, LOG_DIR,\
+    speculates, speculate_command
 
 
-def _get_body(script_lines, num_cores_simul, silence=False):
+def _get_body(script_lines, num_cores_simul, silence=False, parallel_args="",
+              num_staged=None):
     """Function to create the body of the script files, staging their start.
 
     Arguments
@@ -20,42 +28,212 @@ def _get_body(script_lines, num_cores_simul, silence=False):
         List of strings where each element is one command to be submitted.
     sum_cores_simul: int
         Number of cores used simultaneously.
+    silence: bool
+        Discard the output of the commands.
+    parallel_args: str
+        Extra options/command template for GNU Parallel.
+    num_staged: int
+        Number of commands with a staged start (default: num_cores_simul).
     Returns
     -------
     str:
         Joined commands.
     """
+    return (_parallel_command(num_cores_simul, parallel_args) +
+            " << EOF_PARALLEL\n" +
+            _task_lines(script_lines, num_cores_simul, silence, num_staged) +
+            "EOF_PARALLEL\n")
 
-    # Stage the commands every 1 second.
-    body = "parallel -j {num_cores_simul} << EOF_PARALLEL\n"
-    body = body.format(num_cores_simul=num_cores_simul)
+
+def _parallel_command(num_cores_simul, parallel_args=""):
+    """ GNU Parallel with its options, without the input. """
+    command = "parallel -j {num_cores_simul}".format(
+        num_cores_simul=num_cores_simul)
+    if parallel_args:
+        command += " " + parallel_args
+    return command
+
+
+def _task_lines(script_lines, num_cores_simul, silence=False,
+                num_staged=None):
+    """ Commands for the here-document, the first ones with a staged
+        start (every 1 second).
+    """
+    if num_staged is None:
+        num_staged = num_cores_simul
     if silence:
         redirect = "&> /dev/null"
     else:
         redirect = ""
+    lines = ""
     for i, line in enumerate(script_lines):
         new_line = line.rstrip() + redirect + "\n"
-        if i < num_cores_simul:
+        if i < num_staged:
             new_line = "sleep {i}; ".format(i=i) + new_line
-        body = body+new_line
-    body += "EOF_PARALLEL\n"
-    return body
+        lines += new_line
+    return lines
+
+
+def _task_id_args(parallel_args):
+    """ Options/command template for GNU Parallel with task lines
+        "ID<TAB>COMMAND": the task id ({id}) replaces the sequence number
+        ({#}), which restarts at 1 in a continuation of the batch.
+    """
+    rpl = "--rpl '{id} s/\\t.*//' --rpl '{cmd} s/^[^\\t]*\\t//'"
+    if "{}" not in parallel_args:
+        # Without a command template, the task lines are the commands.
+        parallel_args = (parallel_args + " eval {}").strip()
+    return rpl + " " + parallel_args.replace("{#}", "{id}").replace(
+        "{}", "{cmd}")
+
+
+def _get_checkpoint_body(script_lines, num_cores_simul, batch_file,
+                         checkpoint_dir, parallel_args="", num_staged=None,
+                         monitor=""):
+    """ Body that stops at the warning signal (USR1) before the wall time,
+        and submits a continuation of the batch with the remaining tasks.
+
+    The tasks are written to a file, and GNU Parallel records the finished
+    ones in its joblog. The tasks that were running at the checkpoint are
+    killed, and run again by the continuation. A continuation reads its
+    tasks from the file in BATCHGEN_TASKS. Every task keeps its id (line
+    number in the first task file), which is given to the task wrapper.
+
+    Arguments
+    ---------
+    script_lines: str
+        List of strings where each element is one command to be submitted.
+    num_cores_simul: int
+        Number of cores used simultaneously.
+    batch_file: str
+        Batch script that is submitted again as the continuation.
+    checkpoint_dir: str
+        Directory for the task files and the GNU Parallel joblogs (.done,
+        not in the format of batchgen joblogs) of the batch.
+    parallel_args: str
+        Extra options/command template for GNU Parallel.
+    num_staged: int
+        Number of commands with a staged start (default: num_cores_simul).
+    monitor: str
+        Lines that start the speculation monitor, once the tasks are known
+        (the number of tasks is that of $_bg_tasks).
+
+    Returns
+    -------
+    str:
+        Body of the batch script.
+    """
+    return """\
+_bg_ckpt={checkpoint_dir}
+mkdir -p "$_bg_ckpt"
+_bg_tasks=${{BATCHGEN_TASKS:-$_bg_ckpt/$SLURM_JOB_ID.tasks}}
+if [ -z "$BATCHGEN_TASKS" ]; then
+cat > "$_bg_tasks" << EOF_PARALLEL
+{task_lines}EOF_PARALLEL
+fi
+{monitor}_bg_joblog="$_bg_ckpt/$SLURM_JOB_ID.done"
+_bg_stop=0
+trap '_bg_stop=1' USR1
+setsid {parallel} < "$_bg_tasks" &
+_bg_parallel=$!
+wait $_bg_parallel
+if [ $_bg_stop = 1 ]; then
+    # Stop launching tasks, the running tasks are rerun by the continuation.
+    kill -KILL -- -$_bg_parallel 2> /dev/null
+    wait $_bg_parallel
+    _bg_remaining="$_bg_ckpt/$SLURM_JOB_ID.remaining"
+    awk 'FILENAME == ARGV[1] {{ if (FNR > 1) done[$1] = 1; next }}
+        !(FNR in done)' "$_bg_joblog" "$_bg_tasks" > "$_bg_remaining"
+    _bg_left=$(wc -l < "$_bg_remaining")
+    if [ $_bg_left -ge $(wc -l < "$_bg_tasks") ]; then
+        echo "batchgen: no task finished before the checkpoint, not" \\
+            "resubmitted. Remaining tasks: $_bg_remaining" >&2
+    elif [ $_bg_left -gt 0 ]; then
+        echo "batchgen: checkpoint, $_bg_left task(s) left for the" \\
+            "continuation."
+        BATCHGEN_TASKS="$_bg_remaining" sbatch {batch_file}
+    fi
+fi
+""".format(checkpoint_dir=shlex.quote(checkpoint_dir),
+           batch_file=shlex.quote(batch_file), monitor=monitor,
+           parallel=_parallel_command(
+               num_cores_simul, '--joblog "$_bg_joblog" ' +
+               _task_id_args(parallel_args)),
+           task_lines="".join(
+               "{i}\t{line}\n".format(i=i, line=line) for i, line in
+               enumerate(_task_lines(script_lines, num_cores_simul,
+                                     num_staged=num_staged).splitlines(),
+                         start=1)))
+
+
+def _step_launcher(param, num_simul=None):
+    """ srun command that starts a task as a job step on one node, with
+        its share of the cores and memory of the node.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of parameters.
+    num_simul: int
+        Number of simultaneous tasks per node, None if it is only known
+        when the batch runs (the speculation monitor, with NUM_SIMUL tasks
+        on all nodes of the allocation).
+
+    Returns
+    -------
+    str:
+        Launcher command.
+    """
+    cores_per_task = (param["max_num_cores"]-1)//param["num_cores_simul"] + 1
+    launcher = "srun --exclusive -N1 -n1 -c {cpt}".format(
+        cpt=int(param.get("cores_per_task", cores_per_task)))
+    if "mem_per_node" not in param:
+        return launcher
+    # Without an explicit share, every step takes all memory of the node.
+    mem = memory_to_kb(param["mem_per_node"])
+    if num_simul is None:
+        return launcher + " --mem=$(({mem}*SLURM_NNODES/num_simul))K".format(
+            mem=mem)
+    return launcher + " --mem={mem}K".format(mem=mem//num_simul)
+
+
+def _node_prelude(pre_com_string):
+    """ Run the pre-commands (and node cache) on the other nodes of the
+        allocation, once per node. The first node runs them in the batch
+        script itself, so that its environment is passed to the job steps.
+    """
+    if not pre_com_string.strip():
+        return ""
+    return """\
+# Pre-commands on the other nodes of the allocation.
+if [ "${{SLURM_NNODES:-1}}" -gt 1 ]; then
+    srun --nodes=$((SLURM_NNODES-1)) --ntasks-per-node=1 --input=all \\
+        --exclude="$SLURMD_NODENAME" bash << 'EOF_PRELUDE' || {{
+{pre_com_string}
+EOF_PRELUDE
+        echo "Error: pre-commands failed on one of the nodes." >&2
+        exit 1
+    }}
+fi
+""".format(pre_com_string=pre_com_string.rstrip("\n"))
 
 
 class SlurmLisa(HPC):
     """ Derived class from HPC. See hpc.py for method descriptions """
 
+    _appendable = True
+
     def _create_batch_template(self):
         t = Template("""\
 #!/bin/bash
-#SBATCH -t ${clock_wall_time}
+#SBATCH -t ${batch_wall_time}
 #SBATCH --tasks-per-node=${num_cores}
 #SBATCH -J ${job_name}
-#SBATCH --output=${batch_dir}/${job_name}_${batch_id}.out
-#SBATCH --error=${batch_dir}/${job_name}_${batch_id}.err
-
+#SBATCH --output=${slurm_output}
+#SBATCH --error=${slurm_error}
+${sbatch_directives}
 ${pre_com_string}
-${main_body}
+${node_prelude}${main_body}
 ${post_com_string}
 
 if [ "${send_mail}" == "True" ]; then
@@ -68,6 +246,7 @@ date
 
     def _parse_params(self, param):
 
+        explicit_tpn = "num_tasks_per_node" in param
         # If the number of cores is not supplied, set it to the default 16.
         if "num_cores" in param:
             num_cores = int(param["num_cores"])
@@ -77,22 +256,80 @@ date
             param["num_cores_simul"] = num_cores
         if "num_tasks_per_node" not in param:
             param["num_tasks_per_node"] = param["num_cores_simul"]
-        param["num_cores_simul"] = int(param["num_cores_simul"])
+        param["num_cores_simul"] = self._core_concurrency(
+            param, num_cores, int(param["num_cores_simul"]))
         param["num_tasks_per_node"] = int(param["num_tasks_per_node"])
+        apply_memo(param)
+        apply_history(param)
+        self._estimate_memory(param)
+        self._compact_script_lines(param)
+        # Commands end up in an unquoted here-document.
+        self._chunk_script_lines(param, dollar="\\$")
+        history_shape(param, explicit_tpn)
 
         tasks_per_node = param["num_tasks_per_node"]
         num_tasks = len(param["script_lines"])
         max_num_cores = num_cores
-        num_nodes = (num_tasks-1) // tasks_per_node + 1
-        cost_factor = 16*num_nodes
+        # Multi-node mode: one allocation of several nodes per batch.
+        nodes_per_job = int(param.get("nodes_per_job", 1))
+        if nodes_per_job > 1 and _cpu_bind(param) is not None:
+            print("Warning: cpu_bind is ignored with nodes_per_job > 1, "
+                  "job steps are bound by srun.")
+            param["cpu_bind"] = "none"
 
         param["num_cores"] = num_cores
         param["max_num_cores"] = max_num_cores
+        param["nodes_per_job"] = nodes_per_job
+        # Number of tasks, nodes, wall time and tasks per node of every batch.
+        backfill_shape(param)
+        if "batch_layout" not in param:
+            param["batch_layout"] = regular_layout(
+                num_tasks, tasks_per_node, nodes_per_job,
+                param["clock_wall_time"])
+        num_nodes = sum(batch[1] for batch in param["batch_layout"])
         param["num_nodes"] = num_nodes
+        param["speculate_launcher"] = ""
+        param["node_prelude"] = ""
+        if nodes_per_job > 1:
+            # Job steps (tasks and their speculative copies) on one node.
+            param["speculate_launcher"] = _step_launcher(param)
+            param["node_prelude"] = _node_prelude(
+                param.get("pre_com_string", ""))
+        param["num_batches"] = len(param["batch_layout"])
+        param["shard_size"] = shard_size(param)
         param["num_tasks"] = num_tasks
 
-        param["max_bill_time"] = mult_time(param["clock_wall_time"],
-                                           cost_factor)
+        if param.get("backfill_shapes"):
+            param["max_bill_time"] = seconds_to_time(sum(
+                16*batch[1]*time_to_seconds(batch[2])
+                for batch in param["batch_layout"]))
+        else:
+            param["max_bill_time"] = mult_time(param["clock_wall_time"],
+                                               16*num_nodes)
+
+        # Extra #SBATCH lines, each ending with a newline.
+        param["sbatch_directives"] = ""
+        if indexed_logs(param):
+            # Output of the batch script itself: one file per node.
+            param["slurm_output"] = "${batch_dir}/" + LOG_DIR + "/%N.out"
+            param["slurm_error"] = param["slurm_output"]
+            param["sbatch_directives"] += "#SBATCH --open-mode=append\n"
+        else:
+            log_base = "${batch_subdir}/${job_name}_${batch_id}"
+            param["slurm_output"] = log_base + ".out"
+            param["slurm_error"] = log_base + ".err"
+        if "mem_per_node" in param:
+            param["sbatch_directives"] += "#SBATCH --mem={mem}\n".format(
+                mem=param["mem_per_node"])
+        if nodes_per_job > 1:
+            param["sbatch_directives"] += "#SBATCH --nodes=${batch_nodes}\n"
+        if _is_true(param.get("checkpoint", False)):
+            # Warning signal to the batch shell, before the wall time.
+            param["sbatch_directives"] += "#SBATCH --signal=B:USR1@{t}\n"\
+                .format(t=int(param.get("checkpoint_time", 300)))
+            if not indexed_logs(param):
+                # Continuations append to the output of the batch.
+                param["sbatch_directives"] += "#SBATCH --open-mode=append\n"
 
         return param
 
@@ -101,29 +338,81 @@ date
         script_lines = par["script_lines"]
         num_cores = par["num_cores"]
         batch_dir = par["batch_dir"]
-        num_tasks = par["num_tasks"]
-        tpn = par["num_tasks_per_node"]
         ncs = par["num_cores_simul"]
+        first_batch = par.get("first_batch", 0)
+        nodes_per_job = par["nodes_per_job"]
+        cores_per_task = (num_cores-1)//ncs+1
+        new_files = []
         # Split the commands in batches.
-        for batch_id, i in enumerate(range(0, num_tasks, tpn)):
+        i = 0
+        for batch_id, (tpb, batch_nodes, wall_time, tpn) in enumerate(
+                par["batch_layout"], start=first_batch):
             # Output file
-            batch_file = os.path.join(batch_dir,
-                                      "batch_" + str(batch_id) + ".sh")
-            par["main_body"] = _get_body(script_lines[i:i+tpn], ncs)
+            batch_file = batch_file_path(batch_dir, batch_id,
+                                         par["shard_size"])
+            new_files.append(batch_file)
+            par["batch_subdir"] = os.path.dirname(batch_file)
+            if not os.path.isdir(self._out(par["batch_subdir"])):
+                os.makedirs(self._out(par["batch_subdir"]))
+            batch_lines = script_lines[i:i+tpb]
+            num_simul, parallel_opts = self._memory_concurrency(
+                par["task_mem"][i:i+tpb], ncs, par.get("mem_per_node"))
+            i += tpb
+            task_command = par["parallel_args"]
+            if nodes_per_job > 1:
+                # Free memory can only be checked on the first node.
+                parallel_opts = []
+                # Every task is a job step on one of the nodes.
+                task_command = "{srun} {command}".format(
+                    srun=_step_launcher(par, num_simul),
+                    command=task_command or "bash -c {}")
+            parallel_args = " ".join(parallel_opts + [task_command])
+            if _is_true(par.get("checkpoint", False)):
+                # A continuation runs only the tasks left in $_bg_tasks.
+                monitor = ""
+                if speculates(par):
+                    monitor = speculate_command(
+                        par, batch_id, '$(wc -l < "$_bg_tasks")',
+                        num_simul*batch_nodes)
+                body = _get_checkpoint_body(
+                    batch_lines, num_simul*batch_nodes, batch_file,
+                    os.path.join(par["batch_subdir"],
+                                 "checkpoint_{i}".format(i=batch_id)),
+                    parallel_args=parallel_args.strip(),
+                    num_staged=num_simul, monitor=monitor)
+            else:
+                body = _get_body(batch_lines, num_simul*batch_nodes,
+                                 parallel_args=parallel_args.strip(),
+                                 num_staged=num_simul)
+                if speculates(par):
+                    body = speculate_command(
+                        par, batch_id, len(batch_lines),
+                        num_simul*batch_nodes) + body
+            par["main_body"] = par["parallel_prelude"] + body
             par["batch_id"] = batch_id
-            if len(script_lines[i:i+tpn]) < tpn:
-                num_task_remain = len(script_lines[i:i+tpn])
-                cores_per_task = (num_cores-1)//ncs+1
+            par["batch_nodes"] = batch_nodes
+            par["batch_wall_time"] = wall_time
+            par["num_cores"] = num_cores
+            if len(batch_lines) < tpn:
+                num_task_remain = len(batch_lines)
                 par["num_cores"] = min(num_cores,
                                        num_task_remain*cores_per_task)
 
             # Allow for one more substitution to facilitate user substitution.
             batch_script = double_substitute(self._batch_template, par)
-            with open(batch_file, "w") as f:
+            with open(self._out(batch_file), "w") as f:
                 f.write(batch_script)
 
         # Execute the following to submit the batch.
-        my_exec = "for FILE in {batch_dir}/batch_*.sh; do sbatch $FILE; done"
+        if first_batch:
+            # Only the appended batches.
+            batch_glob = " ".join(new_files).replace("{", "{{").replace(
+                "}", "}}")
+        elif par["shard_size"]:
+            batch_glob = "{batch_dir}/shard_*/batch_*.sh"
+        else:
+            batch_glob = "{batch_dir}/batch_*.sh"
+        my_exec = "for FILE in " + batch_glob + "; do sbatch $FILE; done"
 
         return my_exec.format(batch_dir=batch_dir)
 
@@ -142,10 +431,12 @@ date
 ** Maximum run time  : {clock_wall_time: <29}**
 ** Number of nodes   : {num_nodes: <29}**
 ** Max billing time  : {max_bill_time: <29}**
-******************************************************
+{shapes}******************************************************
 ** Execute the following on the command line (bash) **
 ******************************************************
 
 {exec_script}
-        """.format(exec_script=exec_script, **par)
+        """.format(exec_script=exec_script, shapes="".join(
+            "** Batch shape       : {shape: <29}**\n".format(shape=shape)
+            for shape in par.get("backfill_shapes", [])), **par)
         print(print_template)
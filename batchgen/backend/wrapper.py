@@ -0,0 +1,595 @@
+"""
+Task wrapper for running commands inside GNU Parallel.
+
+Some options (e.g. the joblog) need a bit of bookkeeping around every
+command. In that case, GNU Parallel calls the wrapper script with the
+command as an argument instead of executing the command directly:
+
+    task_wrapper.sh BATCH_ID SEQ SLOT COMMAND
+
+@author: Raoul Schram
+"""
+
+import os
+import shlex
+
+from batchgen.util import _is_true
+from batchgen.memo import memoizes, MEMO_FILE, MEMO_MARKER, KEY_LENGTH
+
+
+WRAPPER_FILE = "task_wrapper.sh"
+PROGRESS_DIR = "progress"
+LOG_DIR = "logs"
+SPECULATE_FILE = "speculate.sh"
+# Commands of tasks that failed (after retries), one list per batch.
+FAILED_EXT = ".failed"
+# Shell function holding the common prefix of compacted commands.
+PREFIX_FUNCTION = "_bg_cmd"
+
+
+def uses_task_wrapper(param):
+    """ Check whether any of the options needs the task wrapper. """
+    return (_is_true(param.get("joblog", False)) or
+            _is_true(param.get("progress", False)) or
+            indexed_logs(param) or _binds_cores(param) or
+            speculates(param) or retries(param) or memoizes(param))
+
+
+def retries(param):
+    """ Check whether failed tasks are tried again. """
+    return int(param.get("retry_max", 1)) > 1
+
+
+def speculates(param):
+    """ Check whether long-tail tasks are re-executed speculatively. """
+    return _is_true(param.get("speculate", False))
+
+
+def indexed_logs(param):
+    """ Check whether task output goes to the indexed, per node logs. """
+    return param.get("log_mode", "batch").strip().lower() == "indexed"
+
+
+def _binds_cores(param):
+    """ Check whether tasks are bound to cores/use multiple cores. """
+    return (_cpu_bind(param) is not None or
+            int(param.get("cores_per_task", 1)) > 1)
+
+
+def _cpu_bind(param):
+    """ Binding tool (taskset/numactl), None if tasks are not bound. """
+    cpu_bind = param.get("cpu_bind", "none").strip().lower()
+    if cpu_bind in ("taskset", "numactl"):
+        return cpu_bind
+    return None
+
+
+def _subdir_line(param):
+    """ Shell line that sets the directory of the batch (batch_subdir). """
+    if param.get("shard_size"):
+        return ('batch_subdir="$batch_dir/shard_$(printf %04d '
+                '$(( batch_id / {n} )))"'.format(n=param["shard_size"]))
+    return 'batch_subdir="$batch_dir"'
+
+
+def _header(param):
+    header = """\
+#!/bin/bash
+# Task wrapper generated by batchgen.
+# Usage: {wrapper_file} BATCH_ID SEQ SLOT COMMAND
+
+batch_dir={batch_dir}
+job_name={job_name}
+batch_id=$1
+seq=$2
+slot=$3
+command=$4
+{batch_subdir}
+
+_bg_append() {{
+    # Append a line to a (shared) log file.
+    ( flock -x 9; printf "%s\\n" "$2" >&9 ) 9>> "$1"
+}}
+
+""".format(wrapper_file=WRAPPER_FILE, batch_subdir=_subdir_line(param),
+           batch_dir=shlex.quote(param["batch_dir"]),
+           job_name=shlex.quote(param["job_name"]))
+    return header
+
+
+def _bind_cores(param):
+    """ Bind the task to a fixed set of cores, determined by the job slot.
+
+    Slot s gets cores (s-1)*k, ..., s*k-1 of the cores this job may use,
+    with k=cores_per_task. OMP_NUM_THREADS is set to k.
+    """
+    bind = """\
+cores_per_task={cores_per_task}
+export OMP_NUM_THREADS=$cores_per_task
+""".format(cores_per_task=int(param.get("cores_per_task", 1)))
+    cpu_bind = _cpu_bind(param)
+    if cpu_bind is None:
+        return bind + "\n"
+
+    if cpu_bind == "taskset":
+        bind_command = '_bg_bind=(taskset -c "$_bg_cores")'
+    else:
+        bind_command = ('_bg_bind=(numactl --physcpubind="$_bg_cores" '
+                        '--localalloc)')
+    bind += """\
+_bg_cpus=()
+for _bg_range in $(taskset -pc $$ 2> /dev/null | sed 's/.*: //' |
+                   tr ',' ' '); do
+    if [[ $_bg_range == *-* ]]; then
+        for ((_bg_c=${{_bg_range%-*}}; _bg_c<=${{_bg_range#*-}}; _bg_c++)); do
+            _bg_cpus+=($_bg_c)
+        done
+    else
+        _bg_cpus+=($_bg_range)
+    fi
+done
+# Without a list of cores (no taskset, empty mask), tasks are not bound.
+_bg_bind=()
+if [ ${{#_bg_cpus[@]}} -gt 0 ]; then
+    _bg_first=$(( (slot-1)*cores_per_task % ${{#_bg_cpus[@]}} ))
+    _bg_cores=$(IFS=,; echo "${{_bg_cpus[*]:_bg_first:cores_per_task}}")
+    {bind_command}
+fi
+
+""".format(bind_command=bind_command)
+    return bind
+
+
+def _run_task(param):
+    """ Execute the command, which sets rc (and maxrss for the joblog). """
+    run = 'bash -c "$command"'
+    if _cpu_bind(param) is not None:
+        run = '"${_bg_bind[@]}" ' + run
+    setup = ""
+    if indexed_logs(param):
+        run += ' > "$_bg_out" 2> "$_bg_err"'
+        setup = '_bg_out=$(mktemp)\n_bg_err=$(mktemp)\n'
+    # Stderr is matched against the retry patterns after every attempt.
+    show_err = ""
+    if _retry_patterns(param) and not indexed_logs(param):
+        run += ' 2> "$_bg_err"'
+        setup = '_bg_err=$(mktemp)\n'
+        show_err = 'cat "$_bg_err" >&2\n'
+    # Speculative copies are started in their own process group.
+    spec = "_bg_spec_run " if speculates(param) else ""
+    if _is_true(param.get("joblog", False)):
+        body = """\
+_bg_start=$(date +%s%N)
+if [ -x /usr/bin/time ]; then
+    _bg_rss_file=$(mktemp)
+    {spec}/usr/bin/time -f %M -o "$_bg_rss_file" {run}
+    rc=$?
+    maxrss=$(tail -n 1 "$_bg_rss_file")
+    rm -f "$_bg_rss_file"
+else
+    {spec}{run}
+    rc=$?
+    maxrss=-
+fi
+_bg_end=$(date +%s%N)
+""".format(run=run, spec=spec)
+    else:
+        body = """\
+{spec}{run}
+rc=$?
+""".format(run=run, spec=spec)
+    body += show_err
+    if not retries(param):
+        return setup + body
+    body = "".join("    " + line if line else line
+                   for line in body.splitlines(True))
+    clear = ""
+    if _chunks(param):
+        # Failed commands of the last attempt of a compound task.
+        setup += "export _BG_FAILED=$(mktemp)\n"
+        clear = '    : > "$_BG_FAILED"\n'
+    run_loop = setup + _retry_function(param) + """
+while :; do
+{clear}{body}    _bg_retry || break
+done
+""".format(body=body, clear=clear)
+    if show_err:
+        run_loop += 'rm -f "$_bg_err"\n'
+    return run_loop
+
+
+def _retry_patterns(param):
+    """ Extended regular expressions (one per line) for retryable stderr. """
+    patterns = param.get("retry_stderr_patterns", "")
+    return [pattern.strip() for pattern in patterns.splitlines()
+            if pattern.strip()]
+
+
+def _retry_function(param):
+    """ Decide whether a failed attempt is tried again: the exit code and
+        stderr have to match (if given), with an exponential backoff.
+    """
+    checks = ""
+    exit_codes = param.get("retry_exit_codes", "").replace(",", " ").split()
+    if exit_codes:
+        checks += """\
+    case " {codes} " in
+        *" $rc "*) ;;
+        *) return 1;;
+    esac
+""".format(codes=" ".join(str(int(code)) for code in exit_codes))
+    patterns = _retry_patterns(param)
+    if patterns:
+        checks += "    grep -qE {patterns} \"$_bg_err\" || return 1\n"\
+            .format(patterns=" ".join("-e " + shlex.quote(pattern)
+                                      for pattern in patterns))
+    if speculates(param):
+        # Killed by a speculative copy of the task.
+        checks += '    [ -d "$_bg_spec/$seq.won" ] && return 1\n'
+    return """\
+retry_max={retry_max}
+retry_backoff={retry_backoff}
+_bg_attempt=1
+
+_bg_retry() {{
+    [ $rc -ne 0 ] && [ $_bg_attempt -lt $retry_max ] || return 1
+{checks}\
+    _bg_delay=$(( retry_backoff * 2**(_bg_attempt-1) ))
+    echo "batchgen: task $batch_id.$seq failed with exit code $rc" \\
+        "(attempt $_bg_attempt/$retry_max), retry in $_bg_delay s." >&2
+    sleep $_bg_delay
+    _bg_attempt=$((_bg_attempt+1))
+}}
+""".format(retry_max=int(param["retry_max"]),
+           retry_backoff=int(param.get("retry_backoff", 10)),
+           checks=checks)
+
+
+def _chunks(param):
+    """ Check whether tasks are compound tasks (see chunk_size). """
+    return int(param.get("chunk_size", 1)) > 1
+
+
+def _failed_list(param):
+    """ Record the command of a task that failed after all attempts, or
+        only the failed commands of a compound task that ran to the end.
+    """
+    failed_file = '"$batch_subdir/${job_name}_${batch_id}' + FAILED_EXT + '"'
+    if not _chunks(param):
+        return """
+if [ $rc -ne 0 ]; then
+    _bg_append {failed_file} {command}
+fi
+""".format(failed_file=failed_file, command=_expanded_command(param))
+    return """
+if [ $rc -eq 1 ] && [ -s "$_BG_FAILED" ]; then
+    while IFS= read -r _bg_c; do
+        _bg_append {failed_file} {failed_command}
+    done < "$_BG_FAILED"
+elif [ $rc -ne 0 ]; then
+    _bg_append {failed_file} {command}
+fi
+rm -f "$_BG_FAILED"
+""".format(failed_file=failed_file, command=_expanded_command(param),
+           failed_command=_expanded_command(param, "_bg_c"))
+
+
+def _memo_start(param):
+    """ Take the memoization keys off the command, before it is run or
+        logged (see batchgen.memo).
+    """
+    return """\
+memo_dir={memo_dir}
+_bg_keys=()
+_bg_re={marker_re}
+while [[ $command =~ $_bg_re ]]; do
+    _bg_keys+=("${{BASH_REMATCH[1]}}")
+    command=${{command/"${{BASH_REMATCH[0]}}"/}}
+done
+
+""".format(memo_dir=shlex.quote(param["memo_dir"]),
+           marker_re=shlex.quote("{marker}([0-9a-f]{{{n}}})".format(
+               marker=MEMO_MARKER, n=KEY_LENGTH)))
+
+
+def _memo_store():
+    """ Copy the outputs of the successful commands into the cache, each
+        entry appears at once (rename), or not at all.
+    """
+    return """
+_bg_memo_store() {{
+    local entry="$memo_dir/$1" part="$memo_dir/$1.part.$$" outputs i
+    [ -d "$entry" ] && return 0
+    IFS=$'\t' read -r -a outputs < \
+        <(grep -m 1 "^$1" "$batch_dir/{memo_file}")
+    mkdir -p "$part" || return 1
+    for ((i=1; i<${{#outputs[@]}}; i++)); do
+        if ! cp -rp "${{outputs[i]}}" "$part/$((i-1))"; then
+            rm -rf "$part"
+            return 1
+        fi
+    done
+    mv -T "$part" "$entry" 2> /dev/null || rm -rf "$part"
+}}
+if [ $rc -eq 0 ]; then
+    for _bg_key in "${{_bg_keys[@]}}"; do
+        _bg_memo_store "$_bg_key"
+    done
+fi
+""".format(memo_file=MEMO_FILE)
+
+
+def _speculate_start():
+    """ Register the task for speculative re-execution (see speculate.sh).
+        A copy of the task is started with BATCHGEN_SPECULATIVE_COPY=1.
+    """
+    return """\
+_bg_copy=${BATCHGEN_SPECULATIVE_COPY:-0}
+# State of this run of the batch only (see speculate_command).
+_bg_spec="$batch_subdir/speculate_${batch_id}_${BATCHGEN_RUN_ID:-0}"
+if [ "$_bg_copy" = 0 ]; then
+    mkdir -p "$_bg_spec"
+    printf "%s" "$command" > "$_bg_spec/$seq.cmd"
+    echo $slot > "$_bg_spec/$seq.slot"
+    date +%s > "$_bg_spec/$seq.start"
+else
+    # The task already finished, or only the original writes the logs.
+    [ -d "$_bg_spec/$seq.won" ] && exit 0
+    _bg_append() { :; }
+fi
+
+_bg_spec_run() {
+    setsid "$@" &
+    echo $! > "$_bg_spec/$seq.pid.$_bg_copy"
+    wait $!
+}
+
+"""
+
+
+def _speculate_end(param):
+    """ The first copy of the task to finish wins, and stops the others.
+        The original task exits with the exit code of the winner, and logs
+        its output.
+    """
+    if not indexed_logs(param):
+        hand_over = ""
+        take_over = ""
+        clean_up = ""
+    else:
+        hand_over = """\
+    if [ "$_bg_copy" != 0 ]; then
+        mv "$_bg_out" "$_bg_spec/$seq.out"
+        mv "$_bg_err" "$_bg_spec/$seq.err"
+    fi
+"""
+        take_over = """\
+    if [ "$_bg_copy" = 0 ] && [ -f "$_bg_spec/$seq.out" ]; then
+        rm -f "$_bg_out" "$_bg_err"
+        _bg_out="$_bg_spec/$seq.out"
+        _bg_err="$_bg_spec/$seq.err"
+    fi
+"""
+        clean_up = 'rm -f "$_bg_out" "$_bg_err"\n    '
+    return """
+if mkdir "$_bg_spec/$seq.won" 2> /dev/null; then
+{hand_over}\
+    echo $rc > "$_bg_spec/$seq.rc.tmp"
+    mv "$_bg_spec/$seq.rc.tmp" "$_bg_spec/$seq.rc"
+    for _bg_pid_file in "$_bg_spec/$seq".pid.*; do
+        if [ "$_bg_pid_file" != "$_bg_spec/$seq.pid.$_bg_copy" ]; then
+            kill -- -"$(cat "$_bg_pid_file")" 2> /dev/null
+        fi
+    done
+else
+    while [ ! -f "$_bg_spec/$seq.rc" ]; do sleep 0.1; done
+    rc=$(cat "$_bg_spec/$seq.rc")
+{take_over}\
+fi
+if [ "$_bg_copy" != 0 ]; then
+    {clean_up}exit $rc
+fi
+echo $(( $(date +%s) - $(cat "$_bg_spec/$seq.start") )) > "$_bg_spec/$seq.end"
+""".format(hand_over=hand_over, take_over=take_over, clean_up=clean_up)
+
+
+def speculate_string(param):
+    """ Create the monitor that starts copies of long-tail tasks.
+
+    When all tasks of a batch have started and cores are idle, the tasks
+    that run longer than speculate_factor times the speculate_percentile
+    of the finished tasks are started again on the idle cores.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of parsed parameters.
+
+    Returns
+    -------
+    str:
+        Monitor script.
+    """
+    factor = int(100*float(param.get("speculate_factor", 1.5)))
+    monitor = """\
+#!/bin/bash
+# Speculative re-execution of long-tail tasks, generated by batchgen.
+# Usage: {speculate_file} BATCH_ID NUM_TASKS NUM_SIMUL
+
+batch_dir={batch_dir}
+batch_id=$1
+num_tasks=$2
+num_simul=$3
+{batch_subdir}
+spec="$batch_subdir/speculate_${{batch_id}}_${{BATCHGEN_RUN_ID:-0}}"
+launcher=({launcher})
+
+# Stop when the batch script (parent) is gone.
+while sleep {interval} && kill -0 $PPID 2> /dev/null; do
+    [ -d "$spec" ] || continue
+    runtimes=($(cat "$spec"/*.end 2> /dev/null | sort -n))
+    n_done=${{#runtimes[@]}}
+    n_started=$(find "$spec" -name "*.start" | wc -l)
+    [ "$n_done" -ge "$num_tasks" ] && break
+    # Only when all tasks have started.
+    if [ "$n_started" -lt "$num_tasks" ] || [ "$n_done" -eq 0 ]; then
+        continue
+    fi
+    # Job slots of the running tasks and their copies (TASK.copy).
+    running=()
+    busy=()
+    for start_file in $(ls -tr "$spec"/*.start); do
+        task=${{start_file%.start}}
+        [ -f "$task.end" ] && continue
+        busy[$(cat "$task.slot")]=1
+        if [ -f "$task.copy" ]; then
+            busy[$(cat "$task.copy")]=1
+        else
+            running+=("$task")
+        fi
+    done
+    idle=()
+    for ((slot=1; slot<=num_simul; slot++)); do
+        [ -n "${{busy[slot]}}" ] || idle+=($slot)
+    done
+    rank=$(( (n_done*{percentile} + 99) / 100 ))
+    [ $rank -lt 1 ] && rank=1
+    threshold=$(( ${{runtimes[rank-1]}} * {factor} / 100 ))
+    now=$(date +%s)
+    for task in "${{running[@]}}"; do
+        [ ${{#idle[@]}} -gt 0 ] || break
+        if [ $(( now - $(cat "$task.start") )) -gt $threshold ]; then
+            # The copy takes the slot (and the bound cores) of a finished
+            # task.
+            echo ${{idle[0]}} > "$task.copy"
+            BATCHGEN_SPECULATIVE_COPY=1 "${{launcher[@]}}" \\
+                "$batch_dir/{wrapper_file}" "$batch_id" "${{task##*/}}" \\
+                ${{idle[0]}} "$(cat "$task.cmd")" &
+            idle=("${{idle[@]:1}}")
+        fi
+    done
+done
+wait
+""".format(speculate_file=SPECULATE_FILE, wrapper_file=WRAPPER_FILE,
+           batch_dir=shlex.quote(param["batch_dir"]),
+           batch_subdir=_subdir_line(param),
+           launcher=param.get("speculate_launcher", ""),
+           interval=int(param.get("speculate_interval", 10)),
+           percentile=int(param.get("speculate_percentile", 90)),
+           factor=factor)
+    return monitor
+
+
+def speculate_command(param, batch_id, num_tasks, num_simul):
+    """ Lines in the batch script that start the monitor. The state of the
+        tasks is kept per run (BATCHGEN_RUN_ID), so that a batch that is
+        submitted again doesn't see the tasks of an earlier run.
+    """
+    speculate_file = os.path.join(param["batch_dir"], SPECULATE_FILE)
+    return ("export BATCHGEN_RUN_ID=${{SLURM_JOB_ID:-$(date +%s%N)}}\n"
+            "{monitor} {batch_id} {num_tasks} {num_simul} &\n").format(
+        monitor=shlex.quote(speculate_file), batch_id=batch_id,
+        num_tasks=num_tasks, num_simul=num_simul)
+
+
+def _joblog(param):
+    """ Record start time, runtime, exit code and peak memory. Compacted
+        commands are recorded with their prefix expanded.
+    """
+    return """
+_bg_ms=$(( (_bg_end - _bg_start) / 1000000 ))
+_bg_line=$(printf "%s\\t%s\\t%d.%03d\\t%s\\t%s\\t%s" "$seq" \\
+    $(( _bg_start / 1000000000 )) $(( _bg_ms / 1000 )) $(( _bg_ms % 1000 )) \\
+    "$rc" "$maxrss" {command})
+_bg_append "$batch_subdir/${{job_name}}_${{batch_id}}.joblog" "$_bg_line"
+""".format(command=_expanded_command(param))
+
+
+def _expanded_command(param, variable="command"):
+    """ The command of the task, with the prefix of compacted commands. """
+    if param.get("compact_prefix"):
+        return '"${{{variable}//{function} /$_BG_PREFIX }}"'.format(
+            variable=variable, function=PREFIX_FUNCTION)
+    return '"${variable}"'.format(variable=variable)
+
+
+def _progress_start():
+    """ Compact progress record (one log per node):
+        S BATCH_ID SEQ TIME JOB_ID (- outside of SLURM).
+    """
+    return """\
+_bg_progress="$batch_dir/{progress_dir}/$HOSTNAME.log"
+_bg_append "$_bg_progress" "S $batch_id $seq $(date +%s) ${{SLURM_JOB_ID:--}}"
+""".format(progress_dir=PROGRESS_DIR)
+
+
+def _progress_end():
+    """ Compact progress record: E BATCH_ID SEQ TIME EXIT_CODE """
+    return """\
+_bg_append "$_bg_progress" "E $batch_id $seq $(date +%s) $rc"
+"""
+
+
+def _indexed_log():
+    """ Append the tagged output of the task as a separate gzip member to
+        the compressed log of the node, and record its position in the
+        index: BATCH_ID.SEQ OFFSET LENGTH
+    """
+    return """
+_bg_log="$batch_dir/{log_dir}/$HOSTNAME"
+(
+    flock -x 9
+    _bg_offset=$(stat -c %s "$_bg_log.log.gz" 2> /dev/null || echo 0)
+    {{ sed 's/^/out| /' "$_bg_out"; sed 's/^/err| /' "$_bg_err"; }} | \\
+        gzip >> "$_bg_log.log.gz"
+    _bg_size=$(stat -c %s "$_bg_log.log.gz")
+    printf "%s.%s %s %s\\n" "$batch_id" "$seq" "$_bg_offset" \\
+        $(( _bg_size - _bg_offset )) >> "$_bg_log.idx"
+) 9>> "$_bg_log.lock"
+rm -f "$_bg_out" "$_bg_err"
+""".format(log_dir=LOG_DIR)
+
+
+def task_wrapper_string(param):
+    """ Create the contents of the task wrapper script.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of parsed parameters.
+
+    Returns
+    -------
+    str:
+        Wrapper script.
+    """
+    wrapper = _header(param)
+    if memoizes(param):
+        wrapper += _memo_start(param)
+    if _binds_cores(param):
+        wrapper += _bind_cores(param)
+    if speculates(param):
+        wrapper += _speculate_start()
+    if _is_true(param.get("progress", False)):
+        wrapper += _progress_start()
+    wrapper += _run_task(param)
+    if speculates(param):
+        wrapper += _speculate_end(param)
+    if memoizes(param):
+        wrapper += _memo_store()
+    if retries(param):
+        wrapper += _failed_list(param)
+    if _is_true(param.get("joblog", False)):
+        wrapper += _joblog(param)
+    if indexed_logs(param):
+        wrapper += _indexed_log()
+    if _is_true(param.get("progress", False)):
+        wrapper += _progress_end()
+    wrapper += "\nexit $rc\n"
+    return wrapper
+
+
+def wrapper_command(param):
+    """ Command given to GNU Parallel to run tasks through the wrapper. """
+    wrapper_file = os.path.join(param["batch_dir"], WRAPPER_FILE)
+    return shlex.quote(wrapper_file) + " ${batch_id} {#} {%} {}"
@@ -0,0 +1,293 @@
+"""
+Backfill-aware shaping of SLURM batches: batches are made shorter and/or
+narrower, so that they fit in the holes the scheduler can fill right away.
+
+The holes follow from the idle nodes (sinfo) and the nodes that pending
+jobs will take at their expected start (squeue --start). These are read
+from the cluster itself, or from a snapshot file:
+
+    ## SINFO ##
+    node001 idle
+    node002 allocated
+    ## SQUEUE_START ##
+    2026-10-19T14:30:00 2
+    N/A 1
+    ## NOW ##
+    2026-10-19T14:00:00
+
+The SINFO section is the output of sinfo -h -N -o "%N %T", the
+SQUEUE_START section of squeue -h --start -t PD -o "%S %D". The NOW
+section (time of the snapshot) is optional, the modification time of the
+file is used otherwise.
+
+@author: Raoul Schram
+"""
+
+import os
+import re
+import time
+import subprocess
+
+from batchgen.util import _is_true, time_to_seconds, seconds_to_time
+
+
+SINFO_COMMAND = ["sinfo", "-h", "-N", "-o", "%N %T"]
+SQUEUE_COMMAND = ["squeue", "-h", "--start", "-t", "PD", "-o", "%S %D"]
+
+
+def _parse_time(value):
+    """ Epoch of a SLURM time stamp, None if unknown (e.g. N/A). """
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def parse_snapshot(sinfo_lines, squeue_lines, now):
+    """ Idle nodes and expected starts of pending jobs.
+
+    Arguments
+    ---------
+    sinfo_lines: list
+        Lines "NODE STATE" (sinfo -h -N -o "%N %T").
+    squeue_lines: list
+        Lines "START NUM_NODES" (squeue -h --start -t PD -o "%S %D").
+    now: float
+        Epoch of the snapshot.
+
+    Returns
+    -------
+    int:
+        Number of idle nodes.
+    list:
+        (seconds from now, number of nodes) of the pending jobs with a
+        known start time.
+    """
+    idle_nodes = set()
+    for line in sinfo_lines:
+        parts = line.split()
+        # Flags like * (not responding) or ~ (powered off) are not idle.
+        if len(parts) >= 2 and parts[1].lower() == "idle":
+            idle_nodes.add(parts[0])
+    starts = []
+    for line in squeue_lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        start = _parse_time(parts[0])
+        if start is not None:
+            starts.append((max(0, start-now), int(parts[1])))
+    return len(idle_nodes), sorted(starts)
+
+
+def read_snapshot(snapshot_file):
+    """ Read a recorded snapshot (see the module description).
+
+    Returns
+    -------
+    int:
+        Number of idle nodes.
+    list:
+        (seconds from now, number of nodes) of pending jobs.
+    """
+    sections = {"SINFO": [], "SQUEUE_START": [], "NOW": []}
+    cur_section = None
+    with open(snapshot_file, "r") as f:
+        for line in f:
+            match = re.match(r"## (\w+) ##", line)
+            if match:
+                cur_section = match.group(1)
+            elif cur_section in sections and line.strip():
+                sections[cur_section].append(line.strip())
+    now = None
+    if sections["NOW"]:
+        now = _parse_time(sections["NOW"][0])
+    if now is None:
+        now = os.path.getmtime(snapshot_file)
+    return parse_snapshot(sections["SINFO"], sections["SQUEUE_START"], now)
+
+
+def probe_cluster(partition=None):
+    """ Take a snapshot of the cluster with sinfo and squeue, None if they
+        can't be run.
+    """
+    extra = [] if partition is None else ["-p", partition]
+    output = []
+    for command in [SINFO_COMMAND, SQUEUE_COMMAND]:
+        try:
+            res = subprocess.run(command + extra, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if res.returncode:
+            return None
+        output.append(res.stdout.decode("utf-8").splitlines())
+    return parse_snapshot(output[0], output[1], time.time())
+
+
+def hole_length(idle, events, width):
+    """ How long width nodes are free, starting now.
+
+    Arguments
+    ---------
+    idle: int
+        Number of idle nodes now.
+    events: list
+        (seconds from now, change in the number of free nodes).
+    width: int
+        Number of nodes.
+
+    Returns
+    -------
+    float:
+        Length of the hole [s], 0 if there are not enough free nodes now,
+        None if the nodes stay free.
+    """
+    free = idle
+    for start, change in sorted(events):
+        if start > 0 and free < width:
+            return 0
+        free += change
+        if free < width:
+            return start
+    return None if free >= width else 0
+
+
+def backfill_shapes(num_tasks, task_time, num_simul, max_nodes, max_wall,
+                    idle, starts):
+    """ Shapes of batches that can start right away in backfill holes.
+
+    Greedily, the shape (number of nodes, wall time) that runs the most
+    tasks in the current holes is chosen, until no hole can run a full
+    round of tasks.
+
+    Arguments
+    ---------
+    num_tasks: int
+        Number of tasks.
+    task_time: float
+        Estimated time [s] of one task (with a safety margin).
+    num_simul: int
+        Number of tasks running at the same time on a node.
+    max_nodes: int
+        Maximum number of nodes per batch.
+    max_wall: float
+        Maximum wall time [s] (clock_wall_time).
+    idle: int
+        Number of idle nodes.
+    starts: list
+        (seconds from now, number of nodes) of the pending jobs.
+
+    Returns
+    -------
+    list:
+        (number of tasks, number of nodes, wall time [s]) per batch, the
+        tasks that don't fit are not included.
+    """
+    events = [(start, -num_nodes) for start, num_nodes in starts]
+    shapes = []
+    while num_tasks > 0:
+        best = None
+        for width in range(1, max_nodes+1):
+            length = hole_length(idle, events, width)
+            if length is None or length > max_wall:
+                length = max_wall
+            # Wall times in whole minutes.
+            num_rounds = int((length // 60)*60 // task_time)
+            if num_rounds < 1:
+                continue
+            batch_tasks = min(num_tasks, width*num_simul*num_rounds)
+            if best is None or batch_tasks > best[0]:
+                best = (batch_tasks, width)
+        if best is None:
+            break
+        batch_tasks, width = best
+        num_rounds = -(-batch_tasks // (width*num_simul))
+        # Narrower, if the tasks fit on fewer nodes.
+        width = -(-batch_tasks // (num_simul*num_rounds))
+        wall_time = min(max_wall, max(60, 60*int(-(-num_rounds*task_time
+                                                    // 60))))
+        shapes.append((batch_tasks, width, wall_time))
+        num_tasks -= batch_tasks
+        # The batch takes the nodes until its wall time.
+        events += [(0, -width), (wall_time, width)]
+    return shapes
+
+
+def backfill_shape(param):
+    """ Shape the batches for the backfill holes (option backfill).
+
+    Sets batch_layout: (number of tasks, nodes, wall time [s], tasks per
+    node) of every batch. The tasks that don't fit in the holes get the
+    normal shape.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of (parsed) parameters, is updated.
+    """
+    if not _is_true(param.get("backfill", False)):
+        return
+    if "task_time" not in param:
+        print("Warning: backfill shaping needs task_time (or history), "
+              "the batches are not shaped.")
+        return
+    if "backfill_snapshot" in param:
+        snapshot = read_snapshot(param["backfill_snapshot"])
+    else:
+        snapshot = probe_cluster(param.get("backfill_partition", None))
+    if snapshot is None:
+        print("Warning: could not read the backfill window (sinfo/squeue), "
+              "the batches are not shaped.")
+        return
+    idle, starts = snapshot
+    margin = float(param.get("history_margin", 1.5))
+    task_time = max(float(param["task_time"])*param["chunk_size"]*margin,
+                    1e-3)
+    ncs = param["num_cores_simul"]
+    num_tasks = len(param["script_lines"])
+    shapes = backfill_shapes(num_tasks, task_time, ncs,
+                             param["nodes_per_job"],
+                             time_to_seconds(param["clock_wall_time"]),
+                             idle, starts)
+    layout = [(batch_tasks, width, seconds_to_time(wall_time),
+               -(-batch_tasks // width))
+              for batch_tasks, width, wall_time in shapes]
+    # The remaining tasks get the normal shape.
+    remaining = num_tasks - sum(shape[0] for shape in shapes)
+    layout += regular_layout(remaining, param["num_tasks_per_node"],
+                             param["nodes_per_job"], param["clock_wall_time"])
+    param["batch_layout"] = layout
+    param["backfill_shapes"] = _summarize(layout)
+
+
+def regular_layout(num_tasks, tasks_per_node, nodes_per_job, wall_time):
+    """ Batches with the normal shape: full nodes, nodes_per_job nodes.
+
+    Returns
+    -------
+    list:
+        (number of tasks, nodes, wall time, tasks per node) of every batch.
+    """
+    tasks_per_batch = tasks_per_node*nodes_per_job
+    layout = []
+    for i in range(0, num_tasks, tasks_per_batch):
+        batch_tasks = min(tasks_per_batch, num_tasks-i)
+        layout.append((batch_tasks, -(-batch_tasks // tasks_per_node),
+                       wall_time, tasks_per_node))
+    return layout
+
+
+def _summarize(layout):
+    """ Shapes with their number of batches and tasks, e.g.
+        "3x 2N 00:45:00 480 tasks".
+    """
+    counts = {}
+    for batch_tasks, width, wall_time, _ in layout:
+        key = (time_to_seconds(wall_time), width, wall_time)
+        num_batches, num_tasks = counts.get(key, (0, 0))
+        counts[key] = (num_batches+1, num_tasks+batch_tasks)
+    return ["{n}x {width}N {wall} {tasks} tasks".format(
+        n=num_batches, width=width, wall=wall_time, tasks=num_tasks)
+        for (_, width, wall_time), (num_batches, num_tasks)
+        in sorted(counts.items())]
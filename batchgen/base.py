@@ -6,17 +6,19 @@ See __main__ for the Command Line Interface (CLI)
 """
 
 import os
-try:
-    import configparser as cp
-except ImportError as e:
-    import ConfigParser as cp
-
 import re
+import subprocess
+import configparser as cp
 
 from batchgen.backend.parallel import Parallel
 from batchgen.backend.slurm_lisa import SlurmLisa
-from batchgen.ssh import send_batch_ssh
-from batchgen.util import _read_file, _check_files, batch_dir
+from batchgen.backend.local import Local
+from batchgen.ssh import send_batch_ssh, ship_batch_ssh, remote_mode,\
+    remote_root, remote_batch_dir, REMOTE_ROOT
+from batchgen.node_cache import node_cache_string
+from batchgen.federation import federate, target_names
+from batchgen.util import _read_file, _check_files, batch_dir,\
+    read_manifest
 
 
 def _params(config=None, extra_config={}):
@@ -42,7 +44,7 @@ def _params(config=None, extra_config={}):
     return parameters
 
 
-def _replace_rel_abs_path(config, config_file):
+def _replace_rel_abs_path(config, config_file, root_dir=None):
     """ Variables in the config file ending with dir|file
         are replaced with an absolute file path.
 
@@ -52,9 +54,15 @@ def _replace_rel_abs_path(config, config_file):
         Configuration read from a .ini file.
     config_file: str
         Path to the configuration file (can be relative).
+    root_dir: str
+        Directory relative paths start from, instead of the directory of
+        the configuration file.
     """
-    config_dir = os.path.dirname(config_file)
-    config_dir_abs = os.path.abspath(config_dir)
+    if root_dir is None:
+        config_dir = os.path.dirname(config_file)
+        config_dir_abs = os.path.abspath(config_dir)
+    else:
+        config_dir_abs = root_dir
 
     for key in config.options("BATCH_OPTIONS"):
         dir_file = config.get("BATCH_OPTIONS", key)
@@ -120,8 +128,8 @@ def batch_from_files(command_file, config_file, pre_post_file=None,
         pre_string = _read_file(pre_com_file)
         post_string = _read_file(post_com_file)
 
-    batch_from_strings(command_string, config_file, pre_string,
-                       post_string, force_clear)
+    return batch_from_strings(command_string, config_file, pre_string,
+                              post_string, force_clear)
 
 
 def batch_from_strings(command_string, config_file, pre_com_string="",
@@ -146,10 +154,57 @@ def batch_from_strings(command_string, config_file, pre_com_string="",
     config.optionxform = str
     config.read(config_file)
 
+    if target_names(config):
+        def send_batch(target_commands, target_config):
+            return _batch_from_config(target_commands, target_config,
+                                      config_file, pre_com_string,
+                                      post_com_string, force_clear,
+                                      extra_config)
+        return federate(command_string, config, send_batch)
+    return _batch_from_config(command_string, config, config_file,
+                              pre_com_string, post_com_string, force_clear,
+                              extra_config)
+
+
+def _batch_from_config(command_string, config, config_file, pre_com_string="",
+                       post_com_string="", force_clear=False, extra_config={}):
+    """ Write batch scripts (or send them to a remote server) for a
+        configuration that has been read already.
+    """
     if config.has_section("CONNECTION"):
-        send_batch_ssh(command_string, config, force_clear)
-        return 0
+        if remote_mode(config) == "ship":
+            return _ship_batch(command_string, config, config_file,
+                               pre_com_string, post_com_string, force_clear,
+                               extra_config)
+        return send_batch_ssh(command_string, config, force_clear)
+
+    backend, param = _local_params(config, config_file, pre_com_string,
+                                   post_com_string, extra_config)
+
+    # If no output directory is given, create batch.${back-end}/${job_name}/.
+    output_dir = batch_dir(backend, param["job_name"])
+
+    batch = _backend(backend, config_file)
+    if batch is None:
+        return 1
+
+    if batch.write_batch(command_string, param, output_dir,
+                         force_clear) is None:
+        return 1
+    return 0
 
+
+def _local_params(config, config_file, pre_com_string="", post_com_string="",
+                  extra_config={}):
+    """ Parameters for generating the batch on this machine.
+
+    Returns
+    -------
+    str:
+        Backend.
+    dict:
+        Dictionary of all parameters.
+    """
     _replace_rel_abs_path(config, config_file)
 
     backend = config.get("BACKEND", "backend")
@@ -163,19 +218,107 @@ def batch_from_strings(command_string, config_file, pre_com_string="",
 
     # Get all the commands either from file, or from lists:
 
-    param["pre_com_string"] = pre_com_string
+    param["pre_com_string"] = node_cache_string(param) + pre_com_string
     param["post_com_string"] = post_com_string
+    return backend, param
 
-    # If no output directory is given, create batch.${back-end}/${job_name}/.
+
+def append_from_strings(command_string, config_file, submit=False):
+    """ Add batches with new commands to the existing batches of a job
+        (or create them, if there are none yet).
+
+    Arguments
+    ---------
+    command_string: str
+        New commands, one per line.
+    config_file: str
+        Configuration file of the job.
+    submit: bool
+        Submit the new batches.
+
+    Returns
+    -------
+    int:
+        Zero if successful.
+    """
+    config = cp.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    if config.has_section("CONNECTION") or target_names(config):
+        print("Error: batches can only be appended on this machine.")
+        return 1
+
+    backend, param = _local_params(config, config_file)
     output_dir = batch_dir(backend, param["job_name"])
+    batch = _backend(backend, config_file)
+    if batch is None:
+        return 1
+    # The first batches of the job are generated normally.
+    append = read_manifest(output_dir) is not None
+    my_exec = batch.write_batch(command_string, param, output_dir,
+                                print_exec=False, append=append)
+    if my_exec is None:
+        return 1
+    if submit:
+        return subprocess.run(["bash", "-c", my_exec]).returncode
+    print(my_exec)
+    return 0
 
+
+def _backend(backend, config_file):
+    """ Batch writer for a backend, None if it doesn't exist. """
     if backend == "slurm_lisa":
-        batch = SlurmLisa()
+        return SlurmLisa()
     elif backend == "parallel":
-        batch = Parallel()
-    else:
-        print("Error: no valid backend detected, supplied in file {cfg_file}".
-              format(cfg_file=config_file))
+        return Parallel()
+    elif backend == "local":
+        return Local()
+    print("Error: no valid backend detected, supplied in file {cfg_file}".
+          format(cfg_file=config_file))
+    return None
+
+
+def _ship_batch(command_string, config, config_file, pre_com_string="",
+                post_com_string="", force_clear=False, extra_config={}):
+    """ Generate the batch locally for a remote server, and ship it there
+        (remote_mode = ship).
+
+    Paths are written as they will be on the remote server: relative paths
+    start from remote_dir.
+    """
+    backend = config.get("BACKEND", "backend")
+    batch = _backend(backend, config_file)
+    if batch is None:
         return 1
 
-    batch.write_batch(command_string, param, output_dir, force_clear)
+    # The pre/post commands and the node setup file are read locally.
+    if config.has_option("BATCH_OPTIONS", "pre_post_file"):
+        pre_post_file = config.get("BATCH_OPTIONS", "pre_post_file")
+        pre_com_string, post_com_string = _read_pre_post_file(pre_post_file)
+    setup_file = None
+    if config.has_option("BATCH_OPTIONS", "setup_file"):
+        setup_file = config.get("BATCH_OPTIONS", "setup_file")
+
+    root_dir = remote_root(config)
+    _replace_rel_abs_path(config, config_file, root_dir=root_dir)
+    param = _params(config, extra_config)
+    param["base_dir"] = root_dir
+    if setup_file is not None:
+        param["setup_file"] = setup_file
+
+    param["pre_com_string"] = node_cache_string(
+        param, remote_root=root_dir) + pre_com_string
+    param["post_com_string"] = post_com_string
+
+    output_dir = os.path.join(root_dir, remote_batch_dir(backend,
+                                                         param["job_name"]))
+    write_dir = batch_dir(backend, param["job_name"], remote=True)
+    exec_line = batch.write_batch(command_string, param, output_dir,
+                                  force_clear, write_dir=write_dir,
+                                  print_exec=False)
+    if exec_line is None:
+        return 1
+    # Submission command as seen from the home directory on the server.
+    remote_dir = config.get("CONNECTION", "remote_dir")
+    batch._print_execution(exec_line.replace(REMOTE_ROOT, remote_dir))
+    return ship_batch_ssh(config, write_dir, exec_line, force_clear)
@@ -0,0 +1,691 @@
+"""
+Local stand-in for SLURM (sbatch, squeue, sacct, scontrol, sacctmgr), to
+run generated batch scripts end to end on a single machine.
+
+Submitted scripts are run through a bounded pool of job slots. The most
+relevant #SBATCH options are honored (job name, output/error files with
+their filename patterns, open mode, arrays, dependencies, time limit and
+warning signal), and the usual SLURM environment variables are set. The
+requested nodes and cores are only recorded for the accounting (sacct).
+Limits on the number of queued jobs (MaxSubmitJobs) and the array size
+(MaxArraySize) are taken from the environment
+(BATCHGEN_FAKE_SLURM_MAX_SUBMIT/_MAX_ARRAY). The state of all jobs is
+kept in a directory (BATCHGEN_FAKE_SLURM), see install_shims.
+
+    python -m batchgen.fakeslurm COMMAND [options]
+
+@author: Raoul Schram
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import fcntl
+import signal
+import socket
+import getpass
+import resource
+import subprocess
+
+from multiprocessing import cpu_count
+
+
+STATE_ENV = "BATCHGEN_FAKE_SLURM"
+SLOTS_ENV = "BATCHGEN_FAKE_SLURM_SLOTS"
+MAX_SUBMIT_ENV = "BATCHGEN_FAKE_SLURM_MAX_SUBMIT"
+MAX_ARRAY_ENV = "BATCHGEN_FAKE_SLURM_MAX_ARRAY"
+DEFAULT_MAX_ARRAY_SIZE = 1001
+POLL_INTERVAL = 0.05
+
+# Options that take a value: option -> key.
+VALUE_OPTIONS = {
+    "-J": "job_name", "--job-name": "job_name",
+    "-o": "output", "--output": "output",
+    "-e": "error", "--error": "error",
+    "-a": "array", "--array": "array",
+    "-d": "dependency", "--dependency": "dependency",
+    "-t": "time", "--time": "time",
+    "-D": "chdir", "--chdir": "chdir",
+    "--open-mode": "open_mode",
+    "--signal": "signal",
+    "-N": "nodes", "--nodes": "nodes",
+    "--tasks-per-node": "tasks_per_node",
+    "--ntasks-per-node": "tasks_per_node",
+    "-c": "cpus_per_task", "--cpus-per-task": "cpus_per_task",
+}
+FLAG_OPTIONS = {"--parsable": "parsable"}
+FINAL_STATES = ("COMPLETED", "FAILED", "CANCELLED", "TIMEOUT")
+
+
+def install_shims(bin_dir, state_dir, num_slots=None):
+    """ Write sbatch, squeue, sacct, scontrol and sacctmgr commands that
+        use this module.
+
+    Arguments
+    ---------
+    bin_dir: str
+        Directory for the commands (put it in front of PATH).
+    state_dir: str
+        Directory for the state of the jobs.
+    num_slots: int
+        Maximum number of jobs that run at the same time (default: number
+        of cores).
+    """
+    if num_slots is None:
+        num_slots = cpu_count()
+    for directory in [bin_dir, state_dir]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for command in COMMANDS:
+        shim_file = os.path.join(bin_dir, command)
+        with open(shim_file, "w") as f:
+            f.write("""\
+#!/bin/sh
+export {state_env}=${{{state_env}:-{state_dir}}}
+export {slots_env}=${{{slots_env}:-{num_slots}}}
+export PYTHONPATH={package_dir}${{PYTHONPATH:+:$PYTHONPATH}}
+exec {python} -m batchgen.fakeslurm {command} "$@"
+""".format(state_env=STATE_ENV, slots_env=SLOTS_ENV,
+                state_dir=shlex.quote(os.path.abspath(state_dir)),
+                num_slots=int(num_slots),
+                package_dir=shlex.quote(package_dir),
+                python=shlex.quote(sys.executable), command=command))
+        os.chmod(shim_file, 0o755)
+
+
+def _state_dir():
+    state_dir = os.environ.get(STATE_ENV, None)
+    if state_dir is None:
+        raise ValueError("Error: {env} is not set.".format(env=STATE_ENV))
+    return state_dir
+
+
+def _job_file(state_dir, job_id):
+    return os.path.join(state_dir, "jobs", job_id + ".json")
+
+
+def _read_job(state_dir, job_id):
+    with open(_job_file(state_dir, job_id), "r") as f:
+        return json.load(f)
+
+
+def _write_job(state_dir, job):
+    job_file = _job_file(state_dir, job["job_id"])
+    with open(job_file + ".tmp", "w") as f:
+        json.dump(job, f)
+    os.rename(job_file + ".tmp", job_file)
+
+
+def _all_jobs(state_dir):
+    job_dir = os.path.join(state_dir, "jobs")
+    if not os.path.isdir(job_dir):
+        return []
+    jobs = []
+    for name in os.listdir(job_dir):
+        if name.endswith(".json"):
+            try:
+                jobs.append(_read_job(state_dir, name[:-5]))
+            except (IOError, OSError, ValueError):
+                pass
+    return sorted(jobs, key=lambda job: (job["master_id"],
+                                         job["array_index"] or 0))
+
+
+def _next_job_id(state_dir):
+    """ New job id, unique between concurrent sbatch calls. """
+    counter_file = os.path.join(state_dir, "last_job_id")
+    with open(counter_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(counter_file, "r") as f:
+                job_id = int(f.read()) + 1
+        except (IOError, OSError, ValueError):
+            job_id = 1000
+        with open(counter_file, "w") as f:
+            f.write(str(job_id))
+    return job_id
+
+
+def parse_sbatch_options(args):
+    """ Parse sbatch options (either from the command line or #SBATCH).
+
+    Returns
+    -------
+    dict:
+        Options (key -> value).
+    list:
+        Remaining arguments (script and its arguments).
+    """
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if not arg.startswith("-"):
+            break
+        if arg.startswith("--"):
+            name, has_value, value = arg.partition("=")
+        elif len(arg) > 2:
+            name, has_value, value = arg[:2], True, arg[2:]
+        else:
+            name, has_value, value = arg, False, None
+        if name in FLAG_OPTIONS:
+            options[FLAG_OPTIONS[name]] = True
+        elif not has_value and (name in VALUE_OPTIONS or
+                                not name.startswith("--")):
+            # Option with the value in the next argument.
+            i += 1
+            value = args[i] if i < len(args) else ""
+        if name in VALUE_OPTIONS:
+            options[VALUE_OPTIONS[name]] = value
+        i += 1
+    return options, args[i:]
+
+
+def script_options(script):
+    """ Options from the #SBATCH lines at the start of a script. """
+    args = []
+    for line in script.split("\n")[1:]:
+        line = line.strip()
+        if line.startswith("#SBATCH"):
+            args.extend(shlex.split(line[len("#SBATCH"):], comments=True))
+        elif line and not line.startswith("#"):
+            break
+    return parse_sbatch_options(args)[0]
+
+
+def parse_array(array):
+    """ Indices of an array specification, e.g. 0-9:2,12%4. """
+    indices = []
+    for part in array.split("%")[0].split(","):
+        if not part:
+            continue
+        step = 1
+        if ":" in part:
+            part, step = part.split(":")
+            step = int(step)
+        if "-" in part:
+            first, last = part.split("-")
+            indices.extend(range(int(first), int(last)+1, step))
+        else:
+            indices.append(int(part))
+    return indices
+
+
+def time_limit(value):
+    """ SLURM time limit (minutes, mm:ss, hh:mm:ss, d-hh[:mm[:ss]]) in
+        seconds, None for no limit.
+    """
+    if value is None or value in ("", "UNLIMITED", "infinite"):
+        return None
+    if "-" in value:
+        days, value = value.split("-", 1)
+        parts = [int(part) for part in value.split(":")]
+        parts += [0]*(3-len(parts))
+        return ((int(days)*24 + parts[0])*60 + parts[1])*60 + parts[2]
+    parts = [int(part) for part in value.split(":")]
+    if len(parts) == 1:
+        return 60*parts[0]
+    if len(parts) == 2:
+        return 60*parts[0] + parts[1]
+    return (parts[0]*60 + parts[1])*60 + parts[2]
+
+
+def parse_signal(value):
+    """ SLURM warning signal [B:]SIG[@TIME].
+
+    Returns
+    -------
+    int:
+        Signal number.
+    int:
+        Seconds before the time limit (default 60).
+    bool:
+        Only signal the batch shell (B:), not all processes of the job.
+    """
+    batch_only = value.startswith("B:")
+    if batch_only:
+        value = value[2:]
+    name, _, seconds = value.partition("@")
+    if name.isdigit():
+        signum = int(name)
+    else:
+        name = name.upper()
+        signum = getattr(signal, name if name.startswith("SIG") else
+                         "SIG" + name)
+    return int(signum), int(seconds or 60), batch_only
+
+
+def filename_pattern(pattern, job):
+    """ Fill in a SLURM filename pattern (%j, %x, %A, %a, %N, %u). """
+    replacements = {
+        "j": job["slurm_id"],
+        "x": job["job_name"],
+        "A": str(job["master_id"]),
+        "a": str(job["array_index"]),
+        "N": socket.gethostname(),
+        "u": getpass.getuser(),
+        "%": "%",
+    }
+    result = ""
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == "%" and i+1 < len(pattern) and \
+                pattern[i+1] in replacements:
+            result += replacements[pattern[i+1]]
+            i += 2
+        else:
+            result += pattern[i]
+            i += 1
+    if not os.path.isabs(result):
+        result = os.path.join(job["work_dir"], result)
+    return result
+
+
+def sbatch(args):
+    """ Submit a batch script. """
+    state_dir = _state_dir()
+    for sub_dir in ["jobs", "scripts", "slots"]:
+        if not os.path.isdir(os.path.join(state_dir, sub_dir)):
+            os.makedirs(os.path.join(state_dir, sub_dir))
+    cmd_options, script_args = parse_sbatch_options(args)
+    if not script_args:
+        print("sbatch: error: no batch script given.", file=sys.stderr)
+        return 1
+    with open(script_args[0], "r") as f:
+        script = f.read()
+    # Command line options take precedence over #SBATCH lines.
+    options = script_options(script)
+    options.update(cmd_options)
+
+    master_id = _next_job_id(state_dir)
+    script_file = os.path.join(state_dir, "scripts",
+                               "{id}.sh".format(id=master_id))
+    with open(script_file, "w") as f:
+        f.write(script)
+    if "array" in options:
+        indices = parse_array(options["array"])
+    else:
+        indices = [None]
+    error = _check_limits(state_dir, indices)
+    if error is not None:
+        print("sbatch: error: Batch job submission failed: " + error,
+              file=sys.stderr)
+        return 1
+
+    job_name = options.get("job_name", os.path.basename(script_args[0]))
+    # A range of nodes (min-max) gets the minimum.
+    num_nodes = int(options.get("nodes", "1").split("-")[0])
+    alloc_cpus = num_nodes*int(options.get("tasks_per_node", 1))*int(
+        options.get("cpus_per_task", 1))
+    for i, index in enumerate(indices):
+        # Every array task has its own (numeric) SLURM job id.
+        slurm_id = master_id if i == 0 else _next_job_id(state_dir)
+        if index is None:
+            job_id = str(master_id)
+            default_output = "slurm-%j.out"
+        else:
+            job_id = "{id}_{index}".format(id=master_id, index=index)
+            default_output = "slurm-%A_%a.out"
+        job = {
+            "job_id": job_id, "master_id": master_id,
+            "slurm_id": str(slurm_id),
+            "array_index": index, "job_name": job_name,
+            "script": script_file, "args": script_args[1:],
+            "work_dir": os.path.abspath(options.get("chdir", os.getcwd())),
+            "output": options.get("output", default_output),
+            "error": options.get("error", None),
+            "open_mode": options.get("open_mode", "truncate"),
+            "dependency": options.get("dependency", ""),
+            "time_limit": time_limit(options.get("time", None)),
+            "signal": options.get("signal", None),
+            "num_nodes": num_nodes, "alloc_cpus": alloc_cpus,
+            "total_cpu": None,
+            "array_size": len(indices),
+            "state": "PENDING", "exit_code": None,
+            "submit": time.time(), "start": None, "end": None,
+        }
+        _write_job(state_dir, job)
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([sys.executable, "-m", "batchgen.fakeslurm",
+                              "_run", job_id], stdin=devnull, stdout=devnull,
+                             stderr=devnull, start_new_session=True)
+    if options.get("parsable", False):
+        print(master_id)
+    else:
+        print("Submitted batch job {id}".format(id=master_id))
+    return 0
+
+
+def _check_limits(state_dir, indices):
+    """ Reason why a submission exceeds the limits, None if it doesn't. """
+    max_array = int(os.environ.get(MAX_ARRAY_ENV, DEFAULT_MAX_ARRAY_SIZE))
+    if indices != [None] and max(indices) >= max_array:
+        return "Invalid job array specification"
+    max_submit = os.environ.get(MAX_SUBMIT_ENV, None)
+    if max_submit is not None:
+        queued = sum(1 for job in _all_jobs(state_dir)
+                     if job["state"] not in FINAL_STATES)
+        if queued + len(indices) > int(max_submit):
+            return ("Job violates accounting/QOS policy (job submit limit, "
+                    "user's size and/or time limits)")
+    return None
+
+
+def _dependencies(state_dir, dependency):
+    """ Check the dependencies of a job.
+
+    Returns
+    -------
+    str:
+        "wait", "ok" or "never" (a dependency can't be satisfied).
+    """
+    if not dependency:
+        return "ok"
+    for condition in dependency.replace("?", ",").split(","):
+        if ":" not in condition:
+            continue
+        kind, job_ids = condition.split(":", 1)
+        for job_id in job_ids.split(":"):
+            jobs = [job for job in _all_jobs(state_dir)
+                    if str(job["master_id"]) == job_id.split("_")[0] and
+                    ("_" not in job_id or job["job_id"] == job_id)]
+            for job in jobs:
+                if job["state"] not in FINAL_STATES:
+                    return "wait"
+                if kind == "afterok" and job["state"] != "COMPLETED":
+                    return "never"
+                if kind == "afternotok" and job["state"] == "COMPLETED":
+                    return "never"
+    return "ok"
+
+
+def _acquire_slot(state_dir):
+    """ Wait for a free job slot, returns the (locked) slot file. """
+    num_slots = int(os.environ.get(SLOTS_ENV, cpu_count()))
+    while True:
+        for slot in range(num_slots):
+            slot_file = open(os.path.join(state_dir, "slots", str(slot)),
+                             "w")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except (IOError, OSError):
+                slot_file.close()
+        time.sleep(POLL_INTERVAL)
+
+
+def _run(job_id):
+    """ Wait for the dependencies and a free slot, then run the job. """
+    state_dir = _state_dir()
+    job = _read_job(state_dir, job_id)
+    while True:
+        dependencies = _dependencies(state_dir, job["dependency"])
+        if dependencies != "wait":
+            break
+        time.sleep(POLL_INTERVAL)
+    if dependencies == "never":
+        job.update(state="CANCELLED", end=time.time())
+        _write_job(state_dir, job)
+        return 0
+
+    slot_file = _acquire_slot(state_dir)
+    job.update(state="RUNNING", start=time.time())
+    _write_job(state_dir, job)
+
+    env = dict(os.environ)
+    env.update({
+        "SLURM_JOB_ID": job["slurm_id"], "SLURM_JOBID": job["slurm_id"],
+        "SLURM_JOB_NAME": job["job_name"],
+        "SLURM_SUBMIT_DIR": job["work_dir"],
+        "SLURM_JOB_NUM_NODES": "1", "SLURM_NNODES": "1",
+        "SLURM_JOB_NODELIST": socket.gethostname(),
+        "SLURMD_NODENAME": socket.gethostname(),
+        "SLURM_CPUS_ON_NODE": str(cpu_count()),
+    })
+    if job["array_index"] is not None:
+        env.update({
+            "SLURM_ARRAY_JOB_ID": str(job["master_id"]),
+            "SLURM_ARRAY_TASK_ID": str(job["array_index"]),
+            "SLURM_ARRAY_TASK_COUNT": str(job["array_size"]),
+        })
+    mode = "a" if job["open_mode"] == "append" else "w"
+    output_file = filename_pattern(job["output"], job)
+    stdout = open(output_file, mode)
+    if job["error"] is None or \
+            filename_pattern(job["error"], job) == output_file:
+        stderr = subprocess.STDOUT
+    else:
+        stderr = open(filename_pattern(job["error"], job), mode)
+
+    proc = subprocess.Popen(["bash", job["script"]] + job["args"],
+                            cwd=job["work_dir"], env=env, stdout=stdout,
+                            stderr=stderr, start_new_session=True)
+    state = None
+    timeout = job["time_limit"]
+    try:
+        if job.get("signal") and timeout is not None:
+            signum, seconds, batch_only = parse_signal(job["signal"])
+            try:
+                exit_code = proc.wait(timeout=max(0, timeout-seconds))
+            except subprocess.TimeoutExpired:
+                if batch_only:
+                    os.kill(proc.pid, signum)
+                else:
+                    os.killpg(proc.pid, signum)
+                exit_code = proc.wait(timeout=min(seconds, timeout))
+        else:
+            exit_code = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGTERM)
+        exit_code = proc.wait()
+        state = "TIMEOUT"
+    if state is None:
+        state = "COMPLETED" if exit_code == 0 else "FAILED"
+    # CPU time of the job: this process only runs the batch script.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    job.update(state=state, exit_code=exit_code, end=time.time(),
+               total_cpu=usage.ru_utime + usage.ru_stime)
+    _write_job(state_dir, job)
+    slot_file.close()
+    return 0
+
+
+def _short_state(state):
+    return {"PENDING": "PD", "RUNNING": "R", "COMPLETED": "CD",
+            "FAILED": "F", "CANCELLED": "CA", "TIMEOUT": "TO"}[state]
+
+
+def squeue(args):
+    """ Show pending and running jobs (-h, -j, -n, -u are supported, and -o
+        with %i, %A, %j and %t).
+    """
+    jobs = [job for job in _all_jobs(_state_dir())
+            if job["state"] not in FINAL_STATES]
+    fmt = None
+    for arg_i, arg in enumerate(args):
+        if arg in ("-j", "--jobs") and arg_i+1 < len(args):
+            job_ids = args[arg_i+1].split(",")
+            jobs = [job for job in jobs if job["job_id"] in job_ids or
+                    str(job["master_id"]) in job_ids]
+        elif arg in ("-n", "--name") and arg_i+1 < len(args):
+            names = args[arg_i+1].split(",")
+            jobs = [job for job in jobs if job["job_name"] in names]
+        elif arg in ("-o", "--format") and arg_i+1 < len(args):
+            fmt = args[arg_i+1]
+    if fmt is not None:
+        for job in jobs:
+            print(re.sub(r"%([iAjt])", lambda match: {
+                "i": job["job_id"], "A": str(job["slurm_id"]),
+                "j": job["job_name"], "t": _short_state(job["state"]),
+            }[match.group(1)], fmt))
+        return 0
+    if "-h" not in args and "--noheader" not in args:
+        print("{:>18} {:>24} {:>2} {:>10}".format("JOBID", "NAME", "ST",
+                                                  "TIME"))
+    for job in jobs:
+        elapsed = 0 if job["start"] is None else time.time() - job["start"]
+        print("{:>18} {:>24} {:>2} {:>10}".format(
+            job["job_id"], job["job_name"][:24], _short_state(job["state"]),
+            int(elapsed)))
+    return 0
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                         seconds % 60)
+
+
+def _elapsed(job):
+    if job["start"] is None:
+        return "00:00:00"
+    return _duration((job["end"] or time.time()) - job["start"])
+
+
+def _cpu_time(job):
+    """ CPU time as sacct shows it: MM:SS.mmm, or HH:MM:SS from an hour. """
+    seconds = job.get("total_cpu") or 0
+    if seconds >= 3600:
+        return _duration(seconds)
+    return "{:02d}:{:06.3f}".format(int(seconds // 60), seconds % 60)
+
+
+def _timestamp(epoch):
+    if epoch is None:
+        return "Unknown"
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(epoch))
+
+
+SACCT_FIELDS = {
+    "JobID": lambda job: job["job_id"],
+    "JobName": lambda job: job["job_name"],
+    "State": lambda job: job["state"],
+    "ExitCode": lambda job: "{code}:0".format(code=job["exit_code"] or 0),
+    "Submit": lambda job: _timestamp(job["submit"]),
+    "Start": lambda job: _timestamp(job["start"]),
+    "End": lambda job: _timestamp(job["end"]),
+    "Elapsed": _elapsed,
+    "ElapsedRaw": lambda job: str(int((job["end"] or time.time()) -
+                                      job["start"]) if job["start"] else 0),
+    "Timelimit": lambda job: "UNLIMITED" if job["time_limit"] is None
+    else _duration(job["time_limit"]),
+    "AllocCPUS": lambda job: str(job.get("alloc_cpus", 1)),
+    "TotalCPU": _cpu_time,
+    "NNodes": lambda job: str(job.get("num_nodes", 1)),
+}
+
+
+def sacct(args):
+    """ Accounting of all jobs (-j, --name, -S, -X, -n, -P, --format are
+        supported). There are no job steps, only allocations.
+    """
+    fields = ["JobID", "JobName", "State", "ExitCode", "Elapsed"]
+    jobs = _all_jobs(_state_dir())
+    header = True
+    parsable = False
+    i = 0
+    while i < len(args):
+        arg, _, value = args[i].partition("=")
+        if arg in ("-j", "--jobs", "--name", "-o", "--format", "-S",
+                   "--starttime") and not value:
+            i += 1
+            value = args[i] if i < len(args) else ""
+        if arg in ("-j", "--jobs"):
+            job_ids = value.split(",")
+            jobs = [job for job in jobs if job["job_id"] in job_ids or
+                    str(job["master_id"]) in job_ids]
+        elif arg == "--name":
+            jobs = [job for job in jobs
+                    if job["job_name"] in value.split(",")]
+        elif arg in ("-S", "--starttime"):
+            start = time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+            jobs = [job for job in jobs if job["submit"] >= start]
+        elif arg in ("-o", "--format"):
+            fields = [field.split("%")[0] for field in value.split(",")]
+        elif arg in ("-n", "--noheader"):
+            header = False
+        elif arg in ("-P", "--parsable2"):
+            parsable = True
+        i += 1
+
+    fields = [field for field in fields if field in SACCT_FIELDS]
+    rows = [[SACCT_FIELDS[field](job) for field in fields] for job in jobs]
+    if header:
+        rows.insert(0, fields)
+    for row in rows:
+        if parsable:
+            print("|".join(row))
+        else:
+            print(" ".join("{:>20}".format(value) for value in row))
+    return 0
+
+
+def wait_for_jobs(state_dir, timeout=60):
+    """ Wait until all submitted jobs are finished.
+
+    Returns
+    -------
+    list:
+        All jobs (dictionaries with job_id, state, exit_code, ...).
+    """
+    start = time.time()
+    while True:
+        jobs = _all_jobs(state_dir)
+        if all(job["state"] in FINAL_STATES for job in jobs):
+            return jobs
+        if time.time() - start > timeout:
+            raise RuntimeError("Jobs did not finish within {t} seconds."
+                               .format(t=timeout))
+        time.sleep(POLL_INTERVAL)
+
+
+def scontrol(args):
+    """ Configuration of the cluster (only show config). """
+    if args[:2] != ["show", "config"]:
+        print("scontrol: only 'show config' is supported.", file=sys.stderr)
+        return 1
+    print("Configuration data as of {now}".format(now=_timestamp(
+        time.time())))
+    print("MaxArraySize            = {n}".format(n=os.environ.get(
+        MAX_ARRAY_ENV, DEFAULT_MAX_ARRAY_SIZE)))
+    print("MaxJobCount             = 10000")
+    return 0
+
+
+def sacctmgr(args):
+    """ Limits of the association of the user (only MaxSubmit). """
+    if "show" not in args or not any(arg.lower() == "format=maxsubmit"
+                                     for arg in args):
+        print("sacctmgr: only 'show assoc format=MaxSubmit' is supported.",
+              file=sys.stderr)
+        return 1
+    if "-n" not in args and "--noheader" not in args:
+        print("MaxSubmit")
+    print(os.environ.get(MAX_SUBMIT_ENV, ""))
+    return 0
+
+
+COMMANDS = {"sbatch": sbatch, "squeue": squeue, "sacct": sacct,
+            "scontrol": scontrol, "sacctmgr": sacctmgr}
+
+
+def main(args):
+    if len(args) == 2 and args[0] == "_run":
+        return _run(args[1])
+    if not args or args[0] not in COMMANDS:
+        print("Usage: python -m batchgen.fakeslurm sbatch|squeue|sacct|"
+              "scontrol|sacctmgr [options]", file=sys.stderr)
+        return 1
+    try:
+        return COMMANDS[args[0]](args[1:])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
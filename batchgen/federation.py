@@ -0,0 +1,213 @@
+"""
+Federation of remote targets: the commands of one job are split over
+several clusters, according to their capacity.
+
+@author: Raoul Schram
+"""
+
+import os
+import time
+import json
+import configparser as cp
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from batchgen.util import _split_commands, batch_dir
+
+
+FEDERATION_FILE = "federation.json"
+
+
+def target_names(config):
+    """ Names of the targets ([TARGET name] sections) in the config. """
+    return [section.split(None, 1)[1] for section in config.sections()
+            if section.startswith("TARGET ") and len(section.split()) > 1]
+
+
+def target_config(config, name):
+    """ Configuration for a single target: a copy of the configuration
+        with the target as its CONNECTION section.
+
+    Arguments
+    ---------
+    config: ConfigParser
+        Configuration with [TARGET name] sections.
+    name: str
+        Name of the target.
+
+    Returns
+    -------
+    ConfigParser:
+        New configuration, the job name gets the target name as a suffix.
+    """
+    new_config = cp.ConfigParser(interpolation=None)
+    new_config.optionxform = str
+    for section in config.sections():
+        if section.startswith("TARGET ") or section == "CONNECTION":
+            continue
+        new_config.add_section(section)
+        for key, value in config.items(section, raw=True):
+            new_config.set(section, key, value)
+    new_config.add_section("CONNECTION")
+    for key, value in config.items("TARGET " + name, raw=True):
+        if key not in ("weight", "queue_probe"):
+            new_config.set("CONNECTION", key, value)
+    if new_config.has_option("BATCH_OPTIONS", "job_name"):
+        job_name = new_config.get("BATCH_OPTIONS", "job_name")
+    else:
+        job_name = "asr_simulation"
+    new_config.set("BATCH_OPTIONS", "job_name", job_name + "_" + name)
+    return new_config
+
+
+def queue_depth(section):
+    """ Number of jobs of the user in the queue of a target, None if it
+        can't be determined.
+    """
+    user = section.get("user", None)
+    server = section["server"]
+    if user is not None:
+        server = user + "@" + server
+    ssh_command = ["ssh", "-q", "-o", "ConnectTimeout=10", server,
+                   "squeue -h -u $USER | wc -l"]
+    try:
+        res = subprocess.run(ssh_command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, timeout=30)
+        return int(res.stdout.decode("utf-8").split()[-1])
+    except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+        return None
+
+
+def weighted_split(num_commands, weights):
+    """ Split a number of commands according to weights (largest
+        remainder method).
+
+    Arguments
+    ---------
+    num_commands: int
+        Number of commands to split.
+    weights: list
+        Relative capacity of the targets.
+
+    Returns
+    -------
+    list:
+        Number of commands per target.
+    """
+    total = float(sum(weights))
+    if total <= 0:
+        weights = [1]*len(weights)
+        total = float(len(weights))
+    quota = [num_commands*weight/total for weight in weights]
+    counts = [int(q) for q in quota]
+    by_remainder = sorted(range(len(weights)),
+                          key=lambda i: counts[i] - quota[i])
+    for i in by_remainder[:num_commands - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def target_weights(config, names):
+    """ Weights of the targets: the configured weight, divided by the
+        number of queued jobs (+1) for targets with queue_probe.
+    """
+    sections = [config["TARGET " + name] for name in names]
+    weights = [float(section.get("weight", 1)) for section in sections]
+    probes = [section.getboolean("queue_probe", False)
+              for section in sections]
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+        depths = list(executor.map(
+            lambda i: queue_depth(sections[i]) if probes[i] else None,
+            range(len(names))))
+    for i, depth in enumerate(depths):
+        if probes[i] and depth is None:
+            print("Warning: could not probe the queue of target {name}."
+                  .format(name=names[i]))
+        elif depth is not None:
+            weights[i] /= depth + 1
+    return weights
+
+
+def federate(command_string, config, send_batch):
+    """ Split the commands over the targets, and send them concurrently.
+
+    Arguments
+    ---------
+    command_string: str
+        Commands, one per line.
+    config: ConfigParser
+        Configuration with [TARGET name] sections.
+    send_batch: function
+        Called as send_batch(command_string, target_config), creates and
+        sends the batch for one target, returns non-zero on failure.
+
+    Returns
+    -------
+    int:
+        Zero if all targets were successful.
+    """
+    names = target_names(config)
+    commands = _split_commands(command_string)
+    weights = target_weights(config, names)
+    counts = weighted_split(len(commands), weights)
+
+    targets = []
+    start = 0
+    for name, weight, count in zip(names, weights, counts):
+        targets.append({"name": name, "weight": weight,
+                        "first_command": start, "num_commands": count})
+        start += count
+
+    def _send(target):
+        new_config = target_config(config, target["name"])
+        target["server"] = new_config.get("CONNECTION", "server")
+        target["remote_dir"] = new_config.get("CONNECTION", "remote_dir")
+        target["job_name"] = new_config.get("BATCH_OPTIONS", "job_name")
+        if target["num_commands"] == 0:
+            target["status"] = "skipped"
+            return 0
+        first = target["first_command"]
+        target_commands = commands[first:first+target["num_commands"]]
+        try:
+            res = send_batch("\n".join(target_commands)+"\n", new_config)
+        except Exception as e:
+            print("Error: target {name}: {err}".format(name=target["name"],
+                                                       err=e))
+            res = 1
+        target["status"] = "failed" if res else "sent"
+        return res
+
+    with ThreadPoolExecutor(max_workers=max(1, len(targets))) as executor:
+        results = list(executor.map(_send, targets))
+
+    if config.has_option("BATCH_OPTIONS", "job_name"):
+        job_name = config.get("BATCH_OPTIONS", "job_name")
+    else:
+        job_name = "asr_simulation"
+    write_federation(job_name, targets)
+    print_federation(job_name, targets)
+    return 0 if not any(results) else 1
+
+
+def write_federation(job_name, targets):
+    """ Record which commands were sent to which target. """
+    output_dir = batch_dir("federated", job_name)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    federation = {"job_name": job_name, "targets": targets,
+                  "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(os.path.join(output_dir, FEDERATION_FILE), "w") as f:
+        json.dump(federation, f, indent=2, sort_keys=True)
+
+
+def print_federation(job_name, targets):
+    print("""\
+******************************************************
+**                 Federated targets                **
+******************************************************""")
+    for target in targets:
+        print("** {name: <18}: {n: >8} commands, {status: <10}**".format(
+            name=target["name"][:18], n=target["num_commands"],
+            status=target["status"]))
+    print("******************************************************")
@@ -0,0 +1,282 @@
+"""
+Incremental retrieval of the results of a remote run.
+
+In a single SSH session, the list of files that were fetched before
+(path, size and modification time) is sent to the remote server, which
+compares it with the files that are there now, and sends the new and
+changed ones back as a compressed tar archive.
+
+Every received file is first written next to its destination and renamed
+when it is complete, and then recorded in the fetch state of the job (in
+FETCH_DIR of the local directory), so that an interrupted fetch
+continues where it stopped. Files that were removed or changed locally
+are fetched again.
+
+@author: Raoul Schram
+"""
+
+import os
+import time
+import shutil
+import tarfile
+import configparser as cp
+import subprocess
+
+from batchgen.ssh import remote_batch_dir
+from batchgen.federation import target_names, target_config
+
+
+# Fetch state of every job in the local directory: JOB_NAME.tsv.
+FETCH_DIR = ".batchgen_fetch"
+
+
+def _job_name(config):
+    if config.has_option("BATCH_OPTIONS", "job_name"):
+        return config.get("BATCH_OPTIONS", "job_name")
+    return "asr_simulation"
+
+
+def fetch_paths(config):
+    """ Remote paths to fetch by default, relative to remote_dir: the
+        output_dir of the job (if any) and its batch directory.
+    """
+    paths = []
+    if config.has_option("BATCH_OPTIONS", "output_dir"):
+        paths.append(config.get("BATCH_OPTIONS", "output_dir", raw=True))
+    paths.append(remote_batch_dir(config.get("BACKEND", "backend"),
+                                  _job_name(config)))
+    return paths
+
+
+def _quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def _fetch_command(remote_dir, paths):
+    """ Remote commands that read the fetched files (path, size, mtime)
+        from stdin and write the other files as a tar archive to stdout.
+    """
+    lines = [
+        "cd {dir} || exit 1".format(dir=_quote(remote_dir)),
+        "_bg_fetched=$(mktemp) || exit 1",
+        'cat > "$_bg_fetched"',
+        "find {paths} -type f -printf '%p\\t%s\\t%T@\\n' 2> /dev/null | "
+        "awk -F '\\t' 'FILENAME == ARGV[1] {{fetched[$0] = 1; next}} "
+        # As named in the archive: without a leading / or ./
+        "{{name = $1; sub(/^[.]?\\/+/, \"\", name)}} "
+        "!((name FS $2 FS int($3)) in fetched) {{print $1}}' "
+        '"$_bg_fetched" - | tar czf - --warning=no-file-changed '
+        "--no-recursion -T - 2> /dev/null"
+        .format(paths=" ".join(_quote(path) for path in paths)),
+        "_bg_rc=$?",
+        'rm -f "$_bg_fetched"',
+        # Files that grew while they were read (e.g. logs of running tasks)
+        # are fetched again next time, tar then exits with 1.
+        "[ $_bg_rc -le 1 ]",
+    ]
+    return "\n".join(lines)
+
+
+def read_fetched(state_file, dest_dir):
+    """ Files that were fetched before and are unchanged since.
+
+    Arguments
+    ---------
+    state_file: str
+        Fetch state, lines "PATH SIZE MTIME" (tab separated).
+    dest_dir: str
+        Local directory that the files were fetched to.
+
+    Returns
+    -------
+    dict:
+        Path -> (size, mtime) as on the remote server.
+    """
+    fetched = {}
+    try:
+        with open(state_file, "r") as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return fetched
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 3:
+            continue
+        path, size, mtime = fields
+        try:
+            stat = os.stat(os.path.join(dest_dir, path))
+        except OSError:
+            continue
+        if str(stat.st_size) == size and str(int(stat.st_mtime)) == mtime:
+            fetched[path] = (size, mtime)
+    return fetched
+
+
+def _write_fetched(state_file, fetched):
+    """ Rewrite the fetch state without outdated lines. """
+    with open(state_file + ".tmp", "w") as f:
+        for path, (size, mtime) in sorted(fetched.items()):
+            f.write("{path}\t{size}\t{mtime}\n".format(
+                path=path, size=size, mtime=mtime))
+    os.rename(state_file + ".tmp", state_file)
+
+
+def _safe_name(name):
+    """ Member name as a relative path, None if it points outside. """
+    name = os.path.normpath(name.lstrip("/"))
+    if name.startswith("..") or os.path.isabs(name) or name == ".":
+        return None
+    return name
+
+
+def _receive(stream, dest_dir, state_file):
+    """ Unpack the files in the (tar) stream, and record every complete
+        one in the fetch state.
+
+    Returns
+    -------
+    int:
+        Number of received files.
+    """
+    n_received = 0
+    with open(state_file, "a") as state, \
+            tarfile.open(fileobj=stream, mode="r|gz") as tar:
+        for member in tar:
+            name = _safe_name(member.name)
+            if not member.isfile() or name is None:
+                continue
+            dest_file = os.path.join(dest_dir, name)
+            if not os.path.isdir(os.path.dirname(dest_file)):
+                os.makedirs(os.path.dirname(dest_file))
+            part_file = dest_file + ".part"
+            try:
+                with open(part_file, "wb") as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                os.utime(part_file, (member.mtime, member.mtime))
+                os.rename(part_file, dest_file)
+            except BaseException:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                raise
+            state.write("{path}\t{size}\t{mtime}\n".format(
+                path=name, size=member.size, mtime=int(member.mtime)))
+            state.flush()
+            n_received += 1
+    return n_received
+
+
+def fetch_once(config, dest_dir, paths=None):
+    """ Fetch the new and changed files of a remote job.
+
+    Arguments
+    ---------
+    config: ConfigParser
+        Configuration with a CONNECTION section.
+    dest_dir: str
+        Local directory, the remote paths are relative to it as they are
+        to remote_dir.
+    paths: list
+        Remote files/directories, relative to remote_dir (default: see
+        fetch_paths).
+
+    Returns
+    -------
+    int:
+        Number of received files, None if the fetch failed.
+    """
+    if "user" in config.options("CONNECTION"):
+        user = config.get("CONNECTION", "user")+"@"
+    else:
+        user = ""
+    server = config.get("CONNECTION", "server")
+    remote_dir = config.get("CONNECTION", "remote_dir")
+    if not paths:
+        paths = fetch_paths(config)
+
+    state_dir = os.path.join(dest_dir, FETCH_DIR)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    state_file = os.path.join(state_dir, _job_name(config) + ".tsv")
+    fetched = read_fetched(state_file, dest_dir)
+    _write_fetched(state_file, fetched)
+
+    ssh_command = ["ssh", "-q", "-o", "ConnectTimeout=10", "-o",
+                   "ServerAliveInterval=10", user+server,
+                   _fetch_command(remote_dir, paths)]
+    proc = subprocess.Popen(ssh_command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for path, (size, mtime) in fetched.items():
+            proc.stdin.write("{path}\t{size}\t{mtime}\n".format(
+                path=path, size=size, mtime=mtime).encode("utf-8"))
+        proc.stdin.close()
+    except (IOError, OSError):
+        # The remote side stopped reading, the error is reported below.
+        pass
+    try:
+        n_received = _receive(proc.stdout, dest_dir, state_file)
+    except (IOError, OSError, tarfile.TarError) as e:
+        n_received = None
+        error = str(e)
+    stderr = proc.stderr.read().decode("utf-8")
+    proc.wait()
+    if proc.returncode != 0 or n_received is None:
+        print("----- Remote error at {server} -----".format(server=server))
+        if n_received is None:
+            print(error)
+        print(stderr)
+        return None
+    return n_received
+
+
+def fetch_results(config_file, paths=None, dest_dir=".", interval=None):
+    """ Fetch the results of a remote job, once or periodically.
+
+    Arguments
+    ---------
+    config_file: str
+        Configuration file of the job, with a [CONNECTION] section or
+        [TARGET name] sections.
+    paths: list
+        Remote files/directories, relative to remote_dir (default: the
+        output_dir of the job and its batch directory).
+    dest_dir: str
+        Local directory to fetch to.
+    interval: float
+        Time [s] between fetches, fetch once if None.
+
+    Returns
+    -------
+    int:
+        Zero if successful.
+    """
+    config = cp.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    if config.has_section("CONNECTION"):
+        configs = [("", config)]
+    else:
+        configs = [(name + ": ", target_config(config, name))
+                   for name in target_names(config)]
+    if not configs:
+        print("Error: no remote server ([CONNECTION] or [TARGET]) in "
+              "{cfg_file}.".format(cfg_file=config_file))
+        return 1
+    dest_dir = os.path.abspath(dest_dir)
+
+    while True:
+        failed = False
+        try:
+            for prefix, cur_config in configs:
+                n_received = fetch_once(cur_config, dest_dir, paths)
+                if n_received is None:
+                    failed = True
+                    continue
+                print("{prefix}Fetched {n} new or changed file(s).".format(
+                    prefix=prefix, n=n_received))
+            if interval is None:
+                break
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            break
+    return 1 if failed else 0
@@ -0,0 +1,258 @@
+"""
+Runtime history of commands, harvested from the joblogs of previous runs.
+It is used to estimate the wall time and packing of new batches.
+
+@author: Raoul Schram
+"""
+
+import os
+import re
+import sqlite3
+
+from batchgen.util import _is_true, time_to_seconds, seconds_to_time
+from batchgen.memo import strip_markers
+
+
+def default_history_db():
+    """ Location of the history database if not given in the config. """
+    return os.path.join(os.path.expanduser("~"), ".batchgen",
+                        "history.sqlite")
+
+
+def command_signature(command):
+    """ Normalize a command, such that similar commands have the same key.
+
+    Numbers are replaced by N, and whitespace is collapsed, so that e.g.
+    "./sum.sh 10 /tmp/run_3" and "./sum.sh 12 /tmp/run_4" are the same.
+    Memoization markers (see the memoize option) are ignored.
+
+    Arguments
+    ---------
+    command: str
+        Command to normalize.
+
+    Returns
+    -------
+    str:
+        Signature of the command.
+    """
+    command = strip_markers(command)[0]
+    signature = re.sub(r"\d+(\.\d+)?", "N", command.strip())
+    return re.sub(r"\s+", " ", signature)
+
+
+def _connect(db_file):
+    """ Open (and create if necessary) the history database. """
+    db_dir = os.path.dirname(os.path.abspath(db_file))
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE IF NOT EXISTS runs (signature TEXT, "
+                 "runtime REAL, maxrss INTEGER, exitval INTEGER, "
+                 "job_name TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS runs_signature "
+                 "ON runs (signature)")
+    conn.execute("CREATE TABLE IF NOT EXISTS harvested "
+                 "(path TEXT PRIMARY KEY, offset INTEGER)")
+    return conn
+
+
+def _find_joblogs(paths):
+    """ Find all joblogs in a list of files/(batch) directories. """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith(".joblog"):
+                    yield os.path.abspath(os.path.join(root, name))
+
+
+def _split_compound(command):
+    """ Split a compound task (see chunk_size) into its commands. """
+    if not command.startswith("_bg_fail=0; "):
+        return [command]
+    pattern = r"_bg_c='(.*?)'; \( eval \"\$_bg_c\" \) \|\| "
+    return [part.replace("'\\''", "'")
+            for part in re.findall(pattern, command)]
+
+
+def _parse_joblog_line(line):
+    """ Split a joblog line: seq, start, runtime, exitval, maxrss, command.
+
+    Returns
+    -------
+    tuple:
+        (runtime, maxrss, exitval, command), maxrss is None if unknown.
+    """
+    _, _, runtime, exitval, maxrss, command = line.split("\t", 5)
+    try:
+        maxrss = int(maxrss)
+    except ValueError:
+        maxrss = None
+    return float(runtime), maxrss, int(exitval), command
+
+
+def harvest(paths, db_file=None):
+    """ Load joblogs into the history database.
+
+    Joblogs are read incrementally: only lines that were added since the
+    last harvest are loaded.
+
+    Arguments
+    ---------
+    paths: list
+        Joblog files or (batch) directories to search for joblogs.
+    db_file: str
+        History database, default ~/.batchgen/history.sqlite.
+
+    Returns
+    -------
+    int:
+        Number of new records.
+    """
+    if db_file is None:
+        db_file = default_history_db()
+    conn = _connect(db_file)
+    n_records = 0
+    for joblog in _find_joblogs(paths):
+        row = conn.execute("SELECT offset FROM harvested WHERE path = ?",
+                           (joblog,)).fetchone()
+        offset = 0 if row is None else row[0]
+        if os.path.getsize(joblog) < offset:
+            # The file was regenerated, start over.
+            offset = 0
+        job_name = os.path.basename(joblog).rsplit("_", 1)[0]
+        with open(joblog, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # Only process complete lines.
+        data = data[:data.rfind(b"\n")+1]
+        records = []
+        for line in data.decode("utf-8").splitlines():
+            try:
+                runtime, maxrss, exitval, command = _parse_joblog_line(line)
+            except ValueError:
+                continue
+            # Compound tasks: attribute the runtime evenly to the commands.
+            commands = _split_compound(command)
+            for sub_command in commands:
+                records.append((command_signature(sub_command),
+                                runtime/len(commands), maxrss, exitval,
+                                job_name))
+        conn.executemany("INSERT INTO runs VALUES (?, ?, ?, ?, ?)", records)
+        conn.execute("INSERT OR REPLACE INTO harvested VALUES (?, ?)",
+                     (joblog, offset+len(data)))
+        conn.commit()
+        n_records += len(records)
+    conn.close()
+    return n_records
+
+
+def harvest_joblogs(paths, db_file=None):
+    """ Command line version of harvest. """
+    n_records = harvest(paths, db_file)
+    print("Harvested {n} new records into {db}".format(
+        n=n_records, db=db_file or default_history_db()))
+    return 0
+
+
+def _percentile(values, percentile):
+    """ Percentile (nearest rank) of a list of values. """
+    values = sorted(values)
+    rank = int(-(-len(values)*percentile // 100))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def history_estimates(commands, db_file, percentile=95):
+    """ Estimate runtime and memory of commands from the history.
+
+    Arguments
+    ---------
+    commands: list
+        Commands to be run.
+    db_file: str
+        History database.
+    percentile: float
+        Percentile of the previous runs to use as an estimate.
+
+    Returns
+    -------
+    dict:
+        Signature -> (runtime [s], peak memory [kB] or None), only for
+        signatures with successful runs in the history.
+    """
+    if not os.path.isfile(db_file):
+        return {}
+    signatures = set(command_signature(command) for command in commands)
+    conn = _connect(db_file)
+    estimates = {}
+    for signature in signatures:
+        rows = conn.execute("SELECT runtime, maxrss FROM runs WHERE "
+                            "signature = ? AND exitval = 0",
+                            (signature,)).fetchall()
+        if not rows:
+            continue
+        runtime = _percentile([row[0] for row in rows], percentile)
+        memory = [row[1] for row in rows if row[1] is not None]
+        maxrss = _percentile(memory, percentile) if memory else None
+        estimates[signature] = (runtime, maxrss)
+    conn.close()
+    return estimates
+
+
+def apply_history(param):
+    """ Estimate the duration of the commands from the history.
+
+    If the option history is enabled, task_time (estimated duration of one
+    command) is set, unless it is given explicitly. The estimates per
+    signature are stored in history_estimates.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of parameters, is updated.
+    """
+    param["history_estimates"] = {}
+    if not _is_true(param.get("history", False)):
+        return
+    db_file = param.get("history_db", default_history_db())
+    percentile = float(param.get("history_percentile", 95))
+    estimates = history_estimates(param["script_lines"], db_file, percentile)
+    param["history_estimates"] = estimates
+    if not estimates:
+        print("Warning: no history found for these commands in {db}.".format(
+            db=db_file))
+        return
+    if "task_time" not in param:
+        param["task_time"] = max(est[0] for est in estimates.values())
+
+
+def history_shape(param, explicit_tpn):
+    """ Set the wall time or tasks per node from the estimated runtime.
+
+    If the number of tasks per node was given, the wall time is estimated,
+    otherwise the tasks per node are set to fit within the wall time.
+    A safety margin (history_margin, default 1.5) is applied.
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of (parsed) parameters, is updated.
+    explicit_tpn: bool
+        Whether num_tasks_per_node was set in the configuration.
+    """
+    if not param.get("history_estimates"):
+        return
+    margin = float(param.get("history_margin", 1.5))
+    ncs = param["num_cores_simul"]
+    task_time = float(param["task_time"])*param["chunk_size"]*margin
+    if explicit_tpn:
+        num_rounds = (param["num_tasks_per_node"]-1) // ncs + 1
+        wall_time = max(60, 60*int(-(-num_rounds*task_time // 60)))
+        param["clock_wall_time"] = seconds_to_time(wall_time)
+    else:
+        wall_time = time_to_seconds(param["clock_wall_time"])
+        num_rounds = max(1, int(wall_time // max(task_time, 1e-3)))
+        param["num_tasks_per_node"] = ncs*num_rounds
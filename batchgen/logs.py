@@ -0,0 +1,71 @@
+"""
+Retrieve the output of single tasks from the indexed, compressed logs
+(see the log_mode option).
+
+@author: Raoul Schram
+"""
+
+import os
+import sys
+import zlib
+
+from batchgen.backend.wrapper import LOG_DIR
+
+
+def _decompress_member(data):
+    """ Decompress one gzip member. """
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+def task_output(batch_dir, task_id):
+    """ Find the output of a task in the logs of all nodes.
+
+    Only the (small) index files are scanned, the compressed logs are read
+    only at the position of the task.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory of the job.
+    task_id: str
+        Task identifier BATCH_ID.SEQ, e.g. 3.17 (the batch is 0 for the
+        GNU Parallel backend).
+
+    Returns
+    -------
+    list:
+        Tagged output (one string for every time the task ran).
+    """
+    log_dir = os.path.join(batch_dir, LOG_DIR)
+    if not os.path.isdir(log_dir):
+        return []
+    prefix = task_id + " "
+    outputs = []
+    for idx_file in sorted(os.listdir(log_dir)):
+        if not idx_file.endswith(".idx"):
+            continue
+        idx_path = os.path.join(log_dir, idx_file)
+        log_path = idx_path[:-len(".idx")] + ".log.gz"
+        with open(idx_path, "r") as f:
+            positions = [line.split()[1:3] for line in f
+                         if line.startswith(prefix)]
+        if not positions:
+            continue
+        with open(log_path, "rb") as f:
+            for offset, length in positions:
+                f.seek(int(offset))
+                data = _decompress_member(f.read(int(length)))
+                outputs.append(data.decode("utf-8", "replace"))
+    return outputs
+
+
+def print_task_output(batch_dir, task_id):
+    """ Command line version of task_output. """
+    outputs = task_output(batch_dir, task_id)
+    if not outputs:
+        print("Error: no output found for task {task_id} in {dir}.".format(
+            task_id=task_id, dir=os.path.join(batch_dir, LOG_DIR)))
+        return 1
+    for output in outputs:
+        sys.stdout.write(output)
+    return 0
@@ -0,0 +1,311 @@
+"""
+Content addressed memoization of task results (see the memoize option).
+
+Every command is keyed by a hash of its text and of the contents of its
+declared input files. When the task succeeds, its declared outputs are
+copied into the cache directory under that key; commands of a new run
+that have a complete cache entry are not scheduled, their outputs are
+restored from the cache instead.
+
+Inputs and outputs are declared as patterns, where {N} is the N-th word
+of the command ({0} is the program) and inputs may contain wildcards:
+
+    memo_inputs = {0} data/{1}.csv
+    memo_outputs = results/{1}.out
+
+The key of a scheduled command travels with it as a marker at the end of
+the command (MEMO_MARKER), which the task wrapper removes again before
+running, logging or reporting the command.
+
+@author: Raoul Schram
+"""
+
+import os
+import re
+import glob
+import shlex
+import shutil
+import hashlib
+import time
+
+from batchgen.node_cache import _hash_path
+from batchgen.util import _is_true, memory_to_kb
+
+
+# Table of the outputs of every key, in the batch directory.
+MEMO_FILE = "memo.tsv"
+MEMO_MARKER = " && : _bg_memo="
+KEY_LENGTH = 32
+MARKER_RE = re.compile(re.escape(MEMO_MARKER) +
+                       "([0-9a-f]{{{n}}})".format(n=KEY_LENGTH))
+# Unfinished entries older than this are removed [s].
+STALE_TIME = 86400
+
+
+def memoizes(param):
+    """ Check whether task results are memoized. """
+    return _is_true(param.get("memoize", False))
+
+
+def default_memo_dir():
+    """ Location of the cache if not given in the config. """
+    return os.path.join(os.path.expanduser("~"), ".batchgen", "memo")
+
+
+def _patterns(value):
+    return [pattern for pattern in value.split() if pattern]
+
+
+def _fill_in(pattern, words):
+    """ Replace {N} by the N-th word of the command, None if it has no
+        N-th word.
+    """
+    try:
+        return re.sub(r"\{(\d+)\}", lambda match: words[int(match.group(1))],
+                      pattern)
+    except IndexError:
+        return None
+
+
+def _words(command):
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return command.split()
+
+
+def command_files(command, input_patterns, output_patterns):
+    """ Input and output files of a command.
+
+    Arguments
+    ---------
+    command: str
+        Command (without marker).
+    input_patterns: list
+        Patterns of the inputs, with {N} and wildcards.
+    output_patterns: list
+        Patterns of the outputs, with {N}.
+
+    Returns
+    -------
+    list:
+        Absolute paths of the inputs (matches of wildcards are sorted).
+    list:
+        Absolute paths of the outputs.
+    """
+    words = _words(command)
+    inputs = []
+    for pattern in input_patterns:
+        path = _fill_in(pattern, words)
+        if path is None:
+            continue
+        path = os.path.abspath(os.path.expanduser(path))
+        if glob.has_magic(path):
+            inputs.extend(sorted(glob.glob(path)))
+        else:
+            inputs.append(path)
+    outputs = [os.path.abspath(os.path.expanduser(path)) for path in
+               (_fill_in(pattern, words) for pattern in output_patterns)
+               if path is not None]
+    return inputs, outputs
+
+
+def memo_key(command, inputs, outputs, file_hashes=None):
+    """ Content hash of a command and its inputs.
+
+    Arguments
+    ---------
+    command: str
+        Command (without marker).
+    inputs: list
+        Input files/directories, missing ones are part of the key too.
+    outputs: list
+        Output files, a different set of outputs is a different entry.
+    file_hashes: dict
+        Cache of the hashes of the inputs (path -> hash), is updated.
+
+    Returns
+    -------
+    str:
+        Hexadecimal key (KEY_LENGTH characters).
+    """
+    if file_hashes is None:
+        file_hashes = {}
+    sha = hashlib.sha256()
+    sha.update(command.strip().encode("utf-8") + b"\0")
+    for path in inputs:
+        if path not in file_hashes:
+            if os.path.exists(path):
+                file_sha = hashlib.sha256()
+                _hash_path(file_sha, path)
+                file_hashes[path] = file_sha.hexdigest()
+            else:
+                file_hashes[path] = "-"
+        sha.update("{path}\0{hash}\0".format(
+            path=path, hash=file_hashes[path]).encode("utf-8"))
+    for path in outputs:
+        sha.update(path.encode("utf-8") + b"\0")
+    return sha.hexdigest()[:KEY_LENGTH]
+
+
+def strip_markers(command):
+    """ Remove the markers from a (compound) task.
+
+    Returns
+    -------
+    str:
+        The task as it was given.
+    list:
+        Keys of its commands.
+    """
+    return MARKER_RE.sub("", command), MARKER_RE.findall(command)
+
+
+def _restore(entry, outputs):
+    """ Copy the outputs of a cache entry to their locations. """
+    for i, output in enumerate(outputs):
+        cached = os.path.join(entry, str(i))
+        out_dir = os.path.dirname(output)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        if os.path.isdir(cached):
+            if os.path.isdir(output):
+                shutil.rmtree(output)
+            shutil.copytree(cached, output)
+        else:
+            shutil.copy2(cached, output)
+    # Least recently used entries are evicted first.
+    os.utime(entry, None)
+
+
+def store_outputs(memo_dir, key, outputs):
+    """ Add the outputs of a successful command to the cache.
+
+    Returns
+    -------
+    bool:
+        Whether the entry was added.
+    """
+    entry = os.path.join(memo_dir, key)
+    if os.path.isdir(entry):
+        return False
+    part = "{entry}.part.{pid}".format(entry=entry, pid=os.getpid())
+    try:
+        os.makedirs(part)
+        for i, output in enumerate(outputs):
+            if os.path.isdir(output):
+                shutil.copytree(output, os.path.join(part, str(i)))
+            else:
+                shutil.copy2(output, os.path.join(part, str(i)))
+        os.rename(part, entry)
+    except (IOError, OSError):
+        shutil.rmtree(part, ignore_errors=True)
+        return False
+    return True
+
+
+def _entry_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def evict(memo_dir, max_size):
+    """ Remove the least recently used entries until the cache fits.
+
+    Arguments
+    ---------
+    memo_dir: str
+        Cache directory.
+    max_size: int
+        Maximum size of the cache [kB].
+
+    Returns
+    -------
+    int:
+        Number of removed entries.
+    """
+    if not os.path.isdir(memo_dir):
+        return 0
+    entries = []
+    now = time.time()
+    for name in os.listdir(memo_dir):
+        path = os.path.join(memo_dir, name)
+        mtime = os.path.getmtime(path)
+        if ".part." in name:
+            if now - mtime > STALE_TIME:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        entries.append((mtime, _entry_size(path), path))
+    total = sum(entry[1] for entry in entries)
+    n_removed = 0
+    for _, size, path in sorted(entries):
+        if total <= 1024*max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        n_removed += 1
+    return n_removed
+
+
+def apply_memo(param):
+    """ Skip the commands that have a complete cache entry (their outputs
+        are restored), and mark the others with their key.
+
+    Sets memo_dir and memo_table (key -> outputs of the scheduled
+    commands).
+
+    Arguments
+    ---------
+    param: dict
+        Dictionary of parameters, script_lines is replaced.
+    """
+    param["memo_table"] = {}
+    if not memoizes(param):
+        return
+    memo_dir = os.path.abspath(os.path.expanduser(
+        param.get("memo_dir", default_memo_dir())))
+    param["memo_dir"] = memo_dir
+    if not os.path.isdir(memo_dir):
+        os.makedirs(memo_dir)
+    input_patterns = _patterns(param.get("memo_inputs", ""))
+    output_patterns = _patterns(param.get("memo_outputs", ""))
+
+    file_hashes = {}
+    script_lines = []
+    n_restored = 0
+    for command in param["script_lines"]:
+        command = strip_markers(command)[0]
+        inputs, outputs = command_files(command, input_patterns,
+                                        output_patterns)
+        key = memo_key(command, inputs, outputs, file_hashes)
+        entry = os.path.join(memo_dir, key)
+        if os.path.isdir(entry):
+            try:
+                _restore(entry, outputs)
+                n_restored += 1
+                continue
+            except (IOError, OSError):
+                pass
+        param["memo_table"][key] = outputs
+        script_lines.append(command.rstrip() + MEMO_MARKER + key)
+    param["script_lines"] = script_lines
+    n_evicted = evict(memo_dir, memory_to_kb(param.get("memo_max_size",
+                                                       "10G")))
+    print("Memoization: {n} of {total} command(s) restored from the cache, "
+          "{e} old entries evicted.".format(
+              n=n_restored, total=n_restored+len(script_lines), e=n_evicted))
+
+
+def write_memo_table(memo_file, memo_table):
+    """ Append the outputs of every key to the memo table (tab separated),
+        for the task wrapper.
+    """
+    with open(memo_file, "a") as f:
+        for key, outputs in memo_table.items():
+            f.write("\t".join([key] + outputs) + "\n")
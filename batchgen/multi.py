@@ -0,0 +1,237 @@
+"""
+Generate many jobs (each with its own commands and configuration) from a
+single job list, in one process.
+
+The job list is an INI file with one section per job:
+
+    [sweep_a]
+    command_file = sweep_a/commands.sh
+    config_file = slurm_lisa.ini
+    pre_post_file = pre_post.sh
+
+Paths are relative to the job list. Keys in a [DEFAULT] section apply to
+all jobs.
+
+@author: Raoul Schram
+"""
+
+import os
+import threading
+import configparser as cp
+
+from concurrent.futures import ThreadPoolExecutor
+
+from batchgen.base import _local_params, _backend, _read_pre_post_file
+from batchgen.federation import target_names
+from batchgen.util import _read_file, _check_files, batch_dir,\
+    read_manifest
+
+
+FILE_KEYS = ["command_file", "config_file", "pre_post_file", "pre_com_file",
+             "post_com_file"]
+SUBMIT_FILE = "submit.sh"
+
+
+def read_job_list(job_list_file):
+    """ Read the jobs of a job list.
+
+    Arguments
+    ---------
+    job_list_file: str
+        INI file with a section per job.
+
+    Returns
+    -------
+    list:
+        One dictionary per job, with its name and (absolute) files.
+    """
+    job_list = cp.ConfigParser(interpolation=None)
+    job_list.optionxform = str
+    job_list.read(job_list_file)
+    list_dir = os.path.dirname(os.path.abspath(job_list_file))
+    jobs = []
+    for section in job_list.sections():
+        job = {"name": section}
+        for key in FILE_KEYS:
+            value = job_list.get(section, key, fallback=None)
+            if value is not None:
+                value = os.path.join(list_dir, os.path.expanduser(value))
+            job[key] = value
+        jobs.append(job)
+    return jobs
+
+
+def _copy_config(config):
+    """ Independent copy of a parsed configuration. """
+    new_config = cp.ConfigParser()
+    new_config.optionxform = str
+    for section in config.sections():
+        new_config.add_section(section)
+        for key, value in config.items(section, raw=True):
+            new_config.set(section, key, value)
+    return new_config
+
+
+class _SharedInput(object):
+    """ Configurations and pre/post-commands, each read only once. """
+
+    def __init__(self):
+        self._configs = {}
+        self._files = {}
+        # Batch writers (and their templates) are reused within a thread.
+        self._local = threading.local()
+
+    def config(self, config_file):
+        if config_file not in self._configs:
+            config = cp.ConfigParser()
+            config.optionxform = str
+            config.read(config_file)
+            self._configs[config_file] = config
+        return _copy_config(self._configs[config_file])
+
+    def pre_post(self, job):
+        key = (job["pre_post_file"], job["pre_com_file"],
+               job["post_com_file"])
+        if key not in self._files:
+            if job["pre_post_file"] is not None:
+                self._files[key] = _read_pre_post_file(job["pre_post_file"])
+            else:
+                self._files[key] = (_read_file(job["pre_com_file"]),
+                                    _read_file(job["post_com_file"]))
+        return self._files[key]
+
+    def backend(self, backend, config_file):
+        writers = self._local.__dict__.setdefault("writers", {})
+        if backend not in writers:
+            writers[backend] = _backend(backend, config_file)
+        return writers[backend]
+
+
+def _prepare_job(job, shared, batch_dirs):
+    """ Parameters of a single job, None if it can't be generated. """
+    if _check_files(*[job[key] for key in FILE_KEYS]) or \
+            job["command_file"] is None or job["config_file"] is None:
+        job["status"] = "missing file"
+        return None
+    config = shared.config(job["config_file"])
+    if config.has_section("CONNECTION") or target_names(config):
+        print("Error: job {name} is remote, which is not supported in a "
+              "job list.".format(name=job["name"]))
+        job["status"] = "remote"
+        return None
+    pre_com_string, post_com_string = shared.pre_post(job)
+    backend, param = _local_params(config, job["config_file"],
+                                   pre_com_string, post_com_string)
+    job["backend"] = backend
+    job["batch_dir"] = batch_dir(backend, param["job_name"])
+    if job["batch_dir"] in batch_dirs:
+        print("Error: job {name} has the same batch directory as another "
+              "job: {dir}.".format(name=job["name"], dir=job["batch_dir"]))
+        job["status"] = "duplicate"
+        return None
+    batch_dirs.add(job["batch_dir"])
+    return param
+
+
+def _generate_job(job, param, shared, force_clear):
+    """ Generate the batches of a single job (fills in job). """
+    if param is None:
+        return 1
+    batch = shared.backend(job["backend"], job["config_file"])
+    if batch is None:
+        job["status"] = "no backend"
+        return 1
+    my_exec = batch.write_batch(_read_file(job["command_file"]), param,
+                                job["batch_dir"], force_clear,
+                                print_exec=False)
+    if my_exec is None:
+        job["status"] = "failed"
+        return 1
+    job["exec"] = my_exec
+    job["num_commands"] = read_manifest(job["batch_dir"])["num_commands"]
+    job["status"] = "written"
+    return 0
+
+
+def batch_from_job_list(job_list_file, force_clear=False, num_workers=None):
+    """ Generate the batches of all jobs in a job list, concurrently, and
+        write one script that submits all of them.
+
+    Arguments
+    ---------
+    job_list_file: str
+        INI file with a section per job (see the module description).
+    force_clear: bool
+        Replace existing batch directories.
+    num_workers: int
+        Number of jobs generated at the same time (default: up to 8).
+
+    Returns
+    -------
+    int:
+        Zero if all jobs were generated successfully.
+    """
+    if _check_files(job_list_file):
+        return 1
+    jobs = read_job_list(job_list_file)
+    if not jobs:
+        print("Error: no jobs in {file}.".format(file=job_list_file))
+        return 1
+    if num_workers is None:
+        num_workers = min(8, len(jobs))
+    shared = _SharedInput()
+
+    # Earlier jobs in the list take precedence for a batch directory.
+    batch_dirs = set()
+    params = [_prepare_job(job, shared, batch_dirs) for job in jobs]
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        results = list(executor.map(
+            lambda i: _generate_job(jobs[i], params[i], shared, force_clear),
+            range(len(jobs))))
+
+    list_name = os.path.splitext(os.path.basename(job_list_file))[0]
+    submit_file = write_submit_script(list_name, jobs)
+    print_job_list(list_name, jobs, submit_file)
+    return 0 if not any(results) else 1
+
+
+def write_submit_script(list_name, jobs):
+    """ Write the script that submits all generated jobs.
+
+    Returns
+    -------
+    str:
+        Location of the script.
+    """
+    output_dir = batch_dir("multi", list_name)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    submit_file = os.path.join(output_dir, SUBMIT_FILE)
+    with open(submit_file + ".tmp", "w") as f:
+        f.write("#!/bin/bash\n# Submit the jobs of {name}, generated by "
+                "batchgen.\n".format(name=list_name))
+        for job in jobs:
+            if job["status"] == "written":
+                f.write("\n# {name}\n{my_exec}\n".format(
+                    name=job["name"], my_exec=job["exec"]))
+    os.chmod(submit_file + ".tmp", 0o755)
+    os.rename(submit_file + ".tmp", submit_file)
+    return submit_file
+
+
+def print_job_list(list_name, jobs, submit_file):
+    print("""\
+******************************************************
+**                     Job list                     **
+******************************************************""")
+    for job in jobs:
+        print("** {name: <18}: {n: >8} commands, {status: <10}**".format(
+            name=job["name"][:18], n=job.get("num_commands", "-"),
+            status=job["status"]))
+    print("""\
+******************************************************
+** Execute the following on the command line (bash) **
+******************************************************
+
+bash {submit_file}
+""".format(submit_file=submit_file))
@@ -0,0 +1,151 @@
+"""
+Node-local caching of shared inputs and one-time setup commands.
+
+Batches that land on a node where the same inputs/setup were already
+prepared (same content hash) skip the setup completely.
+
+@author: Raoul Schram
+"""
+
+import os
+import hashlib
+import shlex
+import posixpath
+
+from batchgen.util import _read_file
+
+
+def _hash_path(sha, path):
+    """ Update a hash object with the contents of a file or directory.
+
+    Arguments
+    ---------
+    sha: hashlib object
+        Hash to update.
+    path: str
+        File or directory, directories are hashed recursively.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            sha.update(name.encode("utf-8"))
+            _hash_path(sha, os.path.join(path, name))
+        return
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+
+def cache_key(setup_string, shared_inputs):
+    """ Compute the content hash key of a node cache.
+
+    Arguments
+    ---------
+    setup_string: str
+        Setup commands run once per node.
+    shared_inputs: list
+        Files/directories that are copied to the node.
+
+    Returns
+    -------
+    str:
+        Hexadecimal key (16 characters).
+    """
+    sha = hashlib.sha256()
+    sha.update(setup_string.encode("utf-8"))
+    for path in shared_inputs:
+        sha.update(os.path.basename(path).encode("utf-8"))
+        _hash_path(sha, path)
+    return sha.hexdigest()[:16]
+
+
+def node_cache_string(param, remote_root=None):
+    """ Create the shell code that prepares the node-local cache.
+
+    Arguments
+    ---------
+    param: dict
+        Parameters from the configuration file. The options used are
+        shared_inputs (whitespace separated list of files/directories),
+        setup_file (script run once per node) and node_cache_dir.
+    remote_root: str
+        Remote directory, if the batch is generated for a remote server
+        (remote_mode = ship). Relative shared inputs start from it, and
+        the key is computed on the node from their sizes and modification
+        times, since they can't be read here.
+
+    Returns
+    -------
+    str:
+        Shell code to put before the pre-commands, empty if no shared inputs
+        or setup commands were declared.
+    """
+    if remote_root is None:
+        shared_inputs = [os.path.abspath(path) for path in
+                         param.get("shared_inputs", "").split()]
+    else:
+        shared_inputs = [posixpath.join(remote_root, path) for path in
+                         param.get("shared_inputs", "").split()]
+    setup_string = _read_file(param.get("setup_file", None))
+    if not shared_inputs and not setup_string.strip():
+        return ""
+
+    cache_root = param.get("node_cache_dir", "/tmp/batchgen_cache_${USER}")
+    if remote_root is None:
+        key = cache_key(setup_string, shared_inputs)
+        key_lines = ""
+    else:
+        key = "$_bg_key"
+        key_lines = """\
+_bg_key=$({{ echo {setup_key}; find {paths} -printf '%p %s %T@\\n'; }} |
+          sha256sum | cut -c1-16)
+""".format(setup_key=cache_key(setup_string, []),
+           paths=" ".join(shlex.quote(path) for path in shared_inputs))
+
+    copy_lines = ""
+    for path in shared_inputs:
+        dest = '"$BATCHGEN_CACHE"/' + shlex.quote(posixpath.basename(path))
+        if remote_root is not None:
+            copy_lines += ("        if [ -d {src} ]; then cp -r {src} {dest}; "
+                           "else $_bg_bcast {src} {dest}; fi || exit 1\n"
+                           .format(src=shlex.quote(path), dest=dest))
+            continue
+        if os.path.isdir(path):
+            copy_cmd = "cp -r"
+        else:
+            copy_cmd = "$_bg_bcast"
+        copy_lines += "        {cmd} {src} {dest} || exit 1\n".format(
+            cmd=copy_cmd, src=shlex.quote(path), dest=dest)
+
+    if setup_string.strip():
+        setup_lines = """\
+        cd "$BATCHGEN_CACHE" && bash -e << 'EOF_SETUP' || exit 1
+{setup}
+EOF_SETUP
+""".format(setup=setup_string.rstrip("\n"))
+    else:
+        setup_lines = ""
+
+    cache_str = """\
+# Node-local cache for shared inputs and setup (key {key}).
+{key_lines}export BATCHGEN_CACHE={cache_root}/{key}
+mkdir -p {cache_root}
+(
+    flock -x 9
+    if [ ! -f "$BATCHGEN_CACHE/.ready" ]; then
+        rm -rf "$BATCHGEN_CACHE" && mkdir -p "$BATCHGEN_CACHE" || exit 1
+        if [ -n "$SLURM_JOB_ID" ] && command -v sbcast > /dev/null; then
+            _bg_bcast="sbcast -f"
+        else
+            _bg_bcast="cp"
+        fi
+{copy_lines}{setup_lines}\
+        touch "$BATCHGEN_CACHE/.ready"
+    fi
+) 9> {cache_root}/{key}.lock || {{
+    echo "Error: setting up node cache $BATCHGEN_CACHE failed." >&2
+    exit 1
+}}
+""".format(key=key, key_lines=key_lines, cache_root=cache_root,
+           copy_lines=copy_lines, setup_lines=setup_lines)
+    return cache_str
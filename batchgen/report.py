@@ -0,0 +1,268 @@
+"""
+Efficiency of a run, from the accounting data of SLURM (sacct) and the
+joblogs of the tasks: how well the allocated cores and wall time were
+used, and what it actually cost compared to the estimate.
+
+The jobs of a batch directory are found by their job name, submitted
+after the batches were generated (see the manifest), unless their job ids
+are given.
+
+@author: Raoul Schram
+"""
+
+import time
+import subprocess
+
+from batchgen.history import _find_joblogs, _parse_joblog_line
+from batchgen.util import read_manifest, seconds_to_time, time_to_seconds
+
+
+SACCT_FIELDS = ["JobID", "JobName", "State", "Elapsed", "Timelimit",
+                "AllocCPUS", "TotalCPU", "NNodes"]
+# Billing as estimated by the slurm_lisa backend: 16 cores per node.
+BILL_CORES_PER_NODE = 16
+NUM_WORST = 5
+
+
+def parse_duration(value):
+    """ SLURM duration ([D-][HH:]MM:SS[.mmm]) in seconds, None if unknown
+        (e.g. UNLIMITED).
+    """
+    value = value.strip()
+    days = "0"
+    if "-" in value:
+        days, value = value.split("-", 1)
+    try:
+        days = int(days)
+        parts = [float(part) for part in value.split(":")]
+    except ValueError:
+        return None
+    if len(parts) == 2:
+        # MM:SS
+        parts.insert(0, 0)
+    if len(parts) != 3:
+        return None
+    return 86400*days + 3600*parts[0] + 60*parts[1] + parts[2]
+
+
+def parse_sacct(lines):
+    """ Allocations from the parsable output of sacct (SACCT_FIELDS).
+
+    Job steps (e.g. 1234.batch) are skipped.
+
+    Returns
+    -------
+    list:
+        Dictionary per job with job_id, state, elapsed, time_limit,
+        alloc_cpus, total_cpu and num_nodes (times in seconds).
+    """
+    jobs = []
+    for line in lines:
+        fields = line.strip().split("|")
+        if len(fields) < len(SACCT_FIELDS) or "." in fields[0]:
+            continue
+        try:
+            alloc_cpus = int(fields[5])
+            num_nodes = int(fields[7])
+        except ValueError:
+            continue
+        jobs.append({
+            "job_id": fields[0],
+            "state": fields[2].split()[0] if fields[2] else "",
+            "elapsed": parse_duration(fields[3]) or 0,
+            "time_limit": parse_duration(fields[4]),
+            "alloc_cpus": alloc_cpus,
+            "total_cpu": parse_duration(fields[6]) or 0,
+            "num_nodes": num_nodes,
+        })
+    return jobs
+
+
+def query_sacct(job_name, start=None, job_ids=None):
+    """ Accounting data of the jobs of a run, None if sacct can't be run.
+
+    Arguments
+    ---------
+    job_name: str
+        Name of the jobs.
+    start: float
+        Only jobs submitted after this time (epoch).
+    job_ids: list
+        Job ids, instead of searching by name and time.
+    """
+    command = ["sacct", "-X", "-n", "-P",
+               "--format=" + ",".join(SACCT_FIELDS)]
+    if job_ids:
+        command += ["-j", ",".join(job_ids)]
+    else:
+        command += ["--name=" + job_name]
+        if start is not None:
+            command += ["-S", time.strftime("%Y-%m-%dT%H:%M:%S",
+                                            time.localtime(start))]
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if res.returncode:
+        return None
+    return parse_sacct(res.stdout.decode("utf-8").splitlines())
+
+
+def task_records(batch_dir):
+    """ Runtime, exit value and command of every task in the joblogs. """
+    records = []
+    for joblog in _find_joblogs([batch_dir]):
+        with open(joblog, "r") as f:
+            for line in f:
+                try:
+                    runtime, _, exitval, command = _parse_joblog_line(
+                        line.rstrip("\n"))
+                except ValueError:
+                    continue
+                records.append((runtime, exitval, command))
+    return records
+
+
+def _ratio(part, total):
+    return None if not total else part/float(total)
+
+
+def efficiency(manifest, jobs, tasks):
+    """ Efficiency of a run.
+
+    Arguments
+    ---------
+    manifest: dict
+        Manifest of the batch directory.
+    jobs: list
+        Accounting data of the jobs (see parse_sacct).
+    tasks: list
+        (runtime, exit value, command) of the tasks (see task_records).
+
+    Returns
+    -------
+    dict:
+        cpu_efficiency (CPU time / allocated core time), wall_utilization
+        (elapsed / time limit), task_utilization (task time / allocated
+        core time), idle_core_time (allocated core time in which no task
+        ran), bill_time and estimated_bill_time (seconds),
+        worst_jobs (lowest CPU efficiency), longest_tasks and
+        failed_tasks. Ratios are None if unknown.
+    """
+    core_time = sum(job["elapsed"]*job["alloc_cpus"] for job in jobs)
+    limited = [job for job in jobs if job["time_limit"]]
+    # Every task occupies its share of the cores of a node.
+    num_cores = manifest.get("num_cores")
+    num_simul = manifest.get("num_cores_simul")
+    cores_per_task = 1
+    if num_cores and num_simul:
+        cores_per_task = (int(num_cores)-1)//int(num_simul) + 1
+    busy_time = cores_per_task*sum(task[0] for task in tasks)
+
+    estimated = manifest.get("max_bill_time")
+    report = {
+        "num_jobs": len(jobs),
+        "num_tasks": len(tasks),
+        "cpu_efficiency": _ratio(sum(job["total_cpu"] for job in jobs),
+                                 core_time),
+        "wall_utilization": _ratio(
+            sum(job["elapsed"] for job in limited),
+            sum(job["time_limit"] for job in limited)),
+        "task_utilization": _ratio(busy_time, core_time) if tasks else None,
+        "idle_core_time": max(0, core_time-busy_time) if tasks else None,
+        "bill_time": sum(BILL_CORES_PER_NODE*job["num_nodes"]*job["elapsed"]
+                         for job in jobs),
+        "estimated_bill_time": (None if not estimated
+                                else time_to_seconds(estimated)),
+    }
+    report["worst_jobs"] = sorted(
+        [job for job in jobs if job["elapsed"] > 0],
+        key=lambda job: job["total_cpu"]/(job["elapsed"]*job["alloc_cpus"])
+    )[:NUM_WORST]
+    report["longest_tasks"] = sorted(tasks, key=lambda task: -task[0])[
+        :NUM_WORST]
+    report["failed_tasks"] = [task for task in tasks if task[1] != 0]
+    return report
+
+
+def _percentage(ratio):
+    return "unknown" if ratio is None else "{p:.1f} %".format(p=100*ratio)
+
+
+def _hints(report):
+    """ Suggestions for the configuration of the next run. """
+    hints = []
+    if report["wall_utilization"] is not None and \
+            report["wall_utilization"] < 0.5:
+        hints.append("The jobs used less than half of their wall time: "
+                     "increase num_tasks_per_node (or lower "
+                     "clock_wall_time).")
+    if report["cpu_efficiency"] is not None and \
+            report["cpu_efficiency"] < 0.5:
+        hints.append("Less than half of the allocated core time was used: "
+                     "increase num_cores_simul, if the memory allows it.")
+    return hints
+
+
+def print_report(batch_dir, job_ids=None):
+    """ Command line version of efficiency, job_ids is comma separated. """
+    manifest = read_manifest(batch_dir)
+    if manifest is None:
+        print("Error: no batches (manifest) in {dir}.".format(
+            dir=batch_dir))
+        return 1
+    jobs = query_sacct(manifest["job_name"], manifest.get("created"),
+                       job_ids.split(",") if job_ids else None)
+    if jobs is None:
+        print("Error: could not get the accounting data (sacct).")
+        return 1
+    report = efficiency(manifest, jobs, task_records(batch_dir))
+
+    def _time(seconds):
+        return "unknown" if seconds is None else seconds_to_time(seconds)
+
+    print("""\
+******************************************************
+**                Efficiency report                 **
+******************************************************
+** Job name          : {job_name: <29}**
+** Jobs (sacct)      : {num_jobs: <29}**
+** Tasks (joblogs)   : {num_tasks: <29}**
+** CPU efficiency    : {cpu_efficiency: <29}**
+** Cores busy (tasks): {task_utilization: <29}**
+** Idle core time    : {idle_core_time: <29}**
+** Wall time used    : {wall_utilization: <29}**
+** Billing time      : {bill_time: <29}**
+** Estimated billing : {estimated_bill_time: <29}**
+******************************************************""".format(
+        job_name=manifest["job_name"], num_jobs=report["num_jobs"],
+        num_tasks=report["num_tasks"],
+        cpu_efficiency=_percentage(report["cpu_efficiency"]),
+        task_utilization=_percentage(report["task_utilization"]),
+        idle_core_time=_time(report["idle_core_time"]),
+        wall_utilization=_percentage(report["wall_utilization"]),
+        bill_time=_time(report["bill_time"]),
+        estimated_bill_time=_time(report["estimated_bill_time"])))
+
+    if report["worst_jobs"]:
+        print("\nLowest CPU efficiency (job, state, elapsed, efficiency):")
+        for job in report["worst_jobs"]:
+            print("  {id} {state} {elapsed} {eff}".format(
+                id=job["job_id"], state=job["state"],
+                elapsed=seconds_to_time(job["elapsed"]),
+                eff=_percentage(job["total_cpu"] /
+                                (job["elapsed"]*job["alloc_cpus"]))))
+    if report["longest_tasks"]:
+        print("\nLongest tasks (runtime, command):")
+        for runtime, _, command in report["longest_tasks"]:
+            print("  {t:.1f} s  {command}".format(t=runtime,
+                                                  command=command))
+    if report["failed_tasks"]:
+        print("\nFailed tasks: {n} (exit value, command):".format(
+            n=len(report["failed_tasks"])))
+        for _, exitval, command in report["failed_tasks"][:NUM_WORST]:
+            print("  {rc}  {command}".format(rc=exitval, command=command))
+    for hint in _hints(report):
+        print("\n" + hint)
+    return 0
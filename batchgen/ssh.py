@@ -8,14 +8,14 @@ import os
 import re
 import copy
 import shlex
-try:
-    import subprocess32 as subprocess
-except ImportError as e:
-    import subprocess
+import tarfile
+import posixpath
+import subprocess
 
 from string import Template
 
-from batchgen.util import batch_dir
+from batchgen.util import batch_dir, MANIFEST_FILE
+from batchgen.memo import MEMO_FILE
 from batchgen.backend.hpc import make_check_clean_directory
 
 
@@ -29,6 +29,155 @@ def _ssh_template():
     return ssh
 
 
+# Stand-in for remote_dir in generated files, if it is relative to the home
+# directory on the remote server. It is replaced when the batch is unpacked.
+REMOTE_ROOT = "/@BATCHGEN_REMOTE_ROOT@"
+
+
+def remote_mode(config):
+    """ Remote mode: generate (run batchgen remotely) or ship (generate
+        locally, and ship the batch directory).
+    """
+    if not config.has_option("CONNECTION", "remote_mode"):
+        return "generate"
+    return config.get("CONNECTION", "remote_mode").strip().lower()
+
+
+def remote_root(config):
+    """ Remote directory as used in the generated files. """
+    remote_dir = config.get("CONNECTION", "remote_dir")
+    if remote_dir.startswith("/"):
+        return remote_dir.rstrip("/") or "/"
+    return REMOTE_ROOT
+
+
+def remote_batch_dir(backend, job_name):
+    """ Batch directory, relative to remote_dir. """
+    return os.path.join("batch."+backend, job_name)
+
+
+def _ship_command(remote_dir, rel_batch_dir, exec_line, force_clear=False,
+                  submit=False):
+    """ Remote commands to unpack the shipped batch (from stdin).
+
+    The batch is unpacked in a staging directory, which then replaces the
+    batch directory. As with local generation, an existing batch directory
+    is only replaced (force_clear) if it holds nothing but generated files.
+    """
+    batch_dir = shlex.quote(rel_batch_dir)
+    lines = ["mkdir -p {dir} && cd {dir} || exit 1".format(
+        dir=shlex.quote(remote_dir))]
+    if force_clear:
+        lines.append("""\
+if [ -e {batch_dir} ]; then
+    _bg_found=$(find {batch_dir} -type f ! -name '*.sh' ! -name {manifest} \\
+                ! -name {memo} | sort)
+    if [ -n "$_bg_found" ]; then
+        echo "Error: $(head -n 1 <<< "$_bg_found") in {batch_dir} was not" \\
+            "generated by batchgen ($(wc -l <<< "$_bg_found") file(s) in" \\
+            "total)."
+        exit 1
+    fi
+fi""".format(batch_dir=batch_dir, manifest=MANIFEST_FILE, memo=MEMO_FILE))
+    else:
+        lines.append('if [ -e {batch_dir} ]; then echo "Error: {batch_dir} '
+                     'already exists on the remote server."; exit 1; fi'
+                     .format(batch_dir=batch_dir))
+    lines.append("""\
+mkdir -p {parent} &&
+_bg_stage=$(mktemp -d {parent}/.{name}.stage.XXXXXX) || exit 1
+if ! tar xzf - -C "$_bg_stage" --strip-components={depth}; then
+    rm -rf "$_bg_stage"
+    exit 1
+fi
+grep -rlF {root} "$_bg_stage" | xargs -r sed -i "s|{root}|$PWD|g"
+if [ ! -e {batch_dir} ]; then
+    mv "$_bg_stage" {batch_dir}
+elif mv --exchange -T "$_bg_stage" {batch_dir} 2> /dev/null; then
+    rm -rf "$_bg_stage"
+else
+    # Without an atomic exchange (coreutils < 9.5): two renames.
+    mv {batch_dir} "$_bg_stage.old" && mv "$_bg_stage" {batch_dir} &&
+    rm -rf "$_bg_stage.old"
+fi || exit 1""".format(
+        parent=shlex.quote(posixpath.dirname(rel_batch_dir)),
+        name=posixpath.basename(rel_batch_dir), batch_dir=batch_dir,
+        depth=len(rel_batch_dir.split("/")), root=REMOTE_ROOT))
+    if submit:
+        lines.append(exec_line.replace(REMOTE_ROOT, "$PWD"))
+    return "\n".join(lines)
+
+
+def ship_batch_ssh(config, write_dir, exec_line, force_clear=False):
+    """ Ship a locally generated batch to a remote server, and submit it.
+
+    The batch directory is streamed as a compressed tar
+    archive, unpacked and optionally submitted, in a single SSH session.
+
+    Arguments
+    ---------
+    config: str
+        ConfigParser configuration, read from file.
+    write_dir: str
+        Local copy of the batch directory.
+    exec_line: str
+        Command to submit the batch (in the remote paths).
+    force_clear: bool
+        Overwrite the batch directory on the remote server.
+
+    Returns
+    -------
+    int:
+        Zero if successful.
+    """
+    if "user" in config.options("CONNECTION"):
+        user = config.get("CONNECTION", "user")+"@"
+    else:
+        user = ""
+    server = config.get("CONNECTION", "server")
+    remote_dir = config.get("CONNECTION", "remote_dir")
+    submit = (config.has_option("CONNECTION", "submit") and
+              config.getboolean("CONNECTION", "submit"))
+    rel_batch_dir = remote_batch_dir(config.get("BACKEND", "backend"),
+                                     os.path.basename(write_dir))
+
+    remote_command = _ship_command(remote_dir, rel_batch_dir, exec_line,
+                                   force_clear, submit)
+    ssh_command = ["ssh", "-q", "-o", "ConnectTimeout=10", "-o",
+                   "ServerAliveInterval=10", user+server, remote_command]
+    proc = subprocess.Popen(ssh_command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode="w|gz") as tar:
+            tar.add(write_dir, arcname=rel_batch_dir)
+    except (IOError, OSError):
+        # The remote side stopped reading, the error is reported below.
+        pass
+    stdout, stderr = proc.communicate()
+    msg = stdout.decode("utf-8")
+    error_msg = parse_remote_msg(msg)[0]
+    if proc.returncode != 0 or error_msg:
+        print("----- Remote error at {server} -----".format(server=server))
+        print(msg)
+        print("----- stderr -----")
+        print(stderr.decode("utf-8"))
+        return 1
+    print(msg, end="")
+    if submit:
+        return 0
+
+    sub_templ = _remote_submit_template()
+    sub_script = sub_templ.safe_substitute(
+        user=user, server=server, remote_dir=remote_dir,
+        exec_line=exec_line.replace(REMOTE_ROOT, "$PWD"))
+    sub_file = os.path.join(write_dir, "submit_remote.sh")
+    with open(sub_file, "w") as f:
+        f.write(sub_script)
+    os.chmod(sub_file, 0o755)
+    print(sub_file)
+    return 0
+
+
 def _remote_submit_template():
     sub_templ = Template("""#!/bin/bash
 
@@ -84,6 +233,11 @@ def send_batch_ssh(command_string, config, force_clear=False):
         File with commands to execute.
     config: str
         ConfigParser configuration, read from file.
+
+    Returns
+    -------
+    int:
+        Zero if successful.
     """
 
     if "user" in config.options("CONNECTION"):
@@ -105,11 +259,21 @@ def send_batch_ssh(command_string, config, force_clear=False):
     new_config.remove_section("CONNECTION")
     new_config.set("BATCH_OPTIONS", "base_dir", remote_dir)
     new_config.set("BATCH_OPTIONS", "pre_post_file", remote_pp_file)
-    new_config_file = "remote_cfg.ini"
+    # The node setup file is copied, shared inputs are remote paths already.
+    if config.has_option("BATCH_OPTIONS", "setup_file"):
+        setup_file = config.get("BATCH_OPTIONS", "setup_file")
+        remote_setup_file = "remote_setup_{job_name}.sh".format(
+            job_name=job_name)
+        new_config.set("BATCH_OPTIONS", "setup_file", remote_setup_file)
+    else:
+        setup_file = None
+    # Job specific names, so that several jobs can be sent at the same time.
+    new_config_file = "remote_cfg_{job_name}.ini".format(job_name=job_name)
     with open(new_config_file, "w") as f:
         new_config.write(f)
 
-    new_command_file = "remote_command_script.sh"
+    new_command_file = "remote_command_script_{job_name}.sh".format(
+        job_name=job_name)
     with open(new_command_file, "w") as f:
         f.write(command_string)
 
@@ -120,14 +284,26 @@ def send_batch_ssh(command_string, config, force_clear=False):
                                        user=user, server=server,
                                        remote_cf=remote_dir,
                                        new_config_file=new_config_file)
-    # Copy pre_post_file to remote server.
-    subprocess.run(shlex.split(copy_command))
+    copy_commands = [copy_command]
 
+    # Copy pre_post_file to remote server.
     copy_command = "scp -q {pp_file} {user}{server}:{remote_pp_file}"
     copy_command = copy_command.format(pp_file=pre_post_file, user=user,
                                        server=server,
                                        remote_pp_file=long_remote_pp_file)
-    subprocess.run(shlex.split(copy_command))
+    copy_commands.append(copy_command)
+
+    if setup_file is not None:
+        copy_command = "scp -q {setup_file} {user}{server}:{remote_file}"
+        copy_command = copy_command.format(
+            setup_file=setup_file, user=user, server=server,
+            remote_file=os.path.join(remote_dir, remote_setup_file))
+        copy_commands.append(copy_command)
+    for copy_command in copy_commands:
+        if subprocess.run(shlex.split(copy_command)).returncode != 0:
+            print("Error: could not copy files to {server} ({command})."
+                  .format(server=server, command=copy_command))
+            return 1
 
     # SSH into the remote server and run batchgen with new config file.
     ssht = _ssh_template()
@@ -141,17 +317,17 @@ def send_batch_ssh(command_string, config, force_clear=False):
 
     # Check for error at remote server.
     error_msg, exec_line, info_msg = parse_remote_msg(msg)
-    if len(error_msg) != 0:
+    if len(error_msg) != 0 or res.returncode != 0:
         print("----- Remote error at {server} -----".format(server=server))
         print(msg)
         print("----- stderr -----")
         print(res.stderr.decode('utf-8'))
-        return
+        return 1
 
     # Output directory for script that remotely submits the script.
     output_dir = batch_dir(backend, job_name, remote=True)
     if not make_check_clean_directory(output_dir, force_clear=force_clear):
-        return
+        return 1
 
     sub_templ = _remote_submit_template()
     sub_script = sub_templ.safe_substitute(user=user, server=server,
@@ -165,3 +341,4 @@ def send_batch_ssh(command_string, config, force_clear=False):
     # Print instructions and info
     print(info_msg)
     print(sub_file)
+    return 0
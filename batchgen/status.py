@@ -0,0 +1,241 @@
+"""
+Progress of a running job, aggregated from the compact progress records
+that the task wrapper writes (see the progress option).
+
+@author: Raoul Schram
+"""
+
+import os
+import json
+import time
+import getpass
+import subprocess
+
+from batchgen.util import read_manifest, seconds_to_time
+from batchgen.backend.wrapper import PROGRESS_DIR, FAILED_EXT
+
+
+CACHE_FILE = ".status_cache.json"
+
+
+def _empty_cache():
+    return {"offsets": {}, "done": 0, "failed": 0, "running": {},
+            "lost": [], "first": None, "last": None}
+
+
+def _load_cache(progress_dir):
+    cache_file = os.path.join(progress_dir, CACHE_FILE)
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return _empty_cache()
+    if not isinstance(cache["running"], dict):
+        # Cache of an older version, without job ids.
+        cache["running"] = {key: "-" for key in cache["running"]}
+    cache.setdefault("lost", [])
+    return cache
+
+
+def _save_cache(progress_dir, cache):
+    cache_file = os.path.join(progress_dir, CACHE_FILE)
+    tmp_file = cache_file + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        # Not being able to cache is not fatal (e.g. read-only directory).
+        pass
+
+
+def active_jobs():
+    """ Job ids of the jobs of the user in the queue, None if squeue can't
+        be run.
+    """
+    try:
+        res = subprocess.run(["squeue", "-h", "-u", getpass.getuser(), "-o",
+                              "%A"], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if res.returncode:
+        return None
+    return set(res.stdout.decode("utf-8").split())
+
+
+def update_status(batch_dir, use_cache=True):
+    """ Aggregate the progress records of a batch directory.
+
+    Only the bytes that were added to the progress logs since the previous
+    call are read, using the cached offset per log. Tasks that started in a
+    SLURM job that is no longer in the queue, without an end record (e.g.
+    killed at the wall time), are counted as lost.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory of the job.
+    use_cache: bool
+        Start from the cached counts (otherwise read all records again).
+
+    Returns
+    -------
+    dict:
+        Status with the number of tasks that are done, failed, running, lost
+        and pending and the estimated time until all tasks are finished
+        (eta, in seconds, None if unknown).
+    """
+    progress_dir = os.path.join(batch_dir, PROGRESS_DIR)
+    cache = _load_cache(progress_dir) if use_cache else _empty_cache()
+    running = cache["running"]
+    lost = set(cache["lost"])
+
+    if os.path.isdir(progress_dir):
+        log_files = [name for name in os.listdir(progress_dir)
+                     if name.endswith(".log")]
+    else:
+        log_files = []
+
+    for log_file in log_files:
+        log_path = os.path.join(progress_dir, log_file)
+        offset = cache["offsets"].get(log_file, 0)
+        if os.path.getsize(log_path) <= offset:
+            continue
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # Only process complete records.
+        data = data[:data.rfind(b"\n")+1]
+        cache["offsets"][log_file] = offset + len(data)
+        for record in data.decode("utf-8").splitlines():
+            fields = record.split()
+            if len(fields) < 4:
+                continue
+            key = fields[1] + ":" + fields[2]
+            timestamp = int(fields[3])
+            if cache["first"] is None or timestamp < cache["first"]:
+                cache["first"] = timestamp
+            if cache["last"] is None or timestamp > cache["last"]:
+                cache["last"] = timestamp
+            if fields[0] == "S":
+                running[key] = fields[4] if len(fields) >= 5 else "-"
+                lost.discard(key)
+            elif fields[0] == "E" and len(fields) >= 5:
+                running.pop(key, None)
+                # The job ended right after the task.
+                lost.discard(key)
+                if fields[4] == "0":
+                    cache["done"] += 1
+                else:
+                    cache["failed"] += 1
+
+    job_ids = set(running.values()) - {"-"}
+    active = active_jobs() if job_ids else None
+    if active is not None:
+        for key, job_id in list(running.items()):
+            if job_id != "-" and job_id not in active:
+                del running[key]
+                lost.add(key)
+    cache["lost"] = sorted(lost)
+    if use_cache and os.path.isdir(progress_dir):
+        _save_cache(progress_dir, cache)
+
+    manifest = read_manifest(batch_dir) or {}
+    num_tasks = manifest.get("num_tasks", None)
+    n_finished = cache["done"] + cache["failed"]
+    status = {
+        "job_name": manifest.get("job_name", os.path.basename(batch_dir)),
+        "num_tasks": num_tasks,
+        "done": cache["done"],
+        "failed": cache["failed"],
+        "running": len(running),
+        "lost": len(lost),
+        "pending": None,
+        "eta": None,
+    }
+    if num_tasks is not None:
+        status["pending"] = max(0, num_tasks - n_finished - len(running) -
+                                len(lost))
+        if n_finished and cache["last"] > cache["first"]:
+            rate = n_finished/float(cache["last"] - cache["first"])
+            # Correct for the time since the last record.
+            since_last = time.time() - cache["last"]
+            status["eta"] = max(0, (num_tasks - n_finished)/rate - since_last)
+    return status
+
+
+def print_status(batch_dir, use_cache=True):
+    """ Command line version of update_status. """
+    if not os.path.isdir(batch_dir):
+        print("Error: batch directory {dir} does not exist.".format(
+            dir=batch_dir))
+        return 1
+    status = update_status(batch_dir, use_cache=use_cache)
+    unknown = "unknown"
+    if status["eta"] is None:
+        eta = unknown
+    else:
+        eta = seconds_to_time(status["eta"])
+    print("""\
+******************************************************
+**                   Job progress                   **
+******************************************************
+** Job name          : {job_name: <29}**
+** Number of tasks   : {num_tasks: <29}**
+** Done              : {done: <29}**
+** Failed            : {failed: <29}**
+** Running           : {running: <29}**
+** Lost (job ended)  : {lost: <29}**
+** Pending           : {pending: <29}**
+** Estimated to go   : {eta: <29}**
+******************************************************""".format(
+        job_name=status["job_name"],
+        num_tasks=str(unknown if status["num_tasks"] is None
+                      else status["num_tasks"]),
+        done=status["done"], failed=status["failed"],
+        running=status["running"], lost=status["lost"],
+        pending=str(unknown if status["pending"] is None
+                    else status["pending"]),
+        eta=eta))
+    return 0
+
+
+def failed_commands(batch_dir):
+    """ Commands of the tasks that failed after all retries (see the
+        retry_max option), in the order of the batches.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory of the job.
+
+    Returns
+    -------
+    list:
+        Failed commands, which can be used as the commands of a new run.
+    """
+    failed_files = []
+    for root, _, files in os.walk(batch_dir):
+        for file_name in files:
+            if not file_name.endswith(FAILED_EXT):
+                continue
+            batch_id = file_name[:-len(FAILED_EXT)].rsplit("_", 1)[-1]
+            failed_files.append((int(batch_id) if batch_id.isdigit() else -1,
+                                 os.path.join(root, file_name)))
+    commands = []
+    for _, failed_file in sorted(failed_files):
+        with open(failed_file, "r") as f:
+            commands.extend(line.rstrip("\n") for line in f if line.strip())
+    return commands
+
+
+def print_failed(batch_dir):
+    """ Command line version of failed_commands. """
+    if not os.path.isdir(batch_dir):
+        print("Error: batch directory {dir} does not exist.".format(
+            dir=batch_dir))
+        return 1
+    for command in failed_commands(batch_dir):
+        print(command)
+    return 0
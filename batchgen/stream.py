@@ -0,0 +1,159 @@
+"""
+Streaming mode: new commands are read continuously (from stdin, the tail
+of a file or a local socket) and packed into new batches of a job, when a
+batch is full or a time window expires.
+
+@author: Raoul Schram
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import configparser as cp
+import queue
+
+from batchgen.base import append_from_strings
+
+
+def batch_fill_size(config_file):
+    """ Number of commands that fill one batch of the job. """
+    config = cp.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    options = dict(config.items("BATCH_OPTIONS"))
+    for key in ["num_tasks_per_node", "num_cores_simul", "num_cores"]:
+        if key in options:
+            num_tasks = int(options[key])
+            break
+    else:
+        num_tasks = 16
+    return num_tasks*int(options.get("chunk_size", 1))
+
+
+def _read_lines(stream, lines):
+    """ Put the lines of a stream in the queue, None at the end. """
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def _read_tail(file_name, lines, poll_interval=0.5):
+    """ Put lines that are appended to a file in the queue (tail -f). """
+    with open(file_name, "r") as f:
+        f.seek(0, os.SEEK_END)
+        partial = ""
+        while True:
+            data = f.readline()
+            if not data:
+                time.sleep(poll_interval)
+                continue
+            partial += data
+            if partial.endswith("\n"):
+                lines.put(partial)
+                partial = ""
+
+
+def _read_connection(connection, lines):
+    """ Put the lines of one socket connection in the queue. """
+    with connection.makefile("r") as stream:
+        for line in stream:
+            lines.put(line)
+    connection.close()
+
+
+def _read_socket(socket_file, lines):
+    """ Put the lines sent to a (unix) socket in the queue. """
+    if os.path.exists(socket_file):
+        os.unlink(socket_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_file)
+    server.listen(8)
+    while True:
+        connection = server.accept()[0]
+        reader = threading.Thread(target=_read_connection,
+                                  args=(connection, lines))
+        reader.daemon = True
+        reader.start()
+
+
+def stream_batches(config_file, input_file=None, socket_file=None,
+                   window=60, fill_size=None, submit=False):
+    """ Read new commands and append them to the job as batches.
+
+    A batch is written when it is full (fill_size commands), or when the
+    oldest pending command has waited for the time window.
+
+    Arguments
+    ---------
+    config_file: str
+        Configuration file of the job.
+    input_file: str
+        File to follow (new lines only), stdin if neither this nor the
+        socket is given.
+    socket_file: str
+        Unix socket to listen on for commands.
+    window: float
+        Maximum time [s] a command waits before it is written in a batch.
+    fill_size: int
+        Number of commands per batch, default from the configuration.
+    submit: bool
+        Submit every new batch.
+
+    Returns
+    -------
+    int:
+        Zero if all batches were written successfully.
+    """
+    if fill_size is None:
+        fill_size = batch_fill_size(config_file)
+    lines = queue.Queue()
+    if socket_file is not None:
+        reader = threading.Thread(target=_read_socket,
+                                  args=(socket_file, lines))
+    elif input_file is not None:
+        reader = threading.Thread(target=_read_tail, args=(input_file, lines))
+    else:
+        reader = threading.Thread(target=_read_lines,
+                                  args=(sys.stdin, lines))
+    reader.daemon = True
+    reader.start()
+
+    pending = []
+    first_time = None
+    ret = 0
+    finished = False
+    while not finished:
+        timeout = None
+        if pending:
+            timeout = max(0, first_time + window - time.time())
+        try:
+            line = lines.get(timeout=timeout)
+        except queue.Empty:
+            line = ""
+        except KeyboardInterrupt:
+            line = None
+        if line is None:
+            finished = True
+        elif line.strip():
+            if not pending:
+                first_time = time.time()
+            pending.append(line.strip())
+
+        while len(pending) >= fill_size:
+            ret |= _flush(pending[:fill_size], config_file, submit)
+            pending = pending[fill_size:]
+            first_time = time.time()
+        expired = pending and time.time() >= first_time + window
+        if pending and (finished or expired):
+            ret |= _flush(pending, config_file, submit)
+            pending = []
+    return ret
+
+
+def _flush(commands, config_file, submit):
+    print("Appending {n} command(s).".format(n=len(commands)))
+    sys.stdout.flush()
+    return append_from_strings("\n".join(commands) + "\n", config_file,
+                               submit)
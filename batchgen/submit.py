@@ -0,0 +1,386 @@
+"""
+Submit the batches of a job without exceeding the limits of the site:
+the number of jobs a user may have in the queue (MaxSubmitJobs) and the
+size of job arrays (MaxArraySize).
+
+Batches with the same #SBATCH directives are submitted together as job
+arrays. The number of queued jobs is kept under the limit, and more
+batches are submitted as earlier jobs finish. Which batches have been
+submitted is kept in a state file, so that the submitter can be stopped
+and started again.
+
+@author: Raoul Schram
+"""
+
+import os
+import re
+import json
+import time
+import shlex
+import getpass
+import subprocess
+
+from batchgen.util import read_manifest, batch_files
+from batchgen.backend.wrapper import _subdir_line
+
+
+SUBMIT_DIR = "submit"
+STATE_FILE = "state.json"
+# Default of SLURM.
+DEFAULT_MAX_ARRAY_SIZE = 1001
+# Filename patterns of sbatch in the redirections of an array launcher.
+PATTERN_VARIABLES = {"a": "${batch_id}", "N": "${SLURMD_NODENAME}",
+                     "j": "${SLURM_JOB_ID}", "x": "${SLURM_JOB_NAME}",
+                     "A": "${SLURM_ARRAY_JOB_ID}", "u": "${USER}", "%": "%"}
+
+
+def _run(command):
+    """ Output of a command, None if it failed. """
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if res.returncode:
+        return None
+    return res.stdout.decode("utf-8")
+
+
+def probe_limits():
+    """ Limits of the site: MaxSubmitJobs of the association of the user
+        (sacctmgr) and MaxArraySize (scontrol show config).
+
+    Returns
+    -------
+    int:
+        Maximum number of queued jobs, None if unknown or unlimited.
+    int:
+        Maximum size of a job array, None if unknown.
+    """
+    max_jobs = None
+    output = _run(["sacctmgr", "-n", "-P", "show", "assoc",
+                   "where", "user=" + getpass.getuser(),
+                   "format=MaxSubmit"])
+    if output is not None:
+        limits = [int(line) for line in output.split() if line.isdigit()]
+        if limits:
+            max_jobs = min(limits)
+    max_array_size = None
+    output = _run(["scontrol", "show", "config"])
+    if output is not None:
+        match = re.search(r"^MaxArraySize\s*=\s*(\d+)", output, re.M)
+        if match:
+            max_array_size = int(match.group(1))
+    return max_jobs, max_array_size
+
+
+def submit_limits(manifest, max_jobs=None, max_array_size=None):
+    """ Limits from the command line, the configuration (manifest) or the
+        site, in that order.
+    """
+    if max_jobs is None:
+        max_jobs = manifest.get("max_submit_jobs")
+    if max_array_size is None:
+        max_array_size = manifest.get("max_array_size")
+    if max_jobs is None or max_array_size is None:
+        site_jobs, site_array_size = probe_limits()
+        if max_jobs is None:
+            max_jobs = site_jobs
+        if max_array_size is None:
+            max_array_size = site_array_size
+    if max_array_size is None:
+        max_array_size = DEFAULT_MAX_ARRAY_SIZE
+    return (None if max_jobs is None else int(max_jobs),
+            int(max_array_size))
+
+
+def _directives(batch_file):
+    """ The #SBATCH lines at the start of a batch script. """
+    directives = []
+    with open(batch_file, "r") as f:
+        for line in f:
+            if line.startswith("#SBATCH"):
+                directives.append(line.strip())
+            elif line.strip() and not line.startswith("#"):
+                break
+    return directives
+
+
+def batch_groups(batch_dir, manifest):
+    """ Group the batches by their #SBATCH directives. The batch id in the
+        output/error files is replaced by %a.
+
+    Returns
+    -------
+    list:
+        Normalized directives of every group.
+    dict:
+        Batch id -> group (index in the list of directives).
+    """
+    groups = []
+    group_of = {}
+    for batch_id, batch_file in enumerate(batch_files(batch_dir, manifest)):
+        directives = tuple(
+            line.replace("_{i}.".format(i=batch_id), "_%a.")
+            if line.startswith(("#SBATCH --output=", "#SBATCH --error="))
+            else line for line in _directives(batch_file))
+        if directives not in groups:
+            groups.append(directives)
+        group_of[batch_id] = groups.index(directives)
+    return groups, group_of
+
+
+def _redirect_path(pattern):
+    """ Filename pattern of sbatch as a (double quoted) shell word. """
+    path = re.sub(r'(["$`\\])', r"\\\1", pattern)
+    # The variables are filled in after escaping.
+    return '"' + re.sub(r"%([aNjxAu%])",
+                        lambda match: PATTERN_VARIABLES[match.group(1)],
+                        path) + '"'
+
+
+def launcher_string(batch_dir, directives, shard_size=None):
+    """ Script that runs a batch as an element of a job array: the batch
+        id is the offset (first argument) plus the array index.
+    """
+    options = {}
+    lines = []
+    for line in directives:
+        match = re.match(r"#SBATCH (--output|--error)=(.*)", line)
+        if match:
+            options[match.group(1)] = match.group(2)
+        else:
+            lines.append(line)
+    mode = ">>" if "#SBATCH --open-mode=append" in lines else ">"
+    output = mode + " " + _redirect_path(options.get("--output",
+                                                     "/dev/null"))
+    if options.get("--error", options.get("--output")) == \
+            options.get("--output"):
+        error = "2>&1"
+    else:
+        error = "2" + mode + " " + _redirect_path(options["--error"])
+    return """\
+#!/bin/bash
+{directives}
+#SBATCH --output=/dev/null
+#SBATCH --error=/dev/null
+# Job array of batches generated by batchgen.
+
+batch_dir={batch_dir}
+batch_id=$(( $1 + SLURM_ARRAY_TASK_ID ))
+{batch_subdir}
+exec bash "$batch_subdir/batch_$batch_id.sh" {output} {error}
+""".format(directives="\n".join(lines), batch_dir=shlex.quote(batch_dir),
+           batch_subdir=_subdir_line({"shard_size": shard_size}),
+           output=output, error=error)
+
+
+def plan_round(group_of, submitted, room, max_array_size):
+    """ Batches to submit now, in order of their batch id.
+
+    Consecutive batches of the same group become one job array, of which
+    the indices (batch id minus the first one) are less than
+    max_array_size.
+
+    Arguments
+    ---------
+    group_of: dict
+        Batch id -> group.
+    submitted: iterable
+        Batch ids that were submitted already.
+    room: int
+        Number of jobs that can still be queued, None for no limit.
+    max_array_size: int
+        MaxArraySize of the site.
+
+    Returns
+    -------
+    list:
+        Lists of batch ids, one per submission.
+    """
+    submitted = set(submitted)
+    remaining = [batch_id for batch_id in sorted(group_of)
+                 if batch_id not in submitted]
+    if room is None:
+        room = len(remaining)
+    chunks = []
+    i = 0
+    while i < len(remaining) and room > 0:
+        chunk = [remaining[i]]
+        i += 1
+        while (i < len(remaining) and len(chunk) < room and
+               group_of[remaining[i]] == group_of[chunk[0]] and
+               remaining[i] - chunk[0] < max_array_size):
+            chunk.append(remaining[i])
+            i += 1
+        chunks.append(chunk)
+        room -= len(chunk)
+    return chunks
+
+
+def _array_spec(indices):
+    """ Array specification of sbatch, e.g. 0-3,5. """
+    ranges = []
+    for index in indices:
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(str(first) if first == last else
+                    "{f}-{l}".format(f=first, l=last)
+                    for first, last in ranges)
+
+
+def queued_jobs():
+    """ Number of jobs of the user in the queue (array elements count
+        separately), None if squeue can't be run.
+    """
+    output = _run(["squeue", "-h", "-r", "-u", getpass.getuser(),
+                   "-o", "%i"])
+    if output is None:
+        return None
+    return len(output.splitlines())
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {"submitted": {}}
+
+
+def _save_state(state_file, state):
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(state_file + ".tmp", state_file)
+
+
+def _submit(command):
+    """ Submit with sbatch, returns the job id or None. """
+    try:
+        res = subprocess.run(["sbatch", "--parsable"] + command,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("Warning: sbatch failed: {e}".format(e=e))
+        return None
+    if res.returncode:
+        print("Warning: sbatch failed: {err}".format(
+            err=res.stderr.decode("utf-8").strip()))
+        return None
+    return res.stdout.decode("utf-8").strip().split(";")[0]
+
+
+def submit_round(batch_dir, manifest, groups, state, max_jobs,
+                 max_array_size):
+    """ Submit as many batches as the limits allow now.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory of the job.
+    manifest: dict
+        Manifest of the batch directory.
+    groups: tuple
+        Groups of the batches (see batch_groups).
+    state: dict
+        Submitted batches (batch id -> job id), is updated and saved.
+    max_jobs: int
+        Maximum number of queued jobs, None for no limit.
+    max_array_size: int
+        Maximum size of a job array.
+
+    Returns
+    -------
+    int:
+        Number of batches submitted, None if the queue can't be read.
+    """
+    submit_dir = os.path.join(batch_dir, SUBMIT_DIR)
+    groups, group_of = groups
+    files = batch_files(batch_dir, manifest)
+    room = None
+    if max_jobs is not None:
+        queued = queued_jobs()
+        if queued is None:
+            return None
+        room = max_jobs - queued
+    submitted = state["submitted"]
+    n_submitted = 0
+    for chunk in plan_round(group_of, [int(batch_id) for batch_id in
+                                       submitted], room, max_array_size):
+        if len(chunk) == 1:
+            job_id = _submit([files[chunk[0]]])
+            job_ids = [job_id]
+        else:
+            launcher = os.path.join(submit_dir, "array_{g}.sh".format(
+                g=group_of[chunk[0]]))
+            if not os.path.isfile(launcher):
+                with open(launcher, "w") as f:
+                    f.write(launcher_string(batch_dir,
+                                            groups[group_of[chunk[0]]],
+                                            manifest.get("shard_size")))
+            indices = [batch_id - chunk[0] for batch_id in chunk]
+            job_id = _submit(["--array=" + _array_spec(indices), launcher,
+                              str(chunk[0])])
+            job_ids = ["{id}_{i}".format(id=job_id, i=index)
+                       for index in indices]
+        if job_id is None:
+            # E.g. other jobs of the user took the room, try again later.
+            break
+        for batch_id, job in zip(chunk, job_ids):
+            submitted[str(batch_id)] = job
+        n_submitted += len(chunk)
+        _save_state(os.path.join(submit_dir, STATE_FILE), state)
+    return n_submitted
+
+
+def drip_feed(batch_dir, max_jobs=None, max_array_size=None, interval=60,
+              once=False):
+    """ Submit all batches of a job within the queue limits of the site.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory of the job (slurm_lisa backend).
+    max_jobs: int
+        Maximum number of queued jobs of the user (default: max_submit_jobs
+        in the configuration, or MaxSubmitJobs of the site).
+    max_array_size: int
+        Maximum size of a job array (default: max_array_size in the
+        configuration, or MaxArraySize of the site).
+    interval: float
+        Time [s] between checks of the queue.
+    once: bool
+        Only submit what fits now, e.g. when run periodically.
+
+    Returns
+    -------
+    int:
+        Zero if successful.
+    """
+    manifest = read_manifest(batch_dir)
+    if manifest is None or manifest["backend"] != "slurm_lisa":
+        print("Error: no SLURM batches (manifest) in {dir}.".format(
+            dir=batch_dir))
+        return 1
+    max_jobs, max_array_size = submit_limits(manifest, max_jobs,
+                                             max_array_size)
+    submit_dir = os.path.join(batch_dir, SUBMIT_DIR)
+    if not os.path.isdir(submit_dir):
+        os.makedirs(submit_dir)
+    state_file = os.path.join(submit_dir, STATE_FILE)
+    state = _load_state(state_file)
+    num_batches = manifest["num_batches"]
+    groups = batch_groups(batch_dir, manifest)
+    while True:
+        n_submitted = submit_round(batch_dir, manifest, groups, state,
+                                   max_jobs, max_array_size)
+        if n_submitted is None:
+            print("Error: could not read the queue (squeue).")
+            return 1
+        print("Submitted {n} batch(es), {total}/{num} in total.".format(
+            n=n_submitted, total=len(state["submitted"]), num=num_batches))
+        if once or len(state["submitted"]) >= num_batches:
+            return 0
+        time.sleep(interval)
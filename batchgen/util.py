@@ -6,6 +6,11 @@ Some helpful functions.
 
 import os
 import re
+import json
+import shlex
+
+
+MANIFEST_FILE = "manifest.json"
 
 
 def _read_file(script):
@@ -51,6 +56,139 @@ def _split_commands(script):
     return real_commands
 
 
+def _chunk_size(param):
+    """ Number of commands to group into one task.
+
+    Arguments
+    ---------
+    param: dict
+        Parameters from the configuration file. Either chunk_size is given
+        directly, or it is estimated from the target duration of a task
+        (chunk_time) and the estimated duration of a command (task_time),
+        both in seconds.
+
+    Returns
+    -------
+    int:
+        Number of commands per task (1 means no grouping).
+    """
+    if "chunk_size" in param:
+        return max(1, int(param["chunk_size"]))
+    if "chunk_time" in param and "task_time" in param:
+        task_time = max(float(param["task_time"]), 1e-3)
+        return max(1, int(float(param["chunk_time"]) // task_time))
+    return 1
+
+
+def _chunk_commands(commands, chunk_size, dollar="$"):
+    """ Group consecutive commands into compound tasks.
+
+    Every command in a compound task is executed in its own subshell, even
+    if a previous one fails. Failing commands are reported on stderr with
+    their (1-based) command number and exit code, and appended to the file
+    in _BG_FAILED (if set). The task fails if any command failed. Commands
+    are quoted and run with eval, so that e.g. a trailing comment doesn't
+    end the compound task.
+
+    Arguments
+    ---------
+    commands: list
+        List of commands.
+    chunk_size: int
+        Number of commands per compound task.
+    dollar: str
+        How to write a dollar sign, use "\\$" inside unquoted here-documents.
+
+    Returns
+    -------
+    list:
+        List of (compound) tasks.
+    """
+    if chunk_size <= 1:
+        return list(commands)
+
+    report = ("{{ echo \"batchgen: command {i} failed with exit code {d}?\""
+              " >&2; _bg_fail=1; printf '%s\\n' \"{d}_bg_c\" >> "
+              "\"{d}{{_BG_FAILED:-/dev/null}}\"; }}")
+    tasks = []
+    for start in range(0, len(commands), chunk_size):
+        parts = ["_bg_fail=0"]
+        for i, command in enumerate(commands[start:start+chunk_size]):
+            quoted = "'" + command.strip().replace("'", "'\\''") + "'"
+            parts.append("_bg_c={command}".format(command=quoted))
+            parts.append("( eval \"{d}_bg_c\" ) || ".format(d=dollar)
+                         + report.format(i=start+i+1, d=dollar))
+        parts.append("[ {d}_bg_fail -eq 0 ]".format(d=dollar))
+        tasks.append("; ".join(parts))
+    return tasks
+
+
+def _remove_duplicates(commands):
+    """ Remove duplicate commands, keeping the first occurrence.
+
+    Returns
+    -------
+    list:
+        Indices of the commands to keep.
+    """
+    seen = set()
+    keep = []
+    for i, command in enumerate(commands):
+        key = command.strip()
+        if key not in seen:
+            seen.add(key)
+            keep.append(i)
+    return keep
+
+
+def _common_prefix(commands, min_length=16):
+    """ Longest common prefix of the commands that ends at a word boundary,
+        and can be safely put in a shell function (no control operators,
+        balanced quotes, nothing to expand).
+
+    Arguments
+    ---------
+    commands: list
+        List of commands.
+    min_length: int
+        Minimum length of the prefix to be worth factoring out.
+
+    Returns
+    -------
+    str:
+        Common prefix, empty if there is none.
+    """
+    if len(commands) < 2:
+        return ""
+    prefix = os.path.commonprefix(commands)
+    at_boundary = all(len(command) == len(prefix) or
+                      command[len(prefix)].isspace() for command in commands)
+    if not at_boundary:
+        prefix = prefix[:max(prefix.rfind(" "), prefix.rfind("\t"), 0)]
+    # Variables and command substitutions stay in the commands: in a batch
+    # script they are expanded by the batch shell, in the function only by
+    # the shell of the task (without unexported variables).
+    expanded = [i for i in (prefix.find("$"), prefix.find("`")) if i >= 0]
+    if expanded:
+        end = min(expanded)
+        prefix = prefix[:max(prefix.rfind(" ", 0, end),
+                             prefix.rfind("\t", 0, end), 0)]
+    prefix = prefix.rstrip()
+    if len(prefix) < min_length or prefix.startswith("#") or " #" in prefix:
+        return ""
+
+    try:
+        lexer = shlex.shlex(prefix, posix=True, punctuation_chars=True)
+        lexer.commenters = ""
+        tokens = list(lexer)
+    except ValueError:
+        return ""
+    if any(token and all(char in "();<>|&" for char in token)
+           for token in tokens):
+        return ""
+    return prefix
+
+
 def _check_files(*args):
     """ Check if files exist.
 
@@ -74,6 +212,91 @@ def _check_files(*args):
     return n_error
 
 
+def write_manifest(batch_dir, manifest):
+    """ Write the manifest (description of the generated batches).
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory.
+    manifest: dict
+        Information on the batches (job_name, backend, num_tasks, ...).
+    """
+    manifest_file = os.path.join(batch_dir, MANIFEST_FILE)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(manifest_file + ".tmp", manifest_file)
+
+
+def read_manifest(batch_dir):
+    """ Read the manifest of a batch directory, None if it doesn't exist. """
+    manifest_file = os.path.join(batch_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def shard_size(param):
+    """ Number of batches per subdirectory (None for the flat layout). """
+    if param.get("layout", "flat").strip().lower() != "sharded":
+        return None
+    return int(param.get("shard_size", 1000))
+
+
+def batch_subdir(batch_dir, batch_id, shard_size=None):
+    """ Directory for the files of a batch.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory.
+    batch_id: int
+        Number of the batch.
+    shard_size: int
+        Number of batches per subdirectory, None for a flat layout.
+
+    Returns
+    -------
+    str:
+        The batch directory itself (flat layout), or its subdirectory
+        shard_XXXX (sharded layout).
+    """
+    if not shard_size:
+        return batch_dir
+    return os.path.join(batch_dir, "shard_{shard:04d}".format(
+        shard=batch_id // shard_size))
+
+
+def batch_file_path(batch_dir, batch_id, shard_size=None):
+    """ Location of a SLURM batch script. """
+    return os.path.join(batch_subdir(batch_dir, batch_id, shard_size),
+                        "batch_" + str(batch_id) + ".sh")
+
+
+def batch_files(batch_dir, manifest=None):
+    """ Locations of all batch scripts of a batch directory, in order.
+
+    Arguments
+    ---------
+    batch_dir: str
+        Batch directory.
+    manifest: dict
+        Manifest of the batch directory, read if not supplied.
+
+    Returns
+    -------
+    list:
+        Batch scripts.
+    """
+    if manifest is None:
+        manifest = read_manifest(batch_dir)
+    if manifest["backend"] == "parallel":
+        return [os.path.join(batch_dir, "batch.sh")]
+    return [batch_file_path(batch_dir, batch_id, manifest.get("shard_size"))
+            for batch_id in range(manifest["num_batches"])]
+
+
 def batch_dir(backend, job_name, remote=False):
     """ Return a directory from the backend/job_name/remote. """
     if remote:
@@ -83,6 +306,38 @@ def batch_dir(backend, job_name, remote=False):
     return os.path.abspath(new_dir)
 
 
+def _is_true(value):
+    """ Interpret a boolean option from the configuration file. """
+    return str(value).strip().lower() in ("true", "yes", "on", "1")
+
+
+def time_to_seconds(clock_wall_time):
+    """ Convert a time in hh:mm:ss format to seconds. """
+    seconds = 0
+    for part in clock_wall_time.split(":"):
+        seconds = 60*seconds + int(part)
+    return seconds
+
+
+def seconds_to_time(seconds):
+    """ Convert a number of seconds to hh:mm:ss format (rounding up). """
+    seconds = int(-(-seconds // 1))
+    return "{hh:02d}:{mm:02d}:{ss:02d}".format(
+        hh=seconds // 3600, mm=(seconds // 60) % 60, ss=seconds % 60)
+
+
+def memory_to_kb(memory):
+    """ Convert a memory size (e.g. 4G, 500M, 1024K) to kilobytes.
+
+    Without a suffix, megabytes are assumed (as in SLURM).
+    """
+    memory = str(memory).strip().upper().rstrip("B")
+    factors = {"K": 1, "M": 1024, "G": 1024**2, "T": 1024**3}
+    if memory and memory[-1] in factors:
+        return int(float(memory[:-1])*factors[memory[-1]])
+    return int(float(memory)*1024)
+
+
 def mult_time(clock_wall_time, mult):
     """ Multiply times in hh:mm:ss by some multiplier.
 
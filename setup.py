@@ -37,14 +37,13 @@ setup(
         # Pick your license as you wish
         'License :: OSI Approved :: MIT License',
 
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
     keywords='batch systems parallelization',
+    python_requires='>=3.6',
     packages=find_packages(exclude=['samples']),
 
     install_requires=[],
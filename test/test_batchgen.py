@@ -5,11 +5,21 @@ Module for testing the batchgen package as a whole.
 """
 
 import os
+import re
+import sys
+import time
+import subprocess
+import threading
 import configparser as cp
 
+import batchgen
 from batchgen import batch_from_files, batch_from_strings
+from batchgen.base import append_from_strings
 from batchgen.base import _read_pre_post_file
-from batchgen.util import batch_dir
+from batchgen.util import batch_dir, batch_files, read_manifest
+from batchgen.backend.hpc import lock_batch_directory, swap_directory
+from batchgen.memo import evict
+from batchgen.logs import task_output
 
 
 def _config_slurm_local():
@@ -265,3 +275,628 @@ def test_slurm_local_file(tmpdir):
               False, True)
     string_test(command_string, config, pre_post_input, batch_expected, tmpdir,
                 True)
+
+
+def test_node_cache(tmpdir):
+    """ Test that shared inputs/setup are prepared only once per node. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("reference.dat", "w") as f:
+        f.write("1 2 3\n")
+    with open("setup.sh", "w") as f:
+        f.write("echo x >> {tdir}/setup_count\ncat reference.dat > copy.dat\n"
+                .format(tdir=tdir))
+    config = _config_parallel() + """\
+shared_inputs = reference.dat
+setup_file = setup.sh
+node_cache_dir = {tdir}/node_cache
+""".format(tdir=tdir)
+    with open("config.ini", "w") as f:
+        f.write(config)
+
+    batch_from_strings(_commands(), "config.ini")
+    with open(os.path.join(batch_dir("parallel", "my_test"), "batch.sh")) as f:
+        batch_content = f.read()
+    cache_str = batch_content.split("\n\n")[1]
+    assert cache_str.startswith("# Node-local cache")
+
+    # Running twice (warm node) should only do the setup once.
+    for _ in range(2):
+        res = subprocess.run(["bash", "-c",
+                              cache_str + "\necho $BATCHGEN_CACHE"],
+                             stdout=subprocess.PIPE)
+        assert res.returncode == 0
+    cache_dir = res.stdout.decode("utf-8").strip()
+    with open(os.path.join(cache_dir, "copy.dat")) as f:
+        assert f.read() == "1 2 3\n"
+    with open("setup_count") as f:
+        assert f.read() == "x\n"
+
+
+def test_chunking(tmpdir):
+    """ Test grouping of tiny commands into compound tasks. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "chunk_time = 10\ntask_time = 2\n")
+    batch_from_strings(_commands(), "config.ini")
+    with open(os.path.join(batch_dir("slurm_lisa", "asr_sim"),
+                           "batch_0.sh")) as f:
+        batch_content = f.read()
+    body = batch_content.split("<< EOF_PARALLEL\n")[1].split("EOF_PARALLEL")[0]
+    tasks = body.rstrip("\n").split("\n")
+    assert len(tasks) == 3
+    assert "command 14 failed" in tasks[2]
+    assert "\\$_bg_fail" in tasks[0]
+
+    # Failing commands are reported, but the others are still executed.
+    with open("config.ini", "w") as f:
+        f.write(_config_parallel() + "chunk_size = 3\n")
+    # A trailing comment doesn't end the compound task.
+    batch_from_strings("true # first\nexit 3\necho 'ok'\n", "config.ini",
+                       force_clear=True)
+    with open(os.path.join(batch_dir("parallel", "my_test"),
+                           "commands.sh")) as f:
+        task = f.read()
+    res = subprocess.run(["bash", "-c", task], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    assert res.returncode != 0
+    assert res.stdout.decode("utf-8") == "ok\n"
+    assert res.stderr.decode("utf-8") == \
+        "batchgen: command 2 failed with exit code 3\n"
+
+
+def test_compaction(tmpdir):
+    """ Test removal of duplicates and factoring of the common prefix. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_parallel() + "compact = True\n")
+    commands = ("echo 'the common prefix' run 1\n"
+                "echo 'the common prefix' run 2\n"
+                "echo 'the common prefix' run 1\n"
+                "echo 'the common prefix' run 3\n")
+    batch_from_strings(commands, "config.ini")
+    my_dir = batch_dir("parallel", "my_test")
+    with open(os.path.join(my_dir, "commands.sh")) as f:
+        tasks = f.read()
+    with open(os.path.join(my_dir, "batch.sh")) as f:
+        batch_content = f.read()
+    assert tasks == "_bg_cmd 1\n_bg_cmd 2\n_bg_cmd 3"
+    prelude = batch_content.split("parallel ")[0]
+    res = subprocess.run(["bash", "-c", prelude + tasks],
+                         stdout=subprocess.PIPE)
+    assert res.stdout.decode("utf-8") == \
+        "".join("the common prefix run {i}\n".format(i=i) for i in [1, 2, 3])
+
+    # A prefix with control operators is not factored out.
+    batch_from_strings("cd /tmp/some/long/dir; echo 1\n"
+                       "cd /tmp/some/long/dir; echo 2\n", "config.ini",
+                       force_clear=True)
+    with open(os.path.join(my_dir, "commands.sh")) as f:
+        assert f.read().startswith("cd /tmp")
+
+    # Variables of the pre-commands are expanded by the batch shell.
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "compact = True\n")
+    commands = "".join("./simulate --model big --data $DATA --seed {i}\n"
+                       .format(i=i) for i in range(3))
+    batch_from_strings(commands, "config.ini", pre_com_string="DATA=/x\n")
+    batch_file = os.path.join(batch_dir("slurm_lisa", "asr_sim"),
+                              "batch_0.sh")
+    with open(batch_file) as f:
+        batch_content = f.read()
+    assert "_bg_cmd() { ./simulate --model big --data \"$@\"; }" in \
+        batch_content
+    assert "sleep 1; _bg_cmd $DATA --seed 1\n" in batch_content
+    script = batch_content.split("\nparallel ")[0] + \
+        "\ncat << EOF\n_bg_cmd $DATA --seed 1\nEOF\n"
+    res = subprocess.run(["bash", "-c", script], stdout=subprocess.PIPE)
+    assert res.stdout.decode("utf-8").endswith("_bg_cmd /x --seed 1\n")
+
+
+def test_memory_concurrency(tmpdir):
+    """ Test limiting the number of simultaneous tasks by memory. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() +
+                "mem_per_task = 10G\nmem_per_node = 32G\n")
+    batch_from_strings(_commands(), "config.ini")
+    with open(os.path.join(batch_dir("slurm_lisa", "asr_sim"),
+                           "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert "#SBATCH --mem=32G\n\n" in batch_content
+    assert "parallel -j 3 --memfree 10485760K << EOF_PARALLEL" in \
+        batch_content
+    assert "sleep 3; " not in batch_content
+
+
+def test_cpu_binding(tmpdir):
+    """ Test binding of tasks to a fixed set of cores per job slot. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() +
+                "cpu_bind = taskset\ncores_per_task = 2\n")
+    batch_from_strings(_commands(), "config.ini")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        assert "parallel -j 8 {wrapper} 0 {{#}} {{%}} {{}} << EOF".format(
+            wrapper=wrapper) in f.read()
+
+    cpus = sorted(os.sched_getaffinity(0))
+    slot = 2
+    first = (slot-1)*2 % len(cpus)
+    expected = ",".join(str(cpu) for cpu in cpus[first:first+2])
+    res = subprocess.run(
+        [wrapper, "0", "1", str(slot),
+         "echo $OMP_NUM_THREADS; taskset -pc $$ | sed 's/.*: //'"],
+        stdout=subprocess.PIPE)
+    threads, affinity = res.stdout.decode("utf-8").split()
+    assert threads == "2"
+    assert affinity.replace("-", ",") == expected
+
+    # Without a list of cores, the task runs without binding.
+    os.makedirs("bin")
+    with open(os.path.join("bin", "taskset"), "w") as f:
+        f.write("#!/bin/bash\necho \"pid $2's current affinity list: \"\n")
+    os.chmod(os.path.join("bin", "taskset"), 0o755)
+    env = dict(os.environ, PATH=os.path.abspath("bin") + os.pathsep +
+               os.environ["PATH"])
+    res = subprocess.run([wrapper, "0", "1", str(slot), "echo ok"],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    assert res.returncode == 0
+    assert res.stdout.decode("utf-8") == "ok\n"
+
+
+def test_sharded_layout(tmpdir):
+    """ Test the bucketed subdirectory layout for many batches. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local().replace("num_tasks_per_node = 30",
+                                              "num_tasks_per_node = 2") +
+                "layout = sharded\nshard_size = 2\n")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    for force_clear in [False, True]:
+        batch_from_strings(_commands(), "config.ini",
+                           force_clear=force_clear)
+        files = batch_files(out_dir)
+        assert len(files) == 7
+        assert files[5] == os.path.join(out_dir, "shard_0002", "batch_5.sh")
+        assert all(os.path.isfile(batch_file) for batch_file in files)
+        assert sorted(os.listdir(out_dir)) == [
+            "manifest.json", "shard_0000", "shard_0001", "shard_0002",
+            "shard_0003"]
+    with open(files[5]) as f:
+        assert "#SBATCH --output={dir}/shard_0002/asr_sim_5.out\n".format(
+            dir=out_dir) in f.read()
+
+
+def test_multi_node(tmpdir):
+    """ Test batches with several nodes, with srun job steps. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "nodes_per_job = 2\n")
+    batch_from_strings(_commands(), "config.ini")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    assert sorted(os.listdir(out_dir)) == ["batch_0.sh", "manifest.json"]
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert "#SBATCH --nodes=1\n" in batch_content
+    assert "parallel -j 15 srun --exclusive -N1 -n1 -c 2 bash -c {} <<" \
+        in batch_content
+
+    commands = "".join("echo {i}\n".format(i=i) for i in range(70))
+    batch_from_strings(commands, "config.ini", force_clear=True)
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert "#SBATCH --nodes=2\n" in batch_content
+    assert "parallel -j 30 srun" in batch_content
+    assert batch_content.count("sleep") == 15
+    with open(os.path.join(out_dir, "batch_1.sh")) as f:
+        assert "#SBATCH --nodes=1\n" in f.read()
+
+    # Pre-commands once per node, job steps with their share of memory.
+    with open("config.ini", "a") as f:
+        f.write("mem_per_node = 60G\n")
+    batch_from_strings(commands, "config.ini", pre_com_string="echo pre\n",
+                       force_clear=True)
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert batch_content.count("echo pre\n") == 2
+    assert "srun --nodes=$((SLURM_NNODES-1)) --ntasks-per-node=1" \
+        in batch_content
+    assert "srun --exclusive -N1 -n1 -c 2 --mem=4194304K bash -c {}" \
+        in batch_content
+
+
+def test_backfill_shaping(tmpdir, capsys):
+    """ Test shaping the batches for the holes in a cluster snapshot. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("snapshot.txt", "w") as f:
+        f.write("""## SINFO ##
+node1 idle
+node2 idle
+node3 idle
+node4 allocated
+## SQUEUE_START ##
+2026-10-19T12:30:00 1
+2026-10-19T13:00:00 2
+N/A 4
+## NOW ##
+2026-10-19T12:00:00
+""")
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + """nodes_per_job = 2
+task_time = 600
+history_margin = 1
+backfill = True
+backfill_snapshot = {tdir}/snapshot.txt
+""".format(tdir=tdir))
+    commands = "".join("echo {i}\n".format(i=i) for i in range(250))
+    batch_from_strings(commands, "config.ini")
+    summary = capsys.readouterr().out
+    for shape in ["1x 1N 00:30:00 45 tasks", "1x 2N 01:00:00 180 tasks",
+                  "1x 1N 02:00:00 25 tasks"]:
+        assert "** Batch shape       : {shape: <29}**\n".format(
+            shape=shape) in summary
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    assert read_manifest(out_dir)["num_batches"] == 3
+    shapes = [("01:00:00", 2, 180), ("00:30:00", 1, 45), ("02:00:00", 1, 25)]
+    for batch_id, (wall_time, num_nodes, num_tasks) in enumerate(shapes):
+        with open(os.path.join(out_dir, "batch_{i}.sh".format(i=batch_id))) \
+                as f:
+            batch_content = f.read()
+        assert "#SBATCH -t {wall}\n".format(wall=wall_time) in batch_content
+        assert "#SBATCH --nodes={n}\n".format(n=num_nodes) in batch_content
+        assert len(re.findall(r"echo \d+\n", batch_content)) == num_tasks
+
+
+def test_speculation(tmpdir):
+    """ Test that the first copy of a task to finish wins. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "speculate = True\njoblog = True\n"
+                "log_mode = indexed\nspeculate_interval = 1\n")
+    batch_from_strings(_commands(), "config.ini")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    monitor = os.path.join(out_dir, "speculate.sh")
+    assert os.access(monitor, os.X_OK)
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert "export BATCHGEN_RUN_ID=${SLURM_JOB_ID:-$(date +%s%N)}\n" \
+        in batch_content
+    assert "{monitor} 0 14 15 &\nparallel -j 15".format(
+        monitor=monitor) in batch_content
+
+    # The original task is a straggler, the copy exits immediately.
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    os.makedirs("tmp")
+    env = dict(os.environ, BATCHGEN_RUN_ID="101", TMPDIR=tdir+"/tmp")
+    original = subprocess.Popen([wrapper, "0", "1", "1",
+                                 "echo slow; sleep 30"], env=env)
+    spec_dir = os.path.join(out_dir, "speculate_0_101")
+    while not os.path.exists(os.path.join(spec_dir, "1.pid.0")):
+        time.sleep(0.01)
+    copy_env = dict(env, BATCHGEN_SPECULATIVE_COPY="1")
+    copy = subprocess.run([wrapper, "0", "1", "2", "echo fast; exit 4"],
+                          env=copy_env)
+    assert copy.returncode == 4
+    assert original.wait(timeout=10) == 4
+    assert os.path.isfile(os.path.join(spec_dir, "1.end"))
+    with open(os.path.join(out_dir, "asr_sim_0.joblog")) as f:
+        assert len(f.read().splitlines()) == 1
+    # The output of the winner is logged, no temporary files are left.
+    assert task_output(out_dir, "0.1") == ["out| fast\n"]
+    assert os.listdir("tmp") == []
+
+    # The same batch again: the task runs, without the state of run 101.
+    env = dict(os.environ, BATCHGEN_RUN_ID="102")
+    assert subprocess.run([wrapper, "0", "1", "1", "exit 0"],
+                          env=env).returncode == 0
+    assert os.path.isfile(os.path.join(out_dir, "speculate_0_102", "1.end"))
+    with open(os.path.join(out_dir, "asr_sim_0.joblog")) as f:
+        assert len(f.read().splitlines()) == 2
+
+    # The monitor starts a copy of a straggler on the slot of a finished
+    # task.
+    spec_dir = os.path.join(out_dir, "speculate_0_103")
+    os.makedirs(spec_dir)
+    for seq, slot, start in [(1, 1, time.time()-10), (2, 2, time.time()-100)]:
+        for ext, value in [("cmd", "true"), ("slot", slot),
+                           ("start", int(start))]:
+            with open(os.path.join(spec_dir, "{seq}.{ext}".format(
+                    seq=seq, ext=ext)), "w") as f:
+                f.write("{value}\n".format(value=value))
+    with open(os.path.join(spec_dir, "1.end"), "w") as f:
+        f.write("1\n")
+    proc = subprocess.Popen([monitor, "0", "2", "2"],
+                            env=dict(os.environ, BATCHGEN_RUN_ID="103"))
+    try:
+        while not os.path.isfile(os.path.join(spec_dir, "2.rc")):
+            time.sleep(0.1)
+    finally:
+        proc.terminate()
+    with open(os.path.join(spec_dir, "2.copy")) as f:
+        assert f.read() == "1\n"
+
+
+def test_checkpoint(tmpdir):
+    """ Test the warning signal and the continuation of a batch. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "checkpoint = True\n")
+    batch_from_strings(_commands(), "config.ini")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    batch_file = os.path.join(out_dir, "batch_0.sh")
+    with open(batch_file) as f:
+        batch_content = f.read()
+    assert "#SBATCH --signal=B:USR1@300\n#SBATCH --open-mode=append\n" in \
+        batch_content
+    # Task lines with their id, which is kept in the continuation.
+    assert "\n2\tsleep 1; ./sum.sh 1 ${TMP_DIR}/asr\n" in batch_content
+    assert "setsid parallel -j 15 --joblog \"$_bg_joblog\" --rpl '{id} " \
+        "s/\\t.*//' --rpl '{cmd} s/^[^\\t]*\\t//' eval {cmd} < " \
+        "\"$_bg_tasks\" &" in batch_content
+    assert 'BATCHGEN_TASKS="$_bg_remaining" sbatch {batch_file}\n'.format(
+        batch_file=batch_file) in batch_content
+    assert subprocess.run(["bash", "-n", batch_file]).returncode == 0
+
+    with open("config.ini", "a") as f:
+        f.write("progress = True\n")
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    with open(batch_file) as f:
+        assert "task_wrapper.sh 0 {id} {%} {cmd} < \"$_bg_tasks\" &" in \
+            f.read()
+
+    # The monitor counts the tasks of the continuation, not of the batch.
+    with open("config.ini", "a") as f:
+        f.write("speculate = True\n")
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    with open(batch_file) as f:
+        batch_content = f.read()
+    monitor = "{spec} 0 $(wc -l < \"$_bg_tasks\") 15 &\n".format(
+        spec=os.path.join(out_dir, "speculate.sh"))
+    assert monitor in batch_content
+    assert "EOF_PARALLEL\nfi\nexport BATCHGEN_RUN_ID=" in batch_content
+    assert subprocess.run(["bash", "-n", batch_file]).returncode == 0
+
+
+def test_job_list(tmpdir):
+    """ Test generating several jobs from a job list. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    os.makedirs("sweep")
+    with open(os.path.join("sweep", "slurm.ini"), "w") as f:
+        f.write(_config_slurm_local())
+    with open(os.path.join("sweep", "parallel.ini"), "w") as f:
+        f.write(_config_parallel())
+    with open(os.path.join("sweep", "commands.sh"), "w") as f:
+        f.write(_commands())
+    with open(os.path.join("sweep", "pp_sum.sh"), "w") as f:
+        f.write(_pre_post_input())
+    with open(os.path.join("sweep", "jobs.ini"), "w") as f:
+        f.write("""[DEFAULT]
+command_file = commands.sh
+pre_post_file = pp_sum.sh
+[slurm]
+config_file = slurm.ini
+[parallel]
+config_file = parallel.ini
+[again]
+config_file = slurm.ini
+""")
+    res = subprocess.run([sys.executable, "-m", "batchgen", "multi",
+                          os.path.join("sweep", "jobs.ini")],
+                         stdout=subprocess.PIPE,
+                         env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                             os.path.dirname(batchgen.__file__))))
+    assert res.returncode == 1
+    output = res.stdout.decode("utf-8")
+    assert "** slurm             :       14 commands, written   **" in output
+    assert "** again             :        - commands, duplicate **" in output
+
+    results_tester(tdir, os.path.join("sweep", "slurm.ini"),
+                   _batch_slurm_local(tdir))
+    results_tester(tdir, os.path.join("sweep", "parallel.ini"),
+                   _batch_parallel(tdir))
+    submit_file = os.path.join(batch_dir("multi", "jobs"), "submit.sh")
+    with open(submit_file) as f:
+        submit = f.read()
+    assert "\n# slurm\nfor FILE in {dir}/batch_*.sh; do sbatch $FILE; " \
+        "done\n".format(dir=batch_dir("slurm_lisa", "asr_sim")) in submit
+    assert "# parallel\n" in submit
+    assert "# again\n" not in submit
+
+
+def test_staged_generation(tmpdir):
+    """ Test generation in a staging directory, which is swapped in. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write(_config_slurm_local() + "progress = True\n")
+    out_dir = batch_dir("slurm_lisa", "asr_sim")
+    batch_from_strings(_commands(), "config.ini")
+    # Output of a previous run is not removed.
+    with open(os.path.join(out_dir, "asr_sim_0.out"), "w") as f:
+        f.write("output")
+    os.unlink(os.path.join(out_dir, "batch_0.sh"))
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    assert sorted(os.listdir(out_dir)) == [
+        "asr_sim_0.out", "manifest.json", "progress", "task_wrapper.sh"]
+    os.unlink(os.path.join(out_dir, "asr_sim_0.out"))
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    assert sorted(os.listdir(out_dir)) == [
+        "batch_0.sh", "manifest.json", "progress", "task_wrapper.sh"]
+    assert sorted(os.listdir(os.path.dirname(out_dir))) == [
+        ".asr_sim.lock", "asr_sim"]
+
+    # Another batchgen process is generating the same job.
+    lock = lock_batch_directory(out_dir)
+    os.unlink(os.path.join(out_dir, "batch_0.sh"))
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    lock.close()
+    assert not os.path.exists(os.path.join(out_dir, "batch_0.sh"))
+
+    # Files not generated by batchgen are not replaced.
+    with open(os.path.join(out_dir, "progress", "node.log"), "w") as f:
+        f.write("S 0 1 1000 -\n")
+    batch_from_strings(_commands(), "config.ini", force_clear=True)
+    assert not os.path.exists(os.path.join(out_dir, "batch_0.sh"))
+
+    # The staged directory replaces the old one, which is then removed.
+    os.makedirs(os.path.join("swap", ".x.stage-1", "new"))
+    os.makedirs(os.path.join("swap", "x", "old"))
+    swap_directory(os.path.join("swap", ".x.stage-1"),
+                   os.path.join("swap", "x")).join()
+    assert os.listdir("swap") == ["x"]
+    assert os.listdir(os.path.join("swap", "x")) == ["new"]
+
+
+def test_append(tmpdir):
+    """ Test appending batches, and the streaming mode. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = append_test
+num_cores = 2
+num_tasks_per_node = 2
+joblog = True
+""")
+    batch_from_strings("echo 1\necho 2\necho 3\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "append_test")
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_0 = f.read()
+    assert append_from_strings("echo 4\necho 5\necho 6\n",
+                               "config.ini") == 0
+    manifest = read_manifest(out_dir)
+    assert manifest["num_batches"] == 4
+    assert manifest["num_commands"] == 6
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        assert f.read() == batch_0
+    with open(os.path.join(out_dir, "batch_3.sh")) as f:
+        assert "echo 6" in f.read()
+
+    # Commands from stdin, one batch when full and one at the end.
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(batchgen.__file__)))
+    res = subprocess.run(
+        [sys.executable, "-m", "batchgen", "append", "config.ini", "-n", "2"],
+        input=b"echo 7\necho 8\necho 9\n", stdout=subprocess.PIPE, env=env)
+    assert res.returncode == 0
+    assert read_manifest(out_dir)["num_batches"] == 6
+    with open(os.path.join(out_dir, "batch_5.sh")) as f:
+        assert "echo 9" in f.read()
+
+
+def test_local_backend(tmpdir):
+    """ Test running the commands directly, with pre/post-commands. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    os.makedirs("work")
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = local
+[BATCH_OPTIONS]
+job_name = local_test
+num_cores = 2
+task_timeout = 1
+joblog = True
+""")
+    pre = "export GREETING=hello\nsuffix=done\ncd work\n"
+    post = "echo $suffix > post.txt\n"
+    commands = "echo $GREETING 1 > out_1.txt\nsleep 10\nexit 3\n"
+    assert batch_from_strings(commands, "config.ini", pre, post) == 0
+    with open(os.path.join("work", "out_1.txt")) as f:
+        assert f.read() == "hello 1\n"
+    with open(os.path.join("work", "post.txt")) as f:
+        assert f.read() == "done\n"
+
+    out_dir = batch_dir("local", "local_test")
+    with open(os.path.join(out_dir, "local_test_0.joblog")) as f:
+        joblog = sorted(line.split("\t") for line in f.read().splitlines())
+    assert [(line[0], line[3]) for line in joblog] == \
+        [("1", "0"), ("2", "-9"), ("3", "3")]
+    assert float(joblog[1][2]) < 5
+
+    # Pre-commands that exit stop the batch, as in a batch script.
+    os.remove(os.path.join("work", "out_1.txt"))
+    os.remove(os.path.join("work", "post.txt"))
+    assert batch_from_strings(commands, "config.ini", "echo pre\nexit 1\n",
+                              "cd work\n" + post, force_clear=True) == 1
+    assert os.listdir("work") == []
+
+
+def test_memoization(tmpdir):
+    """ Test skipping commands with cached results, and storing them. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    memo_dir = os.path.join(tdir, "memo")
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = local
+[BATCH_OPTIONS]
+job_name = memo_test
+num_cores = 2
+memoize = True
+memo_dir = {memo_dir}
+memo_inputs = {{1}}
+memo_outputs = {{3}}
+""".format(memo_dir=memo_dir))
+    for i in range(3):
+        with open("in_{i}.txt".format(i=i), "w") as f:
+            f.write(str(i))
+    commands = "".join("cat in_{i}.txt > out_{i}.txt && echo {i} >> runs\n"
+                       .format(i=i) for i in range(3))
+    batch_from_strings(commands, "config.ini")
+    assert len(os.listdir(memo_dir)) == 3
+
+    # Only the command with a changed input runs again.
+    with open("in_2.txt", "w") as f:
+        f.write("changed")
+    for i in range(3):
+        os.remove("out_{i}.txt".format(i=i))
+    batch_from_strings(commands, "config.ini", force_clear=True)
+    with open("runs") as f:
+        assert sorted(f.read().split()) == ["0", "1", "2", "2"]
+    for i, content in enumerate(["0", "1", "changed"]):
+        with open("out_{i}.txt".format(i=i)) as f:
+            assert f.read() == content
+
+    # The task wrapper stores the outputs of the other backends.
+    with open("config.ini", "a") as f:
+        f.write("joblog = True\n")
+    with open("config.ini", "r") as f:
+        config = f.read().replace("backend = local", "backend = slurm_lisa")
+    with open("config.ini", "w") as f:
+        f.write(config)
+    commands += "cat in_3.txt > out_3.txt\n"
+    with open("in_3.txt", "w") as f:
+        f.write("3")
+    batch_from_strings(commands, "config.ini")
+    out_dir = batch_dir("slurm_lisa", "memo_test")
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        task = [line for line in f.read().splitlines()
+                if "in_3.txt" in line][0].split("; ", 1)[1]
+    subprocess.run([os.path.join(out_dir, "task_wrapper.sh"), "0", "1", "1",
+                    task])
+    assert len(os.listdir(memo_dir)) == 5
+    with open(os.path.join(out_dir, "memo_test_0.joblog")) as f:
+        assert f.read().split("\t")[-1] == "cat in_3.txt > out_3.txt\n"
+
+    assert evict(memo_dir, 0) == 5
+    assert os.listdir(memo_dir) == []
@@ -0,0 +1,277 @@
+"""
+Test the local SLURM stand-in, and run generated batches with it.
+
+@author: Raoul Schram
+"""
+
+import os
+import time
+import shutil
+import subprocess
+
+import pytest
+
+from batchgen import batch_from_strings
+from batchgen.fakeslurm import install_shims, wait_for_jobs
+from batchgen.report import query_sacct, task_records, efficiency,\
+    print_report
+from batchgen.submit import drip_feed, plan_round, submit_limits
+from batchgen.status import update_status
+from batchgen.util import batch_dir, read_manifest
+
+
+def _setup(tdir, monkeypatch, num_slots=2):
+    bin_dir = os.path.join(tdir, "bin")
+    state_dir = os.path.join(tdir, "slurm_state")
+    install_shims(bin_dir, state_dir, num_slots)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    return state_dir
+
+
+def _sbatch(*args):
+    res = subprocess.run(["sbatch", "--parsable"] + list(args),
+                         stdout=subprocess.PIPE)
+    assert res.returncode == 0
+    return res.stdout.decode("utf-8").strip()
+
+
+def test_fake_slurm(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("job.sh", "w") as f:
+        f.write("""#!/bin/bash
+#SBATCH -J array_job
+#SBATCH --output=%x_%a.out
+#SBATCH --array=0-2
+echo "$SLURM_JOB_NAME $SLURM_ARRAY_TASK_ID $SLURM_ARRAY_JOB_ID"
+""")
+    with open("fail.sh", "w") as f:
+        f.write("#!/bin/bash\n#SBATCH -o fail.out\nexit 3\n")
+    with open("after.sh", "w") as f:
+        f.write("#!/bin/bash\n#SBATCH -o after.out\necho after\n")
+
+    array_id = _sbatch("job.sh")
+    fail_id = _sbatch("fail.sh")
+    _sbatch("--dependency=afterok:" + array_id, "after.sh")
+    never_id = _sbatch("-d", "afterok:" + fail_id, "-o", "never.out",
+                       "after.sh")
+    jobs = {job["job_id"]: job for job in wait_for_jobs(state_dir)}
+
+    for i in range(3):
+        with open("array_job_{i}.out".format(i=i)) as f:
+            assert f.read() == "array_job {i} {id}\n".format(i=i, id=array_id)
+    assert jobs[fail_id]["state"] == "FAILED"
+    assert jobs[fail_id]["exit_code"] == 3
+    assert jobs[never_id]["state"] == "CANCELLED"
+    with open("after.out") as f:
+        assert f.read() == "after\n"
+    assert not os.path.exists("never.out")
+
+    res = subprocess.run(["sacct", "-n", "-P", "--format=JobID,State",
+                          "-j", fail_id], stdout=subprocess.PIPE)
+    assert res.stdout.decode("utf-8") == fail_id + "|FAILED\n"
+    res = subprocess.run(["squeue", "-h"], stdout=subprocess.PIPE)
+    assert res.stdout.decode("utf-8") == ""
+
+
+def test_lost_tasks(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = lost_test
+num_cores = 2
+progress = True
+""")
+    batch_from_strings("true\ntrue\ntrue\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "lost_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    # The second task is killed with its wrapper, e.g. at the wall time.
+    with open("job.sh", "w") as f:
+        f.write("#!/bin/bash\n{w} 0 1 1 true\n{w} 0 2 2 'kill -9 $PPID'\n"
+                .format(w=wrapper))
+    _sbatch("-o", "job.out", "job.sh")
+    wait_for_jobs(state_dir)
+    status = update_status(out_dir)
+    assert (status["done"], status["running"], status["lost"],
+            status["pending"]) == (1, 0, 1, 1)
+
+
+@pytest.mark.skipif(shutil.which("parallel") is None,
+                    reason="GNU parallel is not installed.")
+def test_generated_batches(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = fake_test
+num_cores = 2
+num_tasks_per_node = 3
+joblog = True
+""")
+    commands = "".join("echo {i} > out_{i}.txt\n".format(i=i)
+                       for i in range(6))
+    batch_from_strings(commands, "config.ini")
+    out_dir = batch_dir("slurm_lisa", "fake_test")
+    for batch_id in range(2):
+        _sbatch(os.path.join(out_dir, "batch_{i}.sh".format(i=batch_id)))
+    jobs = wait_for_jobs(state_dir)
+    assert [job["state"] for job in jobs] == ["COMPLETED"]*2
+    for i in range(6):
+        with open("out_{i}.txt".format(i=i)) as f:
+            assert f.read() == "{i}\n".format(i=i)
+
+
+def test_warning_signal(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("job.sh", "w") as f:
+        f.write("""#!/bin/bash
+#SBATCH -o warn.out
+#SBATCH -t 0:03
+#SBATCH --signal=B:USR1@2
+trap 'echo warned; exit 0' USR1
+sleep 10 &
+wait
+""")
+    job_id = _sbatch("job.sh")
+    jobs = {job["job_id"]: job for job in wait_for_jobs(state_dir)}
+    assert jobs[job_id]["state"] == "COMPLETED"
+    with open("warn.out") as f:
+        assert f.read() == "warned\n"
+
+
+@pytest.mark.skipif(shutil.which("parallel") is None,
+                    reason="GNU parallel is not installed.")
+def test_checkpoint(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = ckpt_test
+clock_wall_time = 00:00:06
+num_cores = 1
+checkpoint = True
+checkpoint_time = 3
+progress = True
+""")
+    commands = "".join("sleep 1; echo {i} >> done.txt\n".format(i=i)
+                       for i in range(4))
+    batch_from_strings(commands, "config.ini")
+    out_dir = batch_dir("slurm_lisa", "ckpt_test")
+    _sbatch(os.path.join(out_dir, "batch_0.sh"))
+    # The continuation is submitted before the first job ends.
+    jobs = wait_for_jobs(state_dir)
+    assert len(jobs) == 2
+    assert [job["state"] for job in jobs] == ["COMPLETED"]*2
+    with open("done.txt") as f:
+        assert sorted(f.read().split()) == ["0", "1", "2", "3"]
+    # The continuation reports its tasks with their original ids.
+    ended = []
+    for name in os.listdir(os.path.join(out_dir, "progress")):
+        with open(os.path.join(out_dir, "progress", name)) as f:
+            ended += [line.split()[2] for line in f if line[0] == "E"]
+    assert sorted(ended) == ["1", "2", "3", "4"]
+
+
+def test_report(tmpdir, monkeypatch, capsys):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    with open("job.sh", "w") as f:
+        f.write("""#!/bin/bash
+#SBATCH -J report_test
+#SBATCH -o job.out
+#SBATCH -t 00:10:00
+#SBATCH --tasks-per-node=2
+for i in $(seq 100000); do :; done
+sleep 1
+""")
+    # Submitted before the batches were generated: not part of the run.
+    _sbatch("job.sh")
+    wait_for_jobs(state_dir)
+    time.sleep(1.1)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = report_test
+num_cores = 2
+num_tasks_per_node = 2
+joblog = True
+""")
+    batch_from_strings("true\ntrue\nfalse\ntrue\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "report_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    for seq, command in enumerate(["true", "sleep 0.2", "false"], start=1):
+        subprocess.run([wrapper, "0", str(seq), "1", command])
+    job_ids = [_sbatch("job.sh"), _sbatch("-N", "2", "job.sh")]
+    wait_for_jobs(state_dir)
+
+    jobs = query_sacct("report_test", read_manifest(out_dir)["created"])
+    assert [job["job_id"] for job in jobs] == job_ids
+    assert [job["alloc_cpus"] for job in jobs] == [2, 4]
+    assert all(job["total_cpu"] > 0 for job in jobs)
+    assert jobs[0]["time_limit"] == 600
+
+    manifest = read_manifest(out_dir)
+    assert manifest["max_bill_time"] == "32:00:00"
+    tasks = task_records(out_dir)
+    assert sorted(task[1] for task in tasks) == [0, 0, 1]
+    report = efficiency(manifest, jobs, tasks)
+    assert report["estimated_bill_time"] == 32*3600
+    assert report["bill_time"] == sum(16*job["num_nodes"]*job["elapsed"]
+                                      for job in jobs)
+    assert report["longest_tasks"][0][2] == "sleep 0.2"
+    assert [task[2] for task in report["failed_tasks"]] == ["false"]
+    assert 0 < report["wall_utilization"] < 0.01
+
+    capsys.readouterr()
+    assert print_report(out_dir) == 0
+    output = capsys.readouterr().out
+    assert "** Jobs (sacct)      : 2 " in output
+    assert "** Estimated billing : 32:00:00 " in output
+    assert "increase num_tasks_per_node" in output
+
+
+def test_drip_feed(tmpdir, monkeypatch, capsys):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    state_dir = _setup(tdir, monkeypatch)
+    monkeypatch.setenv("BATCHGEN_FAKE_SLURM_MAX_SUBMIT", "3")
+    monkeypatch.setenv("BATCHGEN_FAKE_SLURM_MAX_ARRAY", "2")
+    assert plan_round({0: 0, 1: 0, 2: 1, 3: 1, 4: 1}, [1], 3, 2) == \
+        [[0], [2, 3]]
+    assert submit_limits({}) == (3, 2)
+
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = drip_test
+num_cores = 1
+""")
+    batch_from_strings("true\n"*7, "config.ini", "echo batch ${batch_id}\n")
+    out_dir = batch_dir("slurm_lisa", "drip_test")
+    capsys.readouterr()
+    assert drip_feed(out_dir, once=True) == 0
+    assert capsys.readouterr().out == "Submitted 3 batch(es), 3/7 in total.\n"
+    # Stopped and started again: continues with the other batches.
+    assert drip_feed(out_dir, interval=0.1) == 0
+    assert "sbatch failed" not in capsys.readouterr().out
+    jobs = wait_for_jobs(state_dir)
+    assert len(jobs) == 7
+    for i in range(7):
+        with open(os.path.join(out_dir, "drip_test_{i}.out".format(i=i))) as f:
+            assert f.readline() == "batch {i}\n".format(i=i)
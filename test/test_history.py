@@ -0,0 +1,78 @@
+"""
+Test the joblog, runtime history and estimates from the history.
+
+@author: Raoul Schram
+"""
+
+import os
+import subprocess
+
+from batchgen import batch_from_strings
+from batchgen.history import harvest, command_signature
+from batchgen.util import batch_dir
+
+
+def _config(backend, extra):
+    config = """[BACKEND]
+backend = {backend}
+[BATCH_OPTIONS]
+job_name = hist_test
+num_cores = 4
+num_cores_simul = 2
+""".format(backend=backend)
+    return config + extra
+
+
+def test_signature():
+    assert command_signature("./sum.sh 10  /tmp/run_3") == \
+        command_signature("./sum.sh 12 /tmp/run_4")
+    assert command_signature("./sum.sh 10") != command_signature("./mul.sh 10")
+
+
+def test_joblog_harvest(tmpdir):
+    """ Write a joblog with the task wrapper, harvest and use it. """
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    db_file = os.path.join(tdir, "history.sqlite")
+    with open("config.ini", "w") as f:
+        f.write(_config("parallel", "joblog = True\n"))
+    batch_from_strings("sleep 0.2\n", "config.ini")
+    out_dir = batch_dir("parallel", "hist_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    with open(os.path.join(out_dir, "batch.sh")) as f:
+        assert wrapper + " 0 {#} {%} {}" in f.read()
+
+    # Run the wrapper like GNU parallel would.
+    for seq, command in enumerate(["sleep 0.2", "sleep 0.3", "exit 2"]):
+        subprocess.run([wrapper, "0", str(seq+1), "1", command])
+    with open(os.path.join(out_dir, "hist_test_0.joblog")) as f:
+        lines = [line.split("\t") for line in f.read().splitlines()]
+    assert [line[0] for line in lines] == ["1", "2", "3"]
+    assert [line[3] for line in lines] == ["0", "0", "2"]
+    assert float(lines[1][2]) >= 0.3
+    assert lines[2][5] == "exit 2"
+
+    assert harvest([out_dir], db_file) == 3
+    assert harvest([out_dir], db_file) == 0
+
+    # Wall time from the history (2 rounds of 0.3*1.5 seconds -> 1 minute).
+    extra = """clock_wall_time = 10:00:00
+num_tasks_per_node = 4
+history = True
+history_db = {db_file}
+""".format(db_file=db_file)
+    with open("config.ini", "w") as f:
+        f.write(_config("slurm_lisa", extra))
+    batch_from_strings("sleep 1\nsleep 2\nsleep 3\nsleep 4\nsleep 5\n",
+                       "config.ini")
+    out_dir = batch_dir("slurm_lisa", "hist_test")
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        assert "#SBATCH -t 00:01:00\n" in f.read()
+
+    # Tasks per node from the history and the wall time.
+    with open("config.ini", "w") as f:
+        f.write(_config("slurm_lisa",
+                        extra.replace("num_tasks_per_node = 4\n", "")))
+    batch_from_strings("sleep 1\nsleep 2\nsleep 3\nsleep 4\nsleep 5\n",
+                       "config.ini", force_clear=True)
+    assert not os.path.exists(os.path.join(out_dir, "batch_1.sh"))
@@ -0,0 +1,240 @@
+"""
+Test shipping batches to (fake) remote servers.
+
+@author: Raoul Schram
+"""
+
+import os
+import json
+import shutil
+
+from batchgen import batch_from_strings
+from batchgen.federation import weighted_split
+from batchgen.fetch import fetch_results, read_fetched, FETCH_DIR
+from batchgen.util import batch_dir
+
+
+def _fake_commands(bin_dir, home_dir, log_file):
+    """ ssh runs the remote command locally (in home_dir), scp copies to
+        home_dir, sbatch logs and batchgen fails.
+    """
+    os.makedirs(bin_dir)
+    os.makedirs(home_dir)
+    with open(os.path.join(bin_dir, "ssh"), "w") as f:
+        f.write("#!/bin/bash\ncd {home}\nbash -c \"${{@: -1}}\"\n".format(
+            home=home_dir))
+    with open(os.path.join(bin_dir, "scp"), "w") as f:
+        f.write("""#!/bin/bash
+shift
+dest=${{@: -1}}
+dest={home}/${{dest#*:}}
+if [ $# -gt 2 ]; then mkdir -p "$dest"; else mkdir -p "$(dirname "$dest")"; fi
+cp "${{@:1:$#-1}}" "$dest"
+""".format(home=home_dir))
+    with open(os.path.join(bin_dir, "sbatch"), "w") as f:
+        f.write("#!/bin/bash\necho \"$1\" >> {log}\necho Submitted\n".format(
+            log=log_file))
+    with open(os.path.join(bin_dir, "batchgen"), "w") as f:
+        f.write("#!/bin/bash\nexit 1\n")
+    for name in ["ssh", "scp", "sbatch", "batchgen"]:
+        os.chmod(os.path.join(bin_dir, name), 0o755)
+
+
+def test_ship_mode(tmpdir, monkeypatch, capsys):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    home_dir = os.path.join(tdir, "home")
+    log_file = os.path.join(tdir, "sbatch.log")
+    _fake_commands(os.path.join(tdir, "bin"), home_dir, log_file)
+    monkeypatch.setenv("PATH", os.path.join(tdir, "bin") + os.pathsep +
+                       os.environ["PATH"])
+    with open("setup.sh", "w") as f:
+        f.write("echo setup\n")
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = ship_test
+num_cores = 2
+num_tasks_per_node = 2
+joblog = True
+setup_file = setup.sh
+shared_inputs = data/reference.dat
+output_dir = results
+[CONNECTION]
+server = cluster
+remote_dir = jobs
+remote_mode = ship
+submit = True
+""")
+    assert batch_from_strings("echo 1\necho 2\necho 3\n", "config.ini") == 0
+
+    remote_root = os.path.join(home_dir, "jobs")
+    remote_batch = os.path.join(remote_root, "batch.slurm_lisa", "ship_test")
+    with open(log_file) as f:
+        submitted = f.read().split()
+    assert submitted == [os.path.join(remote_batch, "batch_0.sh"),
+                         os.path.join(remote_batch, "batch_1.sh")]
+    with open(os.path.join(remote_batch, "batch_0.sh")) as f:
+        batch_content = f.read()
+    with open(os.path.join(remote_batch, "task_wrapper.sh")) as f:
+        wrapper = f.read()
+    assert "@BATCHGEN_REMOTE_ROOT@" not in batch_content + wrapper
+    assert os.path.join(remote_batch, "ship_test_0.out") in batch_content
+    assert "echo setup" in batch_content
+    assert "batch_dir=" + remote_batch in wrapper
+    # Shared inputs only exist on the remote server.
+    assert "cp -r {path} ".format(
+        path=os.path.join(remote_root, "data", "reference.dat")) in \
+        batch_content
+
+    # The remote batch directory is not overwritten without force_clear,
+    # and only if it holds nothing but generated files.
+    assert batch_from_strings("echo 1\n", "config.ini",
+                              force_clear=True) == 0
+    assert not os.path.exists(os.path.join(remote_batch, "batch_1.sh"))
+    assert os.listdir(os.path.dirname(remote_batch)) == ["ship_test"]
+    with open(os.path.join(remote_batch, "ship_test_0.out"), "w") as f:
+        f.write("output")
+    assert batch_from_strings("echo 1\n", "config.ini",
+                              force_clear=True) == 1
+    assert "ship_test_0.out in batch.slurm_lisa/ship_test was not generated" \
+        in capsys.readouterr()[0]
+    assert os.path.isfile(os.path.join(remote_batch, "ship_test_0.out"))
+    os.remove(os.path.join(remote_batch, "ship_test_0.out"))
+    shutil.rmtree(batch_dir("slurm_lisa", "ship_test", remote=True))
+    assert batch_from_strings("echo 1\n", "config.ini") == 1
+    assert "already exists on the remote server" in capsys.readouterr()[0]
+
+
+def test_federation(tmpdir, monkeypatch):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    home_dir = os.path.join(tdir, "home")
+    log_file = os.path.join(tdir, "sbatch.log")
+    _fake_commands(os.path.join(tdir, "bin"), home_dir, log_file)
+    monkeypatch.setenv("PATH", os.path.join(tdir, "bin") + os.pathsep +
+                       os.environ["PATH"])
+    assert weighted_split(10, [1, 1, 1]) == [4, 3, 3]
+    assert weighted_split(3, [0.2, 0.7, 0.1]) == [1, 2, 0]
+
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = fed
+num_cores = 2
+num_tasks_per_node = 2
+[TARGET big]
+server = cluster_a
+remote_dir = jobs_a
+remote_mode = ship
+submit = True
+weight = 2
+[TARGET small]
+server = cluster_b
+remote_dir = jobs_b
+remote_mode = ship
+submit = True
+""")
+    commands = "".join("echo {i}\n".format(i=i) for i in range(6))
+    assert batch_from_strings(commands, "config.ini") == 0
+
+    with open(os.path.join(batch_dir("federated", "fed"),
+                           "federation.json")) as f:
+        targets = json.load(f)["targets"]
+    assert [(t["name"], t["first_command"], t["num_commands"], t["status"])
+            for t in targets] == [("big", 0, 4, "sent"),
+                                  ("small", 4, 2, "sent")]
+    with open(log_file) as f:
+        assert len(f.read().split()) == 3
+    small_batch = os.path.join(home_dir, "jobs_b", "batch.slurm_lisa",
+                               "fed_small", "batch_0.sh")
+    with open(small_batch) as f:
+        batch_content = f.read()
+    assert "echo 4" in batch_content and "echo 3" not in batch_content
+
+    # A target in generate mode where batchgen fails is recorded as failed.
+    with open("pp.sh", "w") as f:
+        f.write("## PRE_COMMANDS ##\n## POST_COMMANDS ##\n")
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = fed_gen
+num_cores = 2
+pre_post_file = pp.sh
+[TARGET shipped]
+server = cluster_a
+remote_dir = jobs_a
+remote_mode = ship
+submit = True
+[TARGET generated]
+server = cluster_c
+remote_dir = jobs_c
+""")
+    assert batch_from_strings(commands, "config.ini") == 1
+    with open(os.path.join(batch_dir("federated", "fed_gen"),
+                           "federation.json")) as f:
+        targets = json.load(f)["targets"]
+    assert [(t["name"], t["status"]) for t in targets] == [
+        ("shipped", "sent"), ("generated", "failed")]
+
+
+def test_fetch(tmpdir, monkeypatch, capsys):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    home_dir = os.path.join(tdir, "home")
+    _fake_commands(os.path.join(tdir, "bin"), home_dir,
+                   os.path.join(tdir, "sbatch.log"))
+    monkeypatch.setenv("PATH", os.path.join(tdir, "bin") + os.pathsep +
+                       os.environ["PATH"])
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = fetch_test
+output_dir = results
+[CONNECTION]
+server = cluster
+remote_dir = my jobs
+""")
+    remote_results = os.path.join(home_dir, "my jobs", "results")
+    local_results = os.path.join("local", "results")
+    os.makedirs(os.path.join(remote_results, "sub"))
+    for name in ["a.out", "d.out", os.path.join("sub", "b.out")]:
+        with open(os.path.join(remote_results, name), "w") as f:
+            f.write(name + "\n")
+
+    assert fetch_results("config.ini", dest_dir="local") == 0
+    assert "Fetched 3 " in capsys.readouterr()[0]
+    with open(os.path.join(local_results, "sub", "b.out")) as f:
+        assert f.read() == os.path.join("sub", "b.out") + "\n"
+
+    # Only new, changed and locally removed files are fetched again.
+    with open(os.path.join(remote_results, "c.out"), "w") as f:
+        f.write("c\n")
+    with open(os.path.join(remote_results, "sub", "b.out"), "w") as f:
+        f.write("changed\n")
+    os.remove(os.path.join(local_results, "a.out"))
+    assert fetch_results("config.ini", dest_dir="local") == 0
+    assert "Fetched 3 " in capsys.readouterr()[0]
+    with open(os.path.join(local_results, "sub", "b.out")) as f:
+        assert f.read() == "changed\n"
+    assert sorted(os.listdir(local_results)) == ["a.out", "c.out", "d.out",
+                                                 "sub"]
+    fetched = read_fetched(os.path.join("local", FETCH_DIR,
+                                        "fetch_test.tsv"), "local")
+    assert len(fetched) == 4
+    assert fetch_results("config.ini", dest_dir="local") == 0
+    assert "Fetched 0 " in capsys.readouterr()[0]
+
+    # A file that changed while tar read it: tar exits with 1.
+    with open(os.path.join(tdir, "bin", "tar"), "w") as f:
+        f.write("#!/bin/bash\n{tar} \"$@\"\nexit 1\n".format(
+            tar=shutil.which("tar")))
+    os.chmod(os.path.join(tdir, "bin", "tar"), 0o755)
+    with open(os.path.join(remote_results, "e.out"), "w") as f:
+        f.write("e\n")
+    assert fetch_results("config.ini", dest_dir="local") == 0
+    assert "Fetched 1 " in capsys.readouterr()[0]
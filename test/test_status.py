@@ -0,0 +1,136 @@
+"""
+Test the progress records and their aggregation.
+
+@author: Raoul Schram
+"""
+
+import os
+import subprocess
+
+from batchgen import batch_from_strings
+from batchgen.status import update_status, failed_commands
+from batchgen.logs import task_output
+from batchgen.util import batch_dir, _chunk_commands
+
+
+def test_status(tmpdir):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = status_test
+num_cores = 2
+num_tasks_per_node = 2
+progress = True
+""")
+    batch_from_strings("true\ntrue\nfalse\ntrue\ntrue\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "status_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+
+    status = update_status(out_dir)
+    assert (status["num_tasks"], status["pending"], status["done"]) == \
+        (5, 5, 0)
+
+    # Run the first two batches with the wrapper, like GNU parallel would.
+    for batch_id, seq, command in [(0, 1, "true"), (0, 2, "true"),
+                                   (1, 1, "false")]:
+        subprocess.run([wrapper, str(batch_id), str(seq), "1", command])
+    status = update_status(out_dir)
+    assert (status["done"], status["failed"], status["running"],
+            status["pending"]) == (2, 1, 0, 2)
+
+    # A task that has started, but not finished yet: only new bytes are read.
+    log_file = os.path.join(out_dir, "progress", os.uname()[1] + ".log")
+    with open(log_file, "a") as f:
+        f.write("S 1 2 1000\n")
+    status = update_status(out_dir)
+    assert (status["done"], status["failed"], status["running"],
+            status["pending"]) == (2, 1, 1, 1)
+    assert update_status(out_dir, use_cache=False)["running"] == 1
+
+
+def test_indexed_logs(tmpdir):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = log_test
+num_cores = 2
+log_mode = indexed
+""")
+    batch_from_strings("echo a\necho b\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "log_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+    with open(os.path.join(out_dir, "batch_0.sh")) as f:
+        batch_content = f.read()
+    assert "#SBATCH --output={dir}/logs/%N.out\n".format(dir=out_dir) in \
+        batch_content
+    assert "#SBATCH --open-mode=append\n" in batch_content
+
+    subprocess.run([wrapper, "0", "1", "1", "echo first; echo oops >&2"])
+    subprocess.run([wrapper, "0", "2", "2", "echo second"])
+    assert task_output(out_dir, "0.1") == ["out| first\nerr| oops\n"]
+    assert task_output(out_dir, "0.2") == ["out| second\n"]
+    assert task_output(out_dir, "0.3") == []
+
+
+def test_retries(tmpdir):
+    tdir = str(tmpdir)
+    os.chdir(tdir)
+    with open("config.ini", "w") as f:
+        f.write("""[BACKEND]
+backend = slurm_lisa
+[BATCH_OPTIONS]
+job_name = retry_test
+num_cores = 2
+retry_max = 3
+retry_backoff = 0
+retry_exit_codes = 1, 75
+retry_stderr_patterns =
+    Stale file
+    license.*timeout
+""")
+    batch_from_strings("echo a\n", "config.ini")
+    out_dir = batch_dir("slurm_lisa", "retry_test")
+    wrapper = os.path.join(out_dir, "task_wrapper.sh")
+
+    # Transient failure: succeeds at the third attempt.
+    flaky = ("echo x >> count; [ $(wc -l < count) -ge 3 ] && exit 0; "
+             "echo 'license server timeout' >&2; exit 75")
+    res = subprocess.run([wrapper, "0", "1", "1", flaky],
+                         stderr=subprocess.PIPE)
+    assert res.returncode == 0
+    assert res.stderr.decode("utf-8").count("license server timeout") == 2
+    # Exit code or stderr not retryable, and too many attempts.
+    for seq, command in enumerate([
+            "echo x >> count2; echo 'Stale file handle' >&2; exit 2",
+            "echo x >> count3; echo 'other error' >&2; exit 1",
+            "echo x >> count4; echo 'Stale file handle' >&2; exit 1"],
+                                  start=2):
+        assert subprocess.run([wrapper, "0", str(seq), "1", command],
+                              stderr=subprocess.PIPE).returncode != 0
+    for count_file, attempts in [("count2", 1), ("count3", 1),
+                                 ("count4", 3)]:
+        with open(count_file) as f:
+            assert len(f.readlines()) == attempts
+    assert failed_commands(out_dir) == [
+        "echo x >> count2; echo 'Stale file handle' >&2; exit 2",
+        "echo x >> count3; echo 'other error' >&2; exit 1",
+        "echo x >> count4; echo 'Stale file handle' >&2; exit 1"]
+
+    # Only the failed commands of a compound task are recorded.
+    os.remove(os.path.join(out_dir, "retry_test_0.failed"))
+    with open("config.ini", "a") as f:
+        f.write("chunk_size = 3\n")
+    batch_from_strings("echo a\n", "config.ini", force_clear=True)
+    compound = _chunk_commands(["echo 'b' >> count5", "exit 3",
+                                "echo x >> count5; exit 4"], 3)[0]
+    assert subprocess.run([wrapper, "0", "1", "1", compound],
+                          stderr=subprocess.PIPE).returncode == 1
+    assert failed_commands(out_dir) == ["exit 3", "echo x >> count5; exit 4"]
+    with open("count5") as f:
+        assert f.read() == "b\nx\n"